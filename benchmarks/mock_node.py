@@ -0,0 +1,426 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : benchmarks mock node
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Local mock Ethereum JSON-RPC node, over HTTPS and WSS, for the benchmarks
+
+Run alone, it prints its URLs and serves until interrupted :
+python benchmarks/mock_node.py --latency 0.02 --error-rate 0.01
+"""
+
+
+import argparse
+import gzip
+import json
+import os
+import random
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from wsproto import WSConnection, ConnectionType
+from wsproto.events import (
+    AcceptConnection,
+    BytesMessage,
+    CloseConnection,
+    Ping,
+    Request,
+    TextMessage,
+)
+from wsproto.extensions import PerMessageDeflate
+
+
+CHAIN_ID = 137
+FIRST_BLOCK = 30000000
+BLOCK_TIME = 2  # seconds
+
+DEFAULT_PAYLOAD_SIZE = 100000  # bytes of an eth_getLogs response
+LOG_DATA_SIZE = 256  # bytes of data in each log
+
+RECEIVING_BUFFER_SIZE = 65536
+
+# Multicall3, answering aggregate3 calls
+MULTICALL3_ADDRESS = "0xca11bde05977b3631167028862be2a173976ca11"
+MULTICALL3_CODE = "0x6080604052"
+AGGREGATE3_SELECTOR = "82ad56cb"
+# The calls with this selector revert, the others give the target address
+REVERT_SELECTOR = "deadbeef"
+# Error("mock revert")
+REVERT_DATA = (
+    "08c379a0" + f"{32:064x}" + f"{11:064x}" + b"mock revert".hex().ljust(64, "0")
+)
+
+
+def make_certificate(directory):
+    """Create a self-signed certificate for localhost with openssl.
+    Return the certificate and the key files paths.
+    """
+    certfile = os.path.join(directory, "mock_node_cert.pem")
+    keyfile = os.path.join(directory, "mock_node_key.pem")
+    if not (os.path.exists(certfile) and os.path.exists(keyfile)):
+        subprocess.run(
+            [
+                "openssl",
+                "req",
+                "-x509",
+                "-newkey",
+                "ec",
+                "-pkeyopt",
+                "ec_paramgen_curve:prime256v1",
+                "-nodes",
+                "-keyout",
+                keyfile,
+                "-out",
+                certfile,
+                "-days",
+                "30",
+                "-subj",
+                "/CN=localhost",
+                "-addext",
+                "subjectAltName=DNS:localhost,IP:127.0.0.1",
+            ],
+            check=True,
+            capture_output=True,
+        )
+    return certfile, keyfile
+
+
+def read_word(data, offset):
+    """Read an ABI uint256 of data."""
+    return int.from_bytes(data[offset : offset + 32], "big")
+
+
+def call_output(target, call_data):
+    """Give (success, return data) of a contract call."""
+    if call_data[:4].hex() == REVERT_SELECTOR:
+        return False, bytes.fromhex(REVERT_DATA)
+    return True, bytes.fromhex(target[2:].rjust(64, "0"))
+
+
+def aggregate3(call_data):
+    """Run the calls of an aggregate3 call data, encode their results."""
+    arguments = call_data[4:]
+    array_position = read_word(arguments, 0)
+    count = read_word(arguments, array_position)
+    base = array_position + 32
+    encoded_results = []
+    for index in range(count):
+        tuple_position = base + read_word(arguments, base + 32 * index)
+        target = "0x" + arguments[tuple_position + 12 : tuple_position + 32].hex()
+        bytes_position = tuple_position + read_word(arguments, tuple_position + 64)
+        length = read_word(arguments, bytes_position)
+        success, output = call_output(
+            target, arguments[bytes_position + 32 : bytes_position + 32 + length]
+        )
+        encoded_results.append(
+            int(success).to_bytes(32, "big")
+            + (64).to_bytes(32, "big")
+            + len(output).to_bytes(32, "big")
+            + output
+            + bytes(-len(output) % 32)
+        )
+    head = (32).to_bytes(32, "big") + count.to_bytes(32, "big")
+    offset = 32 * count
+    for encoded_result in encoded_results:
+        head += offset.to_bytes(32, "big")
+        offset += len(encoded_result)
+    return "0x" + (head + b"".join(encoded_results)).hex()
+
+
+def log_item(block_number, index):
+    """Build a log of a block, as given by eth_getLogs."""
+    return {
+        "address": "0x" + f"{index:040x}",
+        "blockHash": "0x" + f"{block_number:064x}",
+        "blockNumber": hex(block_number),
+        "data": "0x" + "ab" * LOG_DATA_SIZE,
+        "logIndex": hex(index),
+        "removed": False,
+        "topics": [
+            "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef",
+            "0x" + f"{index:064x}",
+        ],
+        "transactionHash": "0x" + f"{block_number * 1000 + index:064x}",
+        "transactionIndex": hex(index),
+    }
+
+
+class RevertError(Exception):
+    """A contract call reverted, with the revert data."""
+
+
+class MockNode:
+    """Mock Ethereum node : answers the common read methods with
+    deterministic results, after a latency, and fails a fraction of the
+    requests (error_rate) with an internal error.
+    Multicall3 is deployed : the contracts calls give their target address,
+    or revert when their selector is REVERT_SELECTOR.
+    The eth_getLogs responses are about payload_size bytes.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        payload_size=DEFAULT_PAYLOAD_SIZE,
+        error_rate=0.0,
+        compression=False,
+        seed=None,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.compression = compression
+        self.random = random.Random(seed)
+        self.started = time.monotonic()
+        log_size = len(json.dumps(log_item(FIRST_BLOCK, 0))) + 1
+        self.logs = [
+            log_item(FIRST_BLOCK, index)
+            for index in range(max(payload_size // log_size, 1))
+        ]
+        self.requests = 0
+
+    def block_number(self):
+        """Give the current block number, advancing with the time."""
+        return FIRST_BLOCK + int((time.monotonic() - self.started) / BLOCK_TIME)
+
+    def result(self, method, params):
+        """Give the result of a method, or raise KeyError if unknown."""
+        if method == "eth_blockNumber":
+            return hex(self.block_number())
+        if method == "eth_chainId":
+            return hex(CHAIN_ID)
+        if method == "eth_gasPrice":
+            return hex(30 * 10 ** 9)
+        if method == "eth_getBalance":
+            return hex(int(params[0], 16) * 10 ** 9)
+        if method == "eth_getTransactionCount":
+            return hex(int(params[0], 16) % 1000)
+        if method == "eth_getCode":
+            if params[0].lower() == MULTICALL3_ADDRESS:
+                return MULTICALL3_CODE
+            return "0x"
+        if method == "eth_call":
+            target = params[0]["to"].lower()
+            call_data = bytes.fromhex(params[0].get("data", "0x")[2:])
+            if target == MULTICALL3_ADDRESS:
+                if call_data[:4].hex() != AGGREGATE3_SELECTOR:
+                    raise ValueError("Only aggregate3 is supported")
+                return aggregate3(call_data)
+            success, output = call_output(target, call_data)
+            if not success:
+                raise RevertError(output)
+            return "0x" + output.hex()
+        if method == "eth_getLogs":
+            return self.logs
+        raise KeyError(method)
+
+    def handle(self, request):
+        """Give the response object of a decoded request object."""
+        self.requests += 1
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        if self.error_rate and self.random.random() < self.error_rate:
+            response["error"] = {"code": -32603, "message": "Internal error"}
+            return response
+        try:
+            response["result"] = self.result(
+                request.get("method"), request.get("params") or []
+            )
+        except RevertError as exc:
+            response["error"] = {
+                "code": 3,
+                "message": "execution reverted",
+                "data": "0x" + exc.args[0].hex(),
+            }
+        except KeyError:
+            response["error"] = {"code": -32601, "message": "Method not found"}
+        except (IndexError, TypeError, ValueError):
+            response["error"] = {"code": -32602, "message": "Invalid params"}
+        return response
+
+    def handle_payload(self, body):
+        """Give the encoded response of an encoded request, or batch."""
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return json.dumps(
+                {
+                    "jsonrpc": "2.0",
+                    "id": None,
+                    "error": {"code": -32700, "message": "Parse error"},
+                }
+            )
+        if isinstance(payload, list):
+            return json.dumps([self.handle(request) for request in payload])
+        return json.dumps(self.handle(payload))
+
+    def start(self, certfile, keyfile, host="127.0.0.1", https_port=0, wss_port=0):
+        """Start the HTTPS and WSS servers in threads.
+        Return their URLs, the ports are chosen by the system when 0.
+        """
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(certfile, keyfile)
+        https_server = ThreadingHTTPServer((host, https_port), http_handler(self))
+        https_server.daemon_threads = True
+        # The TLS handshake is done in the request thread
+        https_server.socket = ssl_context.wrap_socket(
+            https_server.socket, server_side=True, do_handshake_on_connect=False
+        )
+        threading.Thread(target=https_server.serve_forever, daemon=True).start()
+        listening_socket = socket.socket()
+        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listening_socket.bind((host, wss_port))
+        listening_socket.listen(128)
+        threading.Thread(
+            target=self.accept_websockets,
+            args=(listening_socket, ssl_context),
+            daemon=True,
+        ).start()
+        return (
+            f"https://localhost:{https_server.server_address[1]}/",
+            f"wss://localhost:{listening_socket.getsockname()[1]}/",
+        )
+
+    def accept_websockets(self, listening_socket, ssl_context):
+        """Accept the WebSocket connections, each served in a thread."""
+        while True:
+            client_socket, _ = listening_socket.accept()
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(
+                target=self.serve_websocket,
+                args=(client_socket, ssl_context),
+                daemon=True,
+            ).start()
+
+    def serve_websocket(self, client_socket, ssl_context):
+        """Serve a WebSocket connection. The requests are answered in
+        threads after the latency, so they are multiplexed.
+        """
+        try:
+            tls_socket = ssl_context.wrap_socket(client_socket, server_side=True)
+        except (OSError, ssl.SSLError):
+            client_socket.close()
+            return
+        websocket = WSConnection(ConnectionType.SERVER)
+        lock = threading.Lock()
+
+        def send(event):
+            with lock:
+                tls_socket.sendall(websocket.send(event))
+
+        def reply(message):
+            if self.latency:
+                time.sleep(self.latency)
+            try:
+                send(TextMessage(self.handle_payload(message)))
+            except OSError:
+                pass
+
+        parts = []
+        try:
+            while True:
+                data = tls_socket.recv(RECEIVING_BUFFER_SIZE)
+                if not data:
+                    return
+                websocket.receive_data(data)
+                for event in websocket.events():
+                    if isinstance(event, Request):
+                        extensions = []
+                        if self.compression and event.extensions:
+                            extensions = [PerMessageDeflate()]
+                        send(AcceptConnection(extensions=extensions))
+                    elif isinstance(event, Ping):
+                        send(event.response())
+                    elif isinstance(event, CloseConnection):
+                        send(event.response())
+                        return
+                    elif isinstance(event, (TextMessage, BytesMessage)):
+                        parts.append(event.data)
+                        if event.message_finished:
+                            message = parts[0][:0].join(parts)
+                            parts = []
+                            if self.latency:
+                                threading.Thread(
+                                    target=reply, args=(message,), daemon=True
+                                ).start()
+                            else:
+                                reply(message)
+        except OSError:
+            return
+        finally:
+            tls_socket.close()
+
+
+def http_handler(node):
+    """Build the HTTP request handler class of a node."""
+
+    class MockNodeHandler(BaseHTTPRequestHandler):
+        """Answer the JSON-RPC POST requests, on kept-alive connections."""
+
+        protocol_version = "HTTP/1.1"
+        # The headers and the body are written separately
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if node.latency:
+                time.sleep(node.latency)
+            response = node.handle_payload(body).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            if node.compression and "gzip" in self.headers.get("Accept-Encoding", ""):
+                response = gzip.compress(response, 1)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+
+    return MockNodeHandler
+
+
+def main():
+    """Start a mock node, print its URLs, and serve until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--payload-size", type=int, default=DEFAULT_PAYLOAD_SIZE)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--compression", action="store_true")
+    parser.add_argument("--https-port", type=int, default=0)
+    parser.add_argument("--wss-port", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--cert-dir", default=tempfile.gettempdir())
+    args = parser.parse_args()
+    certfile, keyfile = make_certificate(args.cert_dir)
+    node = MockNode(
+        args.latency, args.payload_size, args.error_rate, args.compression, args.seed
+    )
+    https_url, wss_url = node.start(
+        certfile, keyfile, https_port=args.https_port, wss_port=args.wss_port
+    )
+    print(https_url, wss_url, certfile, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : benchmarks runner
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Web3Client benchmarks, against a local mock node
+
+Each scenario runs in its own process, so its CPU time and peak memory are
+only the client ones : the mock node runs in another process.
+python benchmarks/run.py --save results.json
+python benchmarks/run.py --compare results.json
+"""
+
+
+import argparse
+import json
+import os
+import platform
+import resource
+import ssl
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from mock_node import make_certificate
+
+
+TRANSPORTS = ("https", "wss")
+
+# Scenario : method called, concurrent threads
+SCENARIOS = {
+    "latency": ("get_block_number", 1),
+    "throughput": ("get_balance", 16),
+    "batch": ("request_many", 4),
+    "large": ("get_logs", 4),
+    "stream": ("stream_logs", 4),
+    "multicall": ("multicall", 4),
+}
+
+BATCH_SIZE = 100  # queries in each request_many, or calls in each multicall
+
+# Measures, and if a higher value is better
+MEASURES = {
+    "calls_per_s": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "cpu_ms_per_call": False,
+    "peak_rss_mb": False,
+}
+
+DEFAULT_THRESHOLD = 0.2  # relative change reported as a regression
+
+
+def address(index):
+    """Give a test address."""
+    return f"0x{index:040x}"
+
+
+def scenario_call(client, method, index):
+    """Do a call of a scenario method."""
+    if method == "get_block_number":
+        return client.get_block_number()
+    if method == "get_balance":
+        return client.get_balance(address(index))
+    if method == "request_many":
+        return client.request_many(
+            [
+                ("eth_getBalance", [address(index * BATCH_SIZE + item), "latest"])
+                for item in range(BATCH_SIZE)
+            ]
+        )
+    if method == "get_logs":
+        return len(client.get_logs({"fromBlock": hex(index)}))
+    if method == "stream_logs":
+        return sum(1 for _ in client.stream_logs({"fromBlock": hex(index)}))
+    if method == "multicall":
+        # balanceOf(address)
+        return client.multicall(
+            [
+                (address(index * BATCH_SIZE + item), "70a08231", "00" * 32)
+                for item in range(BATCH_SIZE)
+            ]
+        )
+    raise ValueError(f"Unknown method {method}")
+
+
+def percentile_ms(sorted_values, fraction):
+    """Give a percentile of sorted durations, in milliseconds."""
+    if not sorted_values:
+        return None
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return round(sorted_values[index] * 1000, 3)
+
+
+def run_scenario(scenario, url, certfile, calls):
+    """Measure a scenario in this process, return its measures."""
+    # Imported here, so the runner can run without pyweb3 importable
+    from pyweb3 import Web3Client
+
+    method, threads = SCENARIOS[scenario]
+    client = Web3Client(url, ssl_context=ssl.create_default_context(cafile=certfile))
+    # Warm up the connections
+    with ThreadPoolExecutor(threads) as executor:
+        for index in range(threads):
+            executor.submit(scenario_call, client, method, index)
+    latencies = []
+    errors = []
+
+    def timed_call(index):
+        start = monotonic()
+        try:
+            scenario_call(client, method, index)
+        except Exception:
+            errors.append(index)
+            return
+        latencies.append(monotonic() - start)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_start = usage.ru_utime + usage.ru_stime
+    start = monotonic()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(timed_call, range(calls)))
+    duration = monotonic() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    latencies.sort()
+    return {
+        "calls": calls,
+        "errors": len(errors),
+        "calls_per_s": round(calls / duration, 1),
+        "p50_ms": percentile_ms(latencies, 0.5),
+        "p99_ms": percentile_ms(latencies, 0.99),
+        "cpu_ms_per_call": round(
+            (usage.ru_utime + usage.ru_stime - cpu_start) * 1000 / calls, 4
+        ),
+        # ru_maxrss is in kB on Linux
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+    }
+
+
+def start_node(args):
+    """Start the mock node process, return it and its URLs."""
+    node = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_node.py"),
+            "--latency",
+            str(args.latency),
+            "--payload-size",
+            str(args.payload_size),
+            "--error-rate",
+            str(args.error_rate),
+            "--seed",
+            "1",
+            "--cert-dir",
+            args.cert_dir,
+        ]
+        + (["--compression"] if args.compression else []),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    https_url, wss_url, _ = node.stdout.readline().split()
+    return node, {"https": https_url, "wss": wss_url}
+
+
+def run_all(args):
+    """Run the scenarios, each in a child process. Return the results."""
+    certfile, _ = make_certificate(args.cert_dir)
+    node, urls = start_node(args)
+    results = {}
+    try:
+        for scenario in args.scenarios:
+            for transport in args.transports:
+                child = subprocess.run(
+                    [
+                        sys.executable,
+                        os.path.abspath(__file__),
+                        "--child",
+                        scenario,
+                        urls[transport],
+                        certfile,
+                        str(args.calls),
+                    ],
+                    stdout=subprocess.PIPE,
+                    universal_newlines=True,
+                    check=True,
+                )
+                name = f"{scenario}/{transport}"
+                results[name] = json.loads(child.stdout)
+                print_measures(name, results[name])
+    finally:
+        node.terminate()
+        node.wait()
+    return results
+
+
+def print_measures(name, measures, baseline=None, threshold=DEFAULT_THRESHOLD):
+    """Print the measures of a scenario, and their change from a baseline.
+    Return the number of regressions.
+    """
+    cells = []
+    regressions = 0
+    for measure, higher_is_better in MEASURES.items():
+        cell = f"{measure}={measures[measure]}"
+        if baseline is not None and baseline.get(measure) and measures[measure]:
+            change = measures[measure] / baseline[measure] - 1
+            cell += f" ({change:+.0%})"
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                cell += " REGRESSION"
+                regressions += 1
+        cells.append(cell)
+    if measures["errors"]:
+        cells.append(f"errors={measures['errors']}")
+    print(f"{name:<18} " + "  ".join(cells), flush=True)
+    return regressions
+
+
+def main():
+    """Run the benchmarks, save or compare the results."""
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        scenario, url, certfile, calls = sys.argv[2:6]
+        print(json.dumps(run_scenario(scenario, url, certfile, int(calls))))
+        return 0
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=2000, help="per scenario")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--payload-size", type=int, default=100000, help="bytes")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--compression", action="store_true")
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument(
+        "--transports", nargs="+", choices=TRANSPORTS, default=list(TRANSPORTS)
+    )
+    parser.add_argument("--cert-dir", default=tempfile.gettempdir())
+    parser.add_argument("--save", help="file to save the results in")
+    parser.add_argument("--label", default="", help="of the saved results")
+    parser.add_argument("--compare", help="results file of a previous run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="relative change of a measure reported as a regression",
+    )
+    args = parser.parse_args()
+    settings = {
+        "calls": args.calls,
+        "latency": args.latency,
+        "payload_size": args.payload_size,
+        "error_rate": args.error_rate,
+        "compression": args.compression,
+    }
+    results = run_all(args)
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\nCompared to {args.compare} {baseline.get('label', '')}")
+        if baseline.get("settings") != settings:
+            print(f"Warning, other settings : {baseline.get('settings')}")
+        for name, measures in results.items():
+            if name in baseline["results"]:
+                regressions += print_measures(
+                    name, measures, baseline["results"][name], args.threshold
+                )
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(
+                {
+                    "label": args.label,
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "settings": settings,
+                    "results": results,
+                },
+                results_file,
+                indent=2,
+            )
+    if regressions:
+        print(f"\n{regressions} regressions")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
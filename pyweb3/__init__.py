@@ -1,20 +1,33 @@
-# -*- coding: utf8 -*-
-
-# pyWeb3 : Web3 RPC client for Python wallets
-# Copyright (C) 2021-2022 BitLogiK
-
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, version 3 of the License.
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-# You should have receive a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>
-
-
-"""Web3 RPC client module"""
-
-
-from .web3client import Web3Client
+# -*- coding: utf8 -*-
+
+# pyWeb3 : Web3 RPC client for Python wallets
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Web3 RPC client module"""
+
+
+from .web3client import Web3Client
+from .async_client import AsyncWeb3Client
+from .json_rpc import JSONRPCexception
+from .cache import ResponseCache
+from .log_scanner import ScanCheckpoint
+from .rate_limit import RateLimiter
+from .retry import RetryPolicy
+from .json_codec import set_json_library
+from .tls_socket import SocketOptions
+from .instrumentation import add_listener
+from .instrumentation import remove_listener
+from .instrumentation import InstrumentationListener
+from .instrumentation import MetricsRecorder
+from .instrumentation import OpenTelemetryListener
@@ -0,0 +1,176 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : accounts state fetcher
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Bulk accounts state fetcher for pyWeb3"""
+
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from logging import getLogger
+from time import monotonic, sleep
+from .log_scanner import DEFAULT_WORKERS
+
+
+DEFAULT_ACCOUNTS_CHUNK = 100  # accounts per request_many
+
+# Account fields : JSON-RPC method, and if its result is an integer
+ACCOUNT_FIELDS = {
+    "balance": ("eth_getBalance", True),
+    "nonce": ("eth_getTransactionCount", True),
+    "code": ("eth_getCode", False),
+}
+
+
+logger = getLogger(__name__)
+
+
+def decode_field(raw_result, is_integer):
+    """Decode the result of a field query, an error is given as is."""
+    if isinstance(raw_result, Exception) or not is_integer:
+        return raw_result
+    try:
+        return int(raw_result, 16)
+    except (TypeError, ValueError) as exc:
+        return ValueError(f"Bad data : {raw_result}", exc)
+
+
+class PendingAccount:
+    """An account to fetch, and its failed tries."""
+
+    def __init__(self, address):
+        self.address = address
+        self.tries = 0
+        self.first_try = None
+        self.retry_time = 0
+
+
+class AccountFetcher:
+    """Fetch the state of many accounts at a single block.
+    The addresses are read from an iterable as they are needed, in chunks
+    queried concurrently in JSON-RPC batches : at most workers chunks are
+    in flight, so the memory used doesn't depend on the addresses count.
+    The accounts are given as their chunk completes, not in order.
+    An account with a field in error is queried again after the retry
+    policy delay, alone in a next chunk. When it is not retried anymore,
+    the error is given in place of the field value.
+    """
+
+    def __init__(
+        self,
+        jsonrpc,
+        addresses,
+        fields,
+        block,
+        chunk_size=DEFAULT_ACCOUNTS_CHUNK,
+        workers=DEFAULT_WORKERS,
+    ):
+        for field in fields:
+            if field not in ACCOUNT_FIELDS:
+                raise ValueError(f"Account field must be one of {list(ACCOUNT_FIELDS)}")
+        self.jsonrpc = jsonrpc
+        self.addresses = iter(addresses)
+        self.fields = tuple(fields)
+        if isinstance(block, int):
+            block = hex(block)
+        self.block = block
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retries = deque()
+
+    def next_chunk(self):
+        """Give the next accounts to query : the retries when their delay
+        expired, else new addresses.
+        """
+        now = monotonic()
+        chunk = []
+        while self.retries and self.retries[0].retry_time <= now:
+            chunk.append(self.retries.popleft())
+            if len(chunk) >= self.chunk_size:
+                return chunk
+        chunk.extend(
+            PendingAccount(address)
+            for address in islice(self.addresses, self.chunk_size - len(chunk))
+        )
+        return chunk
+
+    def fetch_chunk(self, chunk):
+        """Query the fields of the accounts, return their values lists."""
+        requests = [
+            (ACCOUNT_FIELDS[field][0], [account.address, self.block])
+            for account in chunk
+            for field in self.fields
+        ]
+        try:
+            raw_results = self.jsonrpc.request_many(requests)
+        except Exception as exc:
+            raw_results = [exc] * len(requests)
+        fields_count = len(self.fields)
+        return [
+            raw_results[index * fields_count : (index + 1) * fields_count]
+            for index in range(len(chunk))
+        ]
+
+    def account_done(self, account, raw_results):
+        """Give the fields of an account, or None when it is retried."""
+        now = monotonic()
+        if account.first_try is None:
+            account.first_try = now
+        for raw_result in raw_results:
+            if isinstance(raw_result, Exception):
+                delay = self.jsonrpc.retry_policy.delay(
+                    account.tries, raw_result, now - account.first_try, True
+                )
+                if delay is not None:
+                    logger.log(5, "Retry account %s : %s", account.address, raw_result)
+                    account.tries += 1
+                    account.retry_time = now + delay
+                    self.retries.append(account)
+                    return None
+                break
+        return {
+            field: decode_field(raw_result, ACCOUNT_FIELDS[field][1])
+            for field, raw_result in zip(self.fields, raw_results)
+        }
+
+    def __iter__(self):
+        """Give (address, fields dict) of the accounts, as they are fetched."""
+        executor = ThreadPoolExecutor(self.workers)
+        in_flight = {}
+        try:
+            while True:
+                while len(in_flight) < self.workers:
+                    chunk = self.next_chunk()
+                    if not chunk:
+                        break
+                    in_flight[executor.submit(self.fetch_chunk, chunk)] = chunk
+                if not in_flight:
+                    if not self.retries:
+                        return
+                    # Only accounts waiting for their retry delay
+                    sleep(max(self.retries[0].retry_time - monotonic(), 0))
+                    continue
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = in_flight.pop(future)
+                    for account, raw_results in zip(chunk, future.result()):
+                        fields = self.account_done(account, raw_results)
+                        if fields is not None:
+                            yield account.address, fields
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=False)
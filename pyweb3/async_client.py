@@ -0,0 +1,274 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : asyncio Web3 client
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Asyncio Web3 RPC client"""
+
+
+import asyncio
+from itertools import count
+from logging import getLogger
+
+from .async_transport import AsyncHttpClient, AsyncWebSocketClient
+from .json_rpc import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_USER_AGENT,
+    json_encode,
+    json_rpc_batch_results,
+    json_rpc_decode,
+    json_rpc_message,
+    json_rpc_request,
+    json_rpc_result,
+)
+from .retry import RetryPolicy, is_idempotent
+from .web3client import Web3Batch, Web3Methods
+from .websocket import DEFAULT_MAX_INFLIGHT
+
+
+logger = getLogger(__name__)
+
+
+class AsyncJSONRPCclient:
+    """WebSocket and HTTPS JSON-RPC client, for asyncio"""
+
+    def __init__(
+        self,
+        url_api,
+        user_agent,
+        retries,
+        batch_size=DEFAULT_BATCH_SIZE,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        timeout=None,
+        compression=True,
+        ssl_context=None,
+    ):
+        if user_agent is None:
+            user_agent = DEFAULT_USER_AGENT
+        if url_api.startswith("wss:"):
+            self.cnx = AsyncWebSocketClient(
+                url_api, user_agent, max_inflight, compression, ssl_context
+            )
+        elif url_api.startswith("https:"):
+            self.cnx = AsyncHttpClient(url_api, user_agent, compression, ssl_context)
+        else:
+            raise Exception("Only accept HTTPS and WebSocket connection scheme")
+        self.multiplexed = isinstance(self.cnx, AsyncWebSocketClient)
+        if not isinstance(retries, RetryPolicy):
+            retries = RetryPolicy(retries)
+        self.retry_policy = retries
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.req_ids = count(1)
+        self.connect_lock = None
+
+    def close(self):
+        """Close the connections"""
+        self.cnx.close()
+
+    async def connect(self):
+        """Open the WebSocket connection, when not opened yet or closed"""
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            if self.cnx.is_closed():
+                await self.cnx.connect()
+
+    async def exchange(self, request_ids, message):
+        """Send an encoded JSON RPC request or batch,
+        return the decoded response
+        """
+        if self.multiplexed:
+            if self.cnx.is_closed():
+                await self.connect()
+            return await self.cnx.exchange(request_ids, message)
+        return json_rpc_decode(await self.cnx.exchange(message))
+
+    async def with_retries(self, query_function, *args, idempotent=True):
+        """Run a query coroutine function, and retry it after an error,
+        as the retry policy tells.
+        """
+        start = asyncio.get_event_loop().time()
+        nret = 0
+        while True:
+            try:
+                return await query_function(*args)
+            except (KeyboardInterrupt, asyncio.CancelledError) as exc:
+                raise exc
+            except Exception as exc:
+                delay = self.retry_policy.delay(
+                    nret,
+                    exc,
+                    asyncio.get_event_loop().time() - start,
+                    idempotent,
+                )
+                if delay is None:
+                    raise exc
+                nret += 1
+                logger.log(5, "Retry %i in %f s after : %s", nret, delay, exc)
+                await asyncio.sleep(delay)
+
+    async def query(self, method_name, params):
+        """Send a RPC query and listen to its response"""
+        req_id = next(self.req_ids)
+        logger.log(5, "Sending RPC request method:%s with data:%s", method_name, params)
+        reqid, result = json_rpc_result(
+            await self.exchange(
+                [req_id], json_rpc_message(req_id, method_name, params)
+            )
+        )
+        logger.log(5, "Received RPC result: %s", result)
+        if reqid != req_id:
+            raise Exception("JSON RPC response id mismatch")
+        return result
+
+    async def query_batch(self, requests):
+        """Send a RPC batch and listen to its responses"""
+        request_objs = [
+            json_rpc_request(next(self.req_ids), method, params)
+            for method, params in requests
+        ]
+        request_ids = [request_obj["id"] for request_obj in request_objs]
+        logger.log(5, "Sending RPC batch of %i requests", len(request_objs))
+        return json_rpc_batch_results(
+            await self.exchange(request_ids, json_encode(request_objs)), request_ids
+        )
+
+    async def request(self, method_name, params=None, timeout=None):
+        """Send a RPC query and listen to response.
+        The query and its retries are cancelled after the timeout.
+        """
+        if params is None:
+            params = []
+        if timeout is None:
+            timeout = self.timeout
+        return await asyncio.wait_for(
+            self.with_retries(
+                self.query,
+                method_name,
+                params,
+                idempotent=is_idempotent([method_name]),
+            ),
+            timeout,
+        )
+
+    async def request_many(self, requests, batch_size=None):
+        """Send a list of (method_name, params) RPC queries in batches.
+        The batches are sent concurrently.
+        Return the list of the results, in the requests order.
+        A query in error gives a JSONRPCexception in place of its result.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        requests = list(requests)
+        chunks = [
+            requests[chunk_start : chunk_start + batch_size]
+            for chunk_start in range(0, len(requests), batch_size)
+        ]
+        chunks_results = await asyncio.gather(
+            *[
+                asyncio.wait_for(
+                    self.with_retries(
+                        self.query_batch,
+                        chunk,
+                        idempotent=is_idempotent(method for method, _ in chunk),
+                    ),
+                    self.timeout,
+                )
+                for chunk in chunks
+            ]
+        )
+        return [result for chunk in chunks_results for result in chunk]
+
+
+class AsyncWeb3Batch(Web3Batch):
+    """Queue Web3 queries, and send them in batches when leaving the async
+    context. Each method gives a BatchResult.
+    """
+
+    def __enter__(self):
+        raise TypeError("Use async with for an asyncio batch")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.send()
+
+    async def send(self):
+        """Send the queued queries and record their results."""
+        requests, self.requests = self.requests, []
+        results, self.results = self.results, []
+        raw_results = await self.jsonrpc.request_many(requests)
+        for result, raw_result in zip(results, raw_results):
+            result.set(raw_result)
+
+
+class AsyncWeb3Client(Web3Methods):
+    """Web3 RPC client for asyncio, the query methods of Web3Client as
+    coroutines.
+    Concurrent queries are sent on pooled HTTPS connections, or multiplexed
+    on the WebSocket.
+    """
+
+    def __init__(
+        self,
+        node_url,
+        user_agent=None,
+        retries=2,
+        batch_size=DEFAULT_BATCH_SIZE,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        timeout=None,
+        compression=True,
+        ssl_context=None,
+    ):
+        self.jsonrpc = AsyncJSONRPCclient(
+            node_url,
+            user_agent,
+            retries,
+            batch_size,
+            max_inflight,
+            timeout,
+            compression,
+            ssl_context,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Close the connections to the node."""
+        self.jsonrpc.close()
+
+    async def query(self, method_name, params=None, decoder=None, timeout=None):
+        """Send a RPC query, and decode its result with the decoder"""
+        result = await self.jsonrpc.request(method_name, params, timeout)
+        if decoder is None:
+            return result
+        return decoder(result)
+
+    async def request_many(self, requests):
+        """Send a list of (method_name, params) RPC queries in batches.
+        Return the list of the raw results, in the requests order.
+        A query in error gives a JSONRPCexception in place of its result.
+        """
+        return await self.jsonrpc.request_many(requests)
+
+    def batch(self):
+        """Open a batch of queries, to be used as an async context manager."""
+        return AsyncWeb3Batch(self)
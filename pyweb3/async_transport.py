@@ -0,0 +1,393 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : asyncio HTTP and WebSocket clients
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Asyncio HTTP and WebSocket clients, over asyncio streams"""
+
+
+import asyncio
+from logging import getLogger
+from ssl import create_default_context, SSLEOFError
+from urllib.parse import urlparse
+
+from h11 import NEED_DATA
+from wsproto import WSConnection, ConnectionType
+from wsproto.events import (
+    AcceptConnection,
+    RejectConnection,
+    CloseConnection,
+    Ping,
+    Message,
+    TextMessage,
+)
+
+from .http_client import (
+    DEFAULT_HTTPS_PORT,
+    HttpClientException,
+    HttpConnectionDropped,
+    HttpConnectionPool,
+    PooledConnection,
+    ResponseReader,
+    post_request,
+)
+from .json_codec import json_codec
+from .tls_socket import RECEIVING_BUFFER_SIZE
+from .websocket import (
+    DEFAULT_MAX_INFLIGHT,
+    GLOBAL_TIMEOUT,
+    WebSocketClientException,
+    handshake_request,
+    response_ids,
+)
+
+
+READ_TIMEOUT = 8  # seconds
+MAX_CONNECTIONS = 16  # concurrent HTTP connections per host
+
+
+logger = getLogger(__name__)
+
+
+async def open_tls_stream(domain, port, ssl_context):
+    """Open a TLS connection with a host domain:port, as asyncio streams."""
+    logger.log(5, "Connecting to Host: %s  Port: %s", domain, port)
+    return await asyncio.wait_for(
+        asyncio.open_connection(
+            domain, port, ssl=ssl_context, server_hostname=domain
+        ),
+        READ_TIMEOUT,
+    )
+
+
+class AsyncHttpConnection(PooledConnection):
+    """Keep-alive HTTP/1.1 connection : asyncio streams and their h11 state."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        super().__init__()
+
+    def close(self):
+        """Close the TLS stream."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def is_closed(self):
+        """Tell if the stream was closed, locally or by the remote party."""
+        return self.writer is None or self.reader.at_eof()
+
+    def is_dropped(self):
+        """Tell if an idle connection was closed by the remote party."""
+        return self.is_closed() or self.reader.exception() is not None
+
+
+class AsyncHttpConnectionPool(HttpConnectionPool):
+    """Bounded pool of idle keep-alive asyncio connections to a host."""
+
+    def __init__(self, domain, port, ssl_context):
+        super().__init__(domain, port)
+        self.ssl_context = ssl_context
+
+    async def open(self):
+        """Open a new connection to the host."""
+        try:
+            reader, writer = await open_tls_stream(
+                self.domain, self.port, self.ssl_context
+            )
+        except Exception as exc:
+            logger.error("Error during TLS connection : %s", str(exc), exc_info=exc)
+            raise HttpClientException(exc) from exc
+        return AsyncHttpConnection(reader, writer)
+
+    async def acquire(self):
+        """Get a warm connection from the pool, or open a new one.
+        Return the connection and if it is reused.
+        """
+        connection = self.take_idle()
+        if connection is not None:
+            return connection, True
+        return await self.open(), False
+
+
+class AsyncHttpClient:
+    """HTTP client with a host within TLS, over asyncio streams.
+    Concurrent requests are sent on distinct pooled connections.
+    """
+
+    def __init__(self, httpURL, ua, compression=True, ssl_context=None):
+        """Setup the HTTPS connections pool to a given a URL.
+        The TLS connections use the ssl_context, the default one when None.
+        """
+        http_url = urlparse(httpURL)
+        assert http_url.scheme == "https"
+        self.port_num = http_url.port or DEFAULT_HTTPS_PORT
+        self.domain = http_url.hostname
+        self.endpoint = http_url.path or "/"
+        self.user_agent = ua
+        self.compression = compression
+        if ssl_context is None:
+            ssl_context = create_default_context()
+        self.pool = AsyncHttpConnectionPool(self.domain, self.port_num, ssl_context)
+        self.slots = None
+
+    async def exchange(self, message):
+        """POST a message to the host, return the response body.
+        Wait for a free connection slot, when MAX_CONNECTIONS are in use.
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(MAX_CONNECTIONS)
+        async with self.slots:
+            return await self.exchange_on_pool(message)
+
+    def close(self):
+        """Close the idle connections."""
+        self.pool.clear()
+
+    async def exchange_on_pool(self, message):
+        """POST a message on a pooled connection, return the response body."""
+        connection, reused = await self.pool.acquire()
+        try:
+            return await self.post(connection, message)
+        except HttpConnectionDropped:
+            if not reused:
+                raise
+            logger.debug("Kept-alive connection dropped, reconnecting")
+            self.pool.clear()
+            return await self.post(await self.pool.open(), message)
+
+    async def post(self, connection, message):
+        """POST a message on the connection, and read the response body."""
+        reader = ResponseReader(connection.conn)
+        try:
+            request_parts = post_request(
+                connection.conn,
+                self.domain,
+                self.endpoint,
+                self.user_agent,
+                message,
+                self.compression,
+            )
+            if logger.isEnabledFor(5):
+                logger.log(5, "Sending HTTP POST data : %s", request_parts)
+            connection.writer.writelines(request_parts)
+            await connection.writer.drain()
+            while True:
+                body = reader.read_events()
+                if body is not NEED_DATA:
+                    self.pool.release(connection)
+                    return body
+                data = await asyncio.wait_for(
+                    connection.reader.read(RECEIVING_BUFFER_SIZE), READ_TIMEOUT
+                )
+                connection.conn.receive_data(data)
+        except asyncio.CancelledError:
+            # Request abandoned, the connection is left in an unknown state
+            connection.close()
+            raise
+        except Exception as exc:
+            dropped = not reader.started and (
+                connection.is_closed()
+                or isinstance(exc, (ConnectionError, SSLEOFError))
+            )
+            connection.close()
+            if dropped:
+                raise HttpConnectionDropped(exc) from exc
+            if isinstance(exc, HttpClientException):
+                raise
+            raise HttpClientException(exc) from exc
+
+
+class AsyncWebSocketClient:
+    """WebSocket client with a host within HTTPS, over asyncio streams.
+    A reader task dispatches the JSON-RPC responses to their waiting
+    requests, so many requests can be in flight at once.
+    """
+
+    def __init__(
+        self,
+        wsURL,
+        user_agent,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        compression=True,
+        ssl_context=None,
+    ):
+        """Setup the WebSocket client to a given a URL, see connect.
+        The TLS connection uses the ssl_context, the default one when None.
+        """
+        self.ws_url = urlparse(wsURL)
+        assert self.ws_url.scheme == "wss"
+        self.user_agent = user_agent
+        self.max_inflight = max_inflight
+        self.compression = compression
+        if ssl_context is None:
+            ssl_context = create_default_context()
+        self.ssl_context = ssl_context
+        self.reader = None
+        self.writer = None
+        self.websock_conn = None
+        self.established = False
+        self.partial_messages = []
+        self.pending = {}
+        self.inflight = None
+        self.reader_task = None
+
+    async def connect(self):
+        """Open the WebSocket connection, and start the reader task."""
+        port_num = self.ws_url.port or DEFAULT_HTTPS_PORT
+        try:
+            self.reader, self.writer = await open_tls_stream(
+                self.ws_url.hostname, port_num, self.ssl_context
+            )
+            self.websock_conn = WSConnection(ConnectionType.CLIENT)
+            self.established = False
+            self.send(
+                handshake_request(self.ws_url, self.user_agent, self.compression)
+            )
+            await asyncio.wait_for(self.handshake(), GLOBAL_TIMEOUT)
+        except Exception as exc:
+            logger.error(
+                "Error during WebSocket connection : %s", str(exc), exc_info=exc
+            )
+            self.close()
+            raise WebSocketClientException(exc) from exc
+        self.inflight = asyncio.Semaphore(self.max_inflight)
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+
+    async def handshake(self):
+        """Wait for the server to accept the WebSocket connection."""
+        while not self.established:
+            datarcv = await self.reader.read(RECEIVING_BUFFER_SIZE)
+            if not datarcv:
+                raise WebSocketClientException("Socket was closed by remote party")
+            self.websock_conn.receive_data(datarcv)
+            self.process_events()
+
+    def close(self):
+        """Stop the reader task and close the TLS connection."""
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            self.reader_task = None
+        if self.writer is not None:
+            logger.debug("Closing WebSocket")
+            self.writer.close()
+            self.writer = None
+
+    def is_closed(self):
+        """Tell if the connection is closed."""
+        return self.writer is None
+
+    def send(self, data_frame):
+        """Send a WebSocket data frame to the host."""
+        if self.writer is None:
+            raise WebSocketClientException("WebSocket connection is closed")
+        self.writer.write(self.websock_conn.send(data_frame))
+
+    def process_events(self):
+        """Decode the WebSocket events of the received data."""
+        for event in self.websock_conn.events():
+            if isinstance(event, AcceptConnection):
+                logger.debug("WebSocket connection established.")
+                self.established = True
+            elif isinstance(event, RejectConnection):
+                raise WebSocketClientException("WebSocket handshake rejected")
+            elif isinstance(event, CloseConnection):
+                logger.error(
+                    "WebSocket Connection closed: code=%i reason=%s",
+                    event.code,
+                    event.reason,
+                )
+                self.close()
+                return
+            elif isinstance(event, Ping):
+                logger.debug("Ping received in WebSocket")
+                self.send(event.response())
+            elif isinstance(event, Message):
+                self.partial_messages.append(event.data)
+                if event.message_finished:
+                    if isinstance(event, TextMessage):
+                        full_message = "".join(self.partial_messages)
+                    else:
+                        full_message = b"".join(self.partial_messages)
+                    self.partial_messages = []
+                    if logger.isEnabledFor(5):
+                        logger.log(5, "WebSocket message received : %s", full_message)
+                    self.dispatch(full_message)
+
+    async def read_loop(self):
+        """Reader task : read the WebSocket and dispatch the messages."""
+        try:
+            while self.writer is not None:
+                datarcv = await self.reader.read(RECEIVING_BUFFER_SIZE)
+                if not datarcv:
+                    logger.debug("Socket was closed by remote party")
+                    break
+                self.websock_conn.receive_data(datarcv)
+                self.process_events()
+        except asyncio.CancelledError:
+            pass
+        except Exception as exc:
+            logger.error("Error in WebSocket reader : %s", str(exc), exc_info=exc)
+        finally:
+            self.reader_task = None
+            self.close()
+            self.fail_pending(WebSocketClientException("WebSocket connection closed"))
+
+    def dispatch(self, message):
+        """Give a received JSON-RPC response to its waiting request."""
+        try:
+            resp_obj = json_codec.loads(message)
+        except Exception:
+            logger.error("Not JSON message received : %s", message)
+            return
+        for resp_id in response_ids(resp_obj):
+            if resp_id in self.pending:
+                future, request_ids = self.pending[resp_id]
+                for req_id in request_ids:
+                    del self.pending[req_id]
+                if not future.done():
+                    future.set_result(resp_obj)
+                return
+        logger.debug("Message received without pending request : %s", message)
+
+    def fail_pending(self, exc):
+        """Give an error to all the requests waiting a response."""
+        futures = [future for future, _ in self.pending.values()]
+        self.pending.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+
+    async def exchange(self, request_ids, data_message, timeout=GLOBAL_TIMEOUT):
+        """Send a JSON-RPC request (or batch) and wait for its response.
+        Return the decoded response object.
+        A cancelled request is abandoned, its response will be ignored.
+        """
+        async with self.inflight:
+            future = asyncio.get_event_loop().create_future()
+            for req_id in request_ids:
+                self.pending[req_id] = (future, request_ids)
+            try:
+                if logger.isEnabledFor(5):
+                    logger.log(5, "Sending message : %s", data_message)
+                self.send(Message(data_message))
+                await self.writer.drain()
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError as exc:
+                raise WebSocketClientException("WebSocket response timeout") from exc
+            finally:
+                for req_id in request_ids:
+                    if self.pending.get(req_id, (None,))[0] is future:
+                        del self.pending[req_id]
@@ -0,0 +1,217 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : responses cache
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Block-aware cache of the RPC results for pyWeb3"""
+
+
+from collections import OrderedDict
+from json import dumps
+from logging import getLogger
+from threading import Lock
+from time import monotonic
+
+from .json_codec import json_codec
+
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_TTL = 2  # seconds, for the latest and pending states
+
+# Position of the block parameter, for the methods with a per-block result
+BLOCK_PARAM_METHODS = {
+    "eth_call": 1,
+    "eth_estimateGas": 1,
+    "eth_getBalance": 1,
+    "eth_getCode": 1,
+    "eth_getStorageAt": 2,
+    "eth_getTransactionCount": 1,
+    "eth_getBlockByNumber": 0,
+    "eth_getBlockTransactionCountByNumber": 0,
+    "eth_getTransactionByBlockNumberAndIndex": 0,
+    "eth_getUncleCountByBlockNumber": 0,
+}
+
+# Methods with a result which never changes, once it is available
+IMMUTABLE_METHODS = (
+    "eth_chainId",
+    "net_version",
+    "eth_getBlockByHash",
+    "eth_getBlockTransactionCountByHash",
+    "eth_getTransactionByBlockHashAndIndex",
+    "eth_getTransactionByHash",
+    "eth_getTransactionReceipt",
+)
+
+# Methods with a result only valid for the current block
+SHORT_LIVED_METHODS = (
+    "eth_blockNumber",
+    "eth_gasPrice",
+    "eth_maxPriorityFeePerGas",
+)
+
+# Block tags which state follows the chain head
+MOVING_BLOCK_TAGS = ("latest", "pending", "safe", "finalized")
+
+# Cache lifetime of a result which never changes
+FOREVER = None
+
+
+logger = getLogger(__name__)
+
+
+def canonical_params(params):
+    """Normalize the parameters : hex strings lower case, sorted keys."""
+    if isinstance(params, str):
+        if params[:2] in ("0x", "0X"):
+            return params.lower()
+        return params
+    if isinstance(params, (list, tuple)):
+        return [canonical_params(param) for param in params]
+    if isinstance(params, dict):
+        return {key: canonical_params(value) for key, value in params.items()}
+    return params
+
+
+def is_fixed_block(block_param):
+    """Tell if a block parameter points to a fixed block."""
+    if isinstance(block_param, dict):
+        # EIP-1898 block reference
+        return "blockHash" in block_param or "blockNumber" in block_param
+    return block_param not in MOVING_BLOCK_TAGS
+
+
+def is_final_result(method_name, result):
+    """Tell if the result of an immutable method is available for good."""
+    if method_name == "eth_getTransactionByHash":
+        return result.get("blockNumber") is not None
+    return True
+
+
+class ResponseCache:
+    """LRU cache of the RPC results, within a budget of bytes.
+    The results for a fixed block, and the immutable items such as
+    receipts, are kept until evicted. The results for the latest and
+    pending states are kept ttl seconds, or until a new block when the
+    cache follows the new heads.
+    The lists and dicts results are kept encoded, each read gives a new
+    copy : a caller can change the result it got.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def stats(self):
+        """Give the cache counters."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+    def make_key(self, method_name, params):
+        """Give the cache key of a query, None when it is not cacheable."""
+        if (
+            method_name not in BLOCK_PARAM_METHODS
+            and method_name not in IMMUTABLE_METHODS
+            and method_name not in SHORT_LIVED_METHODS
+        ):
+            return None
+        params = canonical_params(params)
+        block_position = BLOCK_PARAM_METHODS.get(method_name)
+        if block_position is not None and len(params) <= block_position:
+            # Default state is latest
+            params = params + ["latest"]
+        return method_name + dumps(params, sort_keys=True, separators=(",", ":"))
+
+    def lifetime(self, method_name, params):
+        """Give how long a query result can be kept : FOREVER or seconds."""
+        if method_name in IMMUTABLE_METHODS:
+            return FOREVER
+        block_position = BLOCK_PARAM_METHODS.get(method_name)
+        if block_position is not None and len(params) > block_position:
+            if is_fixed_block(params[block_position]):
+                return FOREVER
+        return self.ttl
+
+    def get(self, key):
+        """Look for a result in the cache. Return (found, result)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                result, _, expiry = entry
+                if expiry is None or expiry > monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    if isinstance(result, bytes):
+                        result = json_codec.loads(result)
+                    return True, result
+                self.remove(key)
+            self.misses += 1
+        return False, None
+
+    def put(self, key, method_name, params, result):
+        """Record a query result, if it can be cached."""
+        if result is None:
+            # Not available yet, such as a block or a transaction not mined
+            return
+        if method_name in IMMUTABLE_METHODS and not is_final_result(
+            method_name, result
+        ):
+            return
+        lifetime = self.lifetime(method_name, params)
+        expiry = None if lifetime is FOREVER else monotonic() + lifetime
+        encoded = json_codec.dumps(result)
+        size = len(key) + len(encoded)
+        if size > self.max_bytes:
+            return
+        if isinstance(result, (list, dict)):
+            # A JSON result is never bytes, the encoded result is decoded
+            # when read
+            result = encoded
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (result, size, expiry)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        """Remove an entry, with the lock held."""
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def invalidate_latest(self, new_head=None):
+        """Remove the results for the latest state, at a new block."""
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[2]]:
+                self.remove(key)
+        logger.log(5, "Cache invalidated at new block")
+
+    def clear(self):
+        """Remove all the entries."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -0,0 +1,163 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : requests coalescing
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Coalescing of concurrent requests for pyWeb3"""
+
+
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from logging import getLogger
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from .json_codec import json_codec
+
+
+logger = getLogger(__name__)
+
+
+def wait_result(future, deadline=None):
+    """Wait for the result of a future, until the deadline."""
+    timeout = None
+    if deadline is not None:
+        timeout = max(deadline - monotonic(), 0)
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError as exc:
+        if future.done():
+            raise
+        raise FutureTimeoutError("No response before the deadline") from exc
+
+
+class SingleFlight:
+    """Run a single call at once for a given key.
+    The concurrent calls with the same key wait for the running one,
+    and get its result or its error. Each gets its own copy of a list or
+    dict result.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = Lock()
+        self.coalesced = 0
+
+    def call(self, key, deadline, function, *args, **kwargs):
+        """Run function, or wait for the one running for this key, until
+        the deadline.
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                future.followers = 0
+                self.calls[key] = future
+            else:
+                future.followers += 1
+                self.coalesced += 1
+        if not leader:
+            logger.log(5, "Waiting for the same request in flight : %s", key)
+            result = wait_result(future, deadline)
+            if isinstance(result, bytes):
+                result = json_codec.loads(result)
+            return result
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as exc:
+            self.finish(key)
+            future.set_exception(exc)
+            raise
+        if self.finish(key) and isinstance(result, (list, dict)):
+            # A JSON result is never bytes, the encoded result is decoded
+            # by each follower
+            future.set_result(json_codec.dumps(result))
+        else:
+            future.set_result(result)
+        return result
+
+    def finish(self, key):
+        """Remove a completed call, the next ones will run again.
+        Return the number of calls waiting for it.
+        """
+        with self.lock:
+            return self.calls.pop(key).followers
+
+
+class MicroBatcher:
+    """Gather the concurrent requests in a JSON-RPC batch.
+    The first request opens a window, and sends the batch of all the
+    requests received during the window, or as soon as it is full.
+    The batch is sent in a thread, until the latest deadline of its
+    requests, and each requester waits for its result until its deadline.
+    """
+
+    def __init__(self, send_batch, window, max_size):
+        self.send_batch = send_batch
+        self.window = window
+        self.max_size = max_size
+        self.queue = None
+        self.lock = Lock()
+
+    def request(self, method_name, params, deadline=None):
+        """Send a request within a batch, and give its result when it is
+        received before the deadline.
+        """
+        future = Future()
+        with self.lock:
+            batch = self.queue
+            leader = batch is None
+            if leader:
+                batch = []
+                self.queue = batch
+            batch.append((method_name, params, future, deadline))
+            full = len(batch) >= self.max_size
+            if full:
+                self.queue = None
+        if full:
+            self.start_send(batch)
+        elif leader:
+            sleep(self.window)
+            with self.lock:
+                # Else it was full, and sent by the last requester
+                send = self.queue is batch
+                if send:
+                    self.queue = None
+            if send:
+                self.start_send(batch)
+        return wait_result(future, deadline)
+
+    def start_send(self, batch):
+        """Send a batch in a thread."""
+        Thread(target=self.send, args=(batch,), daemon=True).start()
+
+    def send(self, batch):
+        """Send a batch, and give each result to its requester."""
+        logger.log(5, "Sending a batch of %i gathered requests", len(batch))
+        deadlines = [deadline for _, _, _, deadline in batch]
+        batch_deadline = None if None in deadlines else max(deadlines)
+        try:
+            results = self.send_batch(
+                [(method, params) for method, params, _, _ in batch],
+                deadline=batch_deadline,
+            )
+        except BaseException as exc:
+            for _, _, future, _ in batch:
+                future.set_exception(exc)
+            return
+        for (_, _, future, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,184 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : nodes endpoints
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Nodes endpoints health and selection for pyWeb3"""
+
+
+from logging import getLogger
+from threading import Lock
+from time import monotonic
+
+from .http_client import HttpClient
+from .websocket import WebSocketClient
+
+
+EWMA_WEIGHT = 0.3  # weight of the last measure in the averages
+ERROR_PENALTY = 10  # latency multiplier for an endpoint always in error
+
+# Circuit breaker
+FAILURES_TO_EJECT = 3  # consecutive failures
+EJECTION_TIME = 5  # seconds, doubled at each failed probe
+MAX_EJECTION_TIME = 300  # seconds
+PROBE_TIMEOUT = 30  # seconds, a probe without outcome then is given up
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+logger = getLogger(__name__)
+
+
+class Endpoint:
+    """A node endpoint : its connection, and its latency and errors
+    statistics. A circuit breaker ejects the endpoint after consecutive
+    failures, and probes it again with a single request after a while.
+    When the probe outcome is not known after PROBE_TIMEOUT, the endpoint
+    is probed again.
+    """
+
+    def __init__(
+        self,
+        url,
+        user_agent,
+        max_inflight,
+        connector,
+        pool_size=None,
+        compression=True,
+    ):
+        if not url.startswith(("wss:", "https:")):
+            raise Exception("Only accept HTTPS and WebSocket connection scheme")
+        self.url = url
+        self.user_agent = user_agent
+        self.max_inflight = max_inflight
+        self.connector = connector
+        self.pool_size = pool_size
+        self.compression = compression
+        self.multiplexed = url.startswith("wss:")
+        self.cnx = None
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.state = CLOSED
+        self.ejected_until = 0
+        self.ejection_time = EJECTION_TIME
+        self.lock = Lock()
+        self.connect_lock = Lock()
+
+    def connect(self):
+        """Give the connection, opened at first use or after it was closed."""
+        with self.connect_lock:
+            if self.cnx is None or (self.multiplexed and self.cnx.is_closed()):
+                if self.multiplexed:
+                    self.cnx = WebSocketClient(
+                        self.url,
+                        self.user_agent,
+                        self.max_inflight,
+                        self.connector,
+                        self.compression,
+                    )
+                else:
+                    self.cnx = HttpClient(
+                        self.url,
+                        self.user_agent,
+                        self.connector,
+                        self.pool_size,
+                        self.compression,
+                    )
+            return self.cnx
+
+    def close(self):
+        """Close the connection."""
+        if self.cnx is not None:
+            self.cnx.close()
+
+    def is_available(self, now):
+        """Tell if the endpoint can be used : not ejected, or to be probed."""
+        if self.state == CLOSED:
+            return True
+        return now >= self.ejected_until
+
+    def score(self):
+        """Expected latency, penalized by the errors. Lower is better."""
+        if self.latency is None:
+            # Not used yet, try it
+            return 0
+        return self.latency * (1 + ERROR_PENALTY * self.error_rate)
+
+    def start_request(self, now):
+        """Record a request is sent, the probe when the endpoint is ejected."""
+        with self.lock:
+            if self.state != CLOSED and now >= self.ejected_until:
+                logger.debug("Probing endpoint %s", self.url)
+                self.state = HALF_OPEN
+                # Until the probe deadline
+                self.ejected_until = now + PROBE_TIMEOUT
+
+    def record_success(self, duration):
+        """Record a successful exchange, and its duration."""
+        with self.lock:
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += EWMA_WEIGHT * (duration - self.latency)
+            self.error_rate -= EWMA_WEIGHT * self.error_rate
+            self.failures = 0
+            if self.state != CLOSED:
+                logger.debug("Endpoint %s is back", self.url)
+                self.state = CLOSED
+                self.ejection_time = EJECTION_TIME
+
+    def record_failure(self):
+        """Record a failed exchange, eject the endpoint when failing."""
+        with self.lock:
+            self.error_rate += EWMA_WEIGHT * (1 - self.error_rate)
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.ejection_time = min(self.ejection_time * 2, MAX_EJECTION_TIME)
+            elif self.failures < FAILURES_TO_EJECT and self.latency is not None:
+                # An endpoint which never succeeded is ejected at once
+                return
+            logger.debug("Ejecting endpoint %s for %i s", self.url, self.ejection_time)
+            self.state = OPEN
+            self.ejected_until = monotonic() + self.ejection_time
+
+    def status(self):
+        """Give the endpoint statistics."""
+        return {
+            "url": self.url,
+            "state": self.state,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+        }
+
+
+def best_endpoint(endpoints, now):
+    """Give the best available endpoint, without changing its state.
+    When all are ejected, the one to be probed first.
+    """
+    available = [endpoint for endpoint in endpoints if endpoint.is_available(now)]
+    if available:
+        return min(available, key=Endpoint.score)
+    return min(endpoints, key=lambda endpoint: endpoint.ejected_until)
+
+
+def select_endpoint(endpoints):
+    """Choose the best available endpoint, and record a request is sent."""
+    now = monotonic()
+    endpoint = best_endpoint(endpoints, now)
+    endpoint.start_request(now)
+    return endpoint
@@ -0,0 +1,142 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : hedged requests
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Hedged requests against the tail latency for pyWeb3"""
+
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Event, Lock
+from time import monotonic
+
+
+LATENCY_SAMPLES = 200  # recent durations kept, to compute the percentile
+MIN_SAMPLES = 20  # before, the hedging delay is DEFAULT_HEDGE_DELAY
+HEDGE_PERCENTILE = 0.95
+DEFAULT_HEDGE_DELAY = 1  # seconds
+MIN_HEDGE_DELAY = 0.005  # seconds
+HEDGE_WORKERS = 32
+
+# Result of a hedge not sent, the request was done before
+NOT_SENT = object()
+
+
+logger = getLogger(__name__)
+
+
+class LatencyTracker:
+    """Recent durations of the requests, to give their percentile."""
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.durations = deque(maxlen=samples)
+        self.lock = Lock()
+
+    def record(self, duration):
+        """Record the duration of a request."""
+        with self.lock:
+            self.durations.append(duration)
+
+    def percentile(self, fraction):
+        """Give the duration percentile, None without enough samples."""
+        with self.lock:
+            if len(self.durations) < MIN_SAMPLES:
+                return None
+            durations = sorted(self.durations)
+        return durations[min(int(fraction * len(durations)), len(durations) - 1)]
+
+
+class RequestHedger:
+    """Send a duplicate of a slow read request, and use the first response.
+    The request runs in the calling thread. The duplicate is sent in the
+    hedging threads when the request is still waiting after the 95th
+    percentile of the recent requests durations.
+    """
+
+    def __init__(self, workers=HEDGE_WORKERS):
+        self.latencies = LatencyTracker()
+        self.workers = workers
+        self.executor = None
+        self.lock = Lock()
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def delay(self):
+        """Give how long to wait for the response, before hedging."""
+        delay = self.latencies.percentile(HEDGE_PERCENTILE)
+        if delay is None:
+            return DEFAULT_HEDGE_DELAY
+        return max(delay, MIN_HEDGE_DELAY)
+
+    def submit(self, function, *args):
+        """Run a function in the hedging threads."""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="HedgedRequest"
+                )
+        return self.executor.submit(function, *args)
+
+    def hedge_after(self, done, hedge_time, hedge, deadline):
+        """Call hedge(deadline) at hedge_time, unless the request is done.
+        Return NOT_SENT when it was done before.
+        """
+        if done.wait(max(hedge_time - monotonic(), 0)):
+            return NOT_SENT
+        logger.log(5, "Request slower than the hedging delay, hedging")
+        with self.lock:
+            self.hedged += 1
+        return hedge(deadline)
+
+    def run(self, primary, hedge, deadline=None):
+        """Call primary(deadline), and hedge(deadline) when primary is slow.
+        Return the primary result, or the hedge one when primary failed.
+        Raise when both failed.
+        """
+        start = monotonic()
+        hedge_time = start + self.delay()
+        if hedge is None or (deadline is not None and hedge_time >= deadline):
+            second = None
+        else:
+            done = Event()
+            second = self.submit(self.hedge_after, done, hedge_time, hedge, deadline)
+        try:
+            result = primary(deadline)
+        except Exception:
+            if second is None:
+                raise
+            done.set()
+            if second.cancel() or second.exception() is not None:
+                raise
+            result = second.result()
+            if result is NOT_SENT:
+                raise
+            with self.lock:
+                self.hedge_wins += 1
+            return result
+        if second is not None:
+            done.set()
+        self.latencies.record(monotonic() - start)
+        return result
+
+    def stats(self):
+        """Give the hedging counters."""
+        return {"hedged": self.hedged, "hedge_wins": self.hedge_wins}
+
+    def close(self):
+        """Stop the hedging threads."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -1,132 +1,548 @@
-# -*- coding: utf8 -*-
-
-# pyWeb3 : HTTP client
-# Copyright (C) 2021-2022 BitLogiK
-
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, version 3 of the License.
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-# You should have receive a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>
-
-
-"""WebSocket client"""
-
-
-from logging import getLogger
-from urllib.parse import urlparse
-
-from h11 import (
-    Connection,
-    Request,
-    Response,
-    Data,
-    EndOfMessage,
-    ConnectionClosed,
-    NEED_DATA,
-    CLIENT,
-)
-
-from .tls_socket import TLSsocket
-
-
-DEFAULT_HTTPS_PORT = 443
-
-
-logger = getLogger(__name__)
-
-
-class HttpClientException(Exception):
-    """Exception from the WebSocket client."""
-
-
-class HttpClient:
-    """HTTP client with a host within TLS, send and decode messages."""
-
-    def __init__(self, httpURL, ua):
-        """Open the HTTPS connection to a given a URL."""
-        http_url = urlparse(httpURL)
-        assert http_url.scheme == "https"
-        self.conn = None
-        self.ssocket = None
-        self.received_messages = []
-        self.partial_messages = []
-        self.port_num = http_url.port or DEFAULT_HTTPS_PORT
-        self.domain = http_url.hostname
-        self.endpoint = http_url.path or "/"
-        self.user_agent = ua
-
-    def close(self):
-        """Close the TLS connection when deleting the object."""
-        if self.ssocket is not None:
-            logger.log(5, "Closing TLS")
-            self.ssocket.close()
-            self.ssocket = None
-
-    def send_message(self, message):
-        """Send a message to the host, POST data message"""
-        try:
-            logger.log(
-                5,
-                "Connecting to HTTPS Host: %s  Port: %s",
-                self.domain,
-                self.port_num,
-            )
-            self.ssocket = TLSsocket(self.domain, self.port_num)
-            logger.log(
-                5,
-                "Connected to HTTPS Host=%s PathTarget=%s",
-                self.domain,
-                self.endpoint,
-            )
-        except Exception as exc:
-            logger.error("Error during TLS connection : %s", str(exc), exc_info=exc)
-            raise HttpClientException(exc) from exc
-        self.conn = Connection(our_role=CLIENT)
-        raw_message = self.conn.send(
-            Request(
-                method=b"POST",
-                target=self.endpoint,
-                headers=[
-                    ("Host", self.domain),
-                    ("User-Agent", self.user_agent),
-                    ("Connection", "close"),
-                    ("Content-Type", "application/json"),
-                    ("Content-Length", str(len(message))),
-                ],
-            )
-        )
-        raw_message += self.conn.send(Data(data=message))
-        raw_message += self.conn.send(EndOfMessage())
-        logger.log(5, "Sending HTTP POST data : %s", raw_message)
-        self.ssocket.send(raw_message)
-
-    def get_messages(self):
-        """Read data from server"""
-        if self.ssocket.conn is None:
-            self.close()
-            logger.debug("Socket was closed by remote party")
-            return
-        # Listen to server data
-        while True:
-            event = self.conn.next_event()
-            if isinstance(event, EndOfMessage):
-                self.conn.send(ConnectionClosed())
-                self.close()
-                self.received_messages.append(b"".join(self.partial_messages))
-                return
-            if event is NEED_DATA:
-                self.conn.receive_data(self.ssocket.receive())
-            if isinstance(event, Response):
-                self.partial_messages = []
-                if event.status_code != 200:
-                    raise HttpClientException(
-                        f"Error in response code {event.status_code}"
-                    )
-            if isinstance(event, Data):
-                logger.log(5, "Data received from HTTP query : %s", event.data)
-                self.partial_messages.append(event.data)
+# -*- coding: utf8 -*-
+
+# pyWeb3 : HTTP client
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""WebSocket client"""
+
+
+from email.utils import parsedate_to_datetime
+from logging import getLogger
+from selectors import DefaultSelector, EVENT_READ
+from ssl import SSLEOFError
+from threading import BoundedSemaphore, Lock, local
+from time import monotonic, time
+from urllib.parse import urlparse
+from zlib import decompressobj, MAX_WBITS
+
+from h11 import (
+    Connection,
+    Request,
+    Response,
+    Data,
+    EndOfMessage,
+    ConnectionClosed,
+    NEED_DATA,
+    CLIENT,
+    DONE,
+)
+
+from .instrumentation import (
+    instrumentation,
+    PHASE_FIRST_BYTE,
+    PHASE_SEND,
+    POOL_IN_USE,
+    POOL_OPENED,
+    POOL_REUSED,
+)
+from .tls_socket import Connector, TLSsocket
+
+
+DEFAULT_HTTPS_PORT = 443
+
+# Keep-alive pool limits
+POOL_MAX_IDLE = 4  # idle sockets kept per host
+POOL_IDLE_TIMEOUT = 30  # seconds
+POOL_MAX_AGE = 300  # seconds
+POOL_MAX_REQUESTS = 100  # requests per socket
+
+# Compressed responses accepted, decoded as they are received
+ACCEPT_ENCODING = "gzip, deflate"
+# zlib window bits, to decode gzip and zlib (deflate) headers
+AUTO_HEADER_WBITS = 32 + MAX_WBITS
+
+
+logger = getLogger(__name__)
+
+
+class HttpClientException(Exception):
+    """Exception from the WebSocket client."""
+
+
+class HttpConnectionDropped(HttpClientException):
+    """The server closed the connection before sending any response."""
+
+
+class HttpResponseError(HttpClientException):
+    """The server replied with an error status code."""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class HttpRateLimited(HttpResponseError):
+    """The server throttled the request, with a 429 response."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message, 429)
+        self.retry_after = retry_after
+
+
+def retry_after_delay(headers):
+    """Read the Retry-After header of a response : seconds, or None."""
+    for name, value in headers:
+        if name == b"retry-after":
+            value = value.decode("ascii", "replace").strip()
+            if value.isdigit():
+                return int(value)
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def content_decoder(headers):
+    """Give a streaming decoder for the Content-Encoding of a response,
+    or None when its body is not compressed.
+    """
+    for name, value in headers:
+        if name == b"content-encoding":
+            encoding = value.strip().lower()
+            if encoding in (b"gzip", b"x-gzip", b"deflate"):
+                return decompressobj(AUTO_HEADER_WBITS)
+            if encoding != b"identity":
+                raise HttpClientException(f"Unsupported content encoding {encoding}")
+    return None
+
+
+def post_request(conn, host, target, user_agent, message, compression=False):
+    """Build the raw POST request of a message, with a h11 connection.
+    Return its parts, the message is not copied.
+    With compression, the response can be compressed.
+    """
+    headers = [
+        ("Host", host),
+        ("User-Agent", user_agent),
+        ("Content-Type", "application/json"),
+        ("Content-Length", str(len(message))),
+    ]
+    if compression:
+        headers.append(("Accept-Encoding", ACCEPT_ENCODING))
+    request_head = conn.send(Request(method=b"POST", target=target, headers=headers))
+    return (
+        [request_head]
+        + conn.send_with_data_passthrough(Data(data=message))
+        + [conn.send(EndOfMessage())]
+    )
+
+
+class ResponseReader:
+    """Read an HTTP response from the events of a h11 connection.
+    A compressed body is decoded as it is received.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.started = False
+        self.partial_messages = []
+        self.decoder = None
+
+    def read_events(self):
+        """Process the received data.
+        Return the body when the response is complete, else NEED_DATA.
+        """
+        if self.process_events():
+            return b"".join(self.partial_messages)
+        return NEED_DATA
+
+    def take_data(self):
+        """Give the body data received since the last call."""
+        data = self.partial_messages
+        self.partial_messages = []
+        return data
+
+    def process_events(self):
+        """Process the received data, tell if the response is complete."""
+        while True:
+            event = self.conn.next_event()
+            if event is NEED_DATA:
+                return False
+            if isinstance(event, EndOfMessage):
+                if self.decoder is not None:
+                    self.partial_messages.append(self.decoder.flush())
+                return True
+            if isinstance(event, ConnectionClosed):
+                raise HttpClientException("Connection closed by remote party")
+            if isinstance(event, Response):
+                self.started = True
+                if event.status_code == 429:
+                    raise HttpRateLimited(
+                        "Too many requests", retry_after_delay(event.headers)
+                    )
+                if event.status_code != 200:
+                    raise HttpResponseError(
+                        f"Error in response code {event.status_code}",
+                        event.status_code,
+                    )
+                self.decoder = content_decoder(event.headers)
+            if isinstance(event, Data):
+                data = event.data
+                if self.decoder is not None:
+                    data = self.decoder.decompress(data)
+                if logger.isEnabledFor(5):
+                    logger.log(5, "Data received from HTTP query : %s", data)
+                self.partial_messages.append(data)
+
+
+class PooledConnection:
+    """Keep-alive HTTP/1.1 connection state, for the pool.
+    A subclass holds the underlying connection, and defines :
+    close() to close it, is_closed() to tell if it was closed, locally or
+    by the remote party, and is_dropped() to tell if it was closed by the
+    remote party while idle.
+    """
+
+    def __init__(self):
+        self.conn = Connection(our_role=CLIENT)
+        self.created = monotonic()
+        self.last_used = self.created
+        self.requests_count = 0
+
+    def is_reusable(self):
+        """Tell if the last request/response cycle ended cleanly in keep-alive."""
+        return (
+            not self.is_closed()
+            and self.conn.our_state is DONE
+            and self.conn.their_state is DONE
+        )
+
+    def is_expired(self, now, idle_timeout, max_age, max_requests):
+        """Tell if the connection reached one of the pool limits."""
+        return (
+            now - self.last_used > idle_timeout
+            or now - self.created > max_age
+            or self.requests_count >= max_requests
+        )
+
+
+class HttpConnection(PooledConnection):
+    """Keep-alive HTTP/1.1 connection : a TLS socket and its h11 state."""
+
+    def __init__(self, domain, port, deadline=None, connector=None):
+        """Open a new TLS connection to the host."""
+        self.ssocket = TLSsocket(domain, port, deadline, connector)
+        super().__init__()
+
+    def close(self):
+        """Close the TLS socket."""
+        if self.ssocket is not None:
+            self.ssocket.close()
+            self.ssocket = None
+
+    def is_closed(self):
+        """Tell if the socket was closed, locally or by the remote party."""
+        return self.ssocket is None or self.ssocket.conn is None
+
+    def is_dropped(self):
+        """Detect a socket half-closed by the server while idle.
+        An idle keep-alive socket has nothing to read : if it is readable,
+        this is the EOF (or unexpected data), and it can't be used anymore.
+        """
+        if self.is_closed():
+            return True
+        if self.ssocket.conn.pending():
+            return True
+        try:
+            with DefaultSelector() as selector:
+                selector.register(self.ssocket.conn, EVENT_READ)
+                return bool(selector.select(0))
+        except (OSError, ValueError):
+            return True
+
+
+class HttpConnectionPool:
+    """Bounded pool of idle keep-alive connections to a host.
+    With max_connections, at most this number of connections are in use at
+    once, the other requests wait for a free one.
+    """
+
+    def __init__(
+        self,
+        domain,
+        port,
+        max_idle=POOL_MAX_IDLE,
+        idle_timeout=POOL_IDLE_TIMEOUT,
+        max_age=POOL_MAX_AGE,
+        max_requests=POOL_MAX_REQUESTS,
+        connector=None,
+        max_connections=None,
+    ):
+        self.domain = domain
+        self.port = port
+        self.slots = None
+        if max_connections is not None:
+            self.slots = BoundedSemaphore(max_connections)
+            # Keep a connection for each
+            max_idle = max_connections
+        self.connector = connector
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.max_requests = max_requests
+        self.idle_connections = []
+        self.lock = Lock()
+        self.in_use = 0
+
+    def take_slot(self, deadline=None):
+        """Wait for a connection slot, until the deadline."""
+        if self.slots is not None:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - monotonic(), 0)
+            if not self.slots.acquire(timeout=timeout):
+                raise HttpClientException("No free connection before the deadline")
+        self.count_in_use(1)
+
+    def free_slot(self):
+        """Give back a connection slot."""
+        self.count_in_use(-1)
+        if self.slots is not None:
+            self.slots.release()
+
+    def count_in_use(self, change):
+        """Update the number of connections in use."""
+        with self.lock:
+            self.in_use += change
+            in_use = self.in_use
+        if instrumentation.enabled:
+            instrumentation.gauge(POOL_IN_USE, in_use, f"{self.domain}:{self.port}")
+
+    def take_idle(self):
+        """Get a warm connection from the pool, None if there is none."""
+        now = monotonic()
+        while True:
+            with self.lock:
+                if not self.idle_connections:
+                    return None
+                connection = self.idle_connections.pop()
+            if connection.is_expired(
+                now, self.idle_timeout, self.max_age, self.max_requests
+            ):
+                logger.log(5, "Closing expired pooled connection")
+                connection.close()
+            elif connection.is_dropped():
+                logger.log(5, "Pooled connection was closed by remote party")
+                connection.close()
+            else:
+                logger.log(5, "Reusing pooled connection")
+                return connection
+
+    def acquire(self, deadline=None):
+        """Get a warm connection from the pool, or open a new one.
+        Return the connection and if it is reused.
+        """
+        connection = self.take_idle()
+        if connection is not None:
+            return connection, True
+        logger.log(
+            5,
+            "Connecting to HTTPS Host: %s  Port: %s",
+            self.domain,
+            self.port,
+        )
+        return (
+            HttpConnection(self.domain, self.port, deadline, self.connector),
+            False,
+        )
+
+    def release(self, connection):
+        """Give back a connection after a complete response.
+        Keep it idle for a next request, or close it.
+        """
+        connection.requests_count += 1
+        connection.last_used = monotonic()
+        if not connection.is_reusable() or connection.is_expired(
+            connection.last_used, self.idle_timeout, self.max_age, self.max_requests
+        ):
+            connection.close()
+            return
+        connection.conn.start_next_cycle()
+        with self.lock:
+            self.idle_connections.append(connection)
+            if len(self.idle_connections) > self.max_idle:
+                oldest = self.idle_connections.pop(0)
+                oldest.close()
+
+    def clear(self):
+        """Close all the idle connections."""
+        with self.lock:
+            connections = self.idle_connections
+            self.idle_connections = []
+        for connection in connections:
+            connection.close()
+
+
+class HttpClient:
+    """HTTP client with a host within TLS, send and decode messages.
+    Concurrent exchanges from many threads use distinct pooled connections,
+    at most pool_size at once when given.
+    """
+
+    def __init__(
+        self, httpURL, ua, connector=None, pool_size=None, compression=True
+    ):
+        """Setup the HTTPS connections pool to a given a URL.
+        With compression, the server can send compressed responses.
+        """
+        http_url = urlparse(httpURL)
+        assert http_url.scheme == "https"
+        # Messages of send_message and get_messages, per thread
+        self.thread_messages = local()
+        self.port_num = http_url.port or DEFAULT_HTTPS_PORT
+        self.domain = http_url.hostname
+        self.endpoint = http_url.path or "/"
+        self.user_agent = ua
+        self.compression = compression
+        if connector is None:
+            connector = Connector()
+        self.pool = HttpConnectionPool(
+            self.domain,
+            self.port_num,
+            connector=connector,
+            max_connections=pool_size,
+        )
+
+    def close(self):
+        """Close the idle connections."""
+        logger.log(5, "Closing TLS")
+        self.pool.clear()
+
+    def open_connection(self, fresh=False, deadline=None):
+        """Get a connection to the host, from the pool unless fresh is True.
+        Return the connection and if it is reused.
+        """
+        try:
+            if fresh:
+                connection = HttpConnection(
+                    self.domain, self.port_num, deadline, self.pool.connector
+                )
+                reused = False
+            else:
+                connection, reused = self.pool.acquire(deadline)
+            logger.log(
+                5,
+                "Connected to HTTPS Host=%s PathTarget=%s",
+                self.domain,
+                self.endpoint,
+            )
+        except Exception as exc:
+            logger.error("Error during TLS connection : %s", str(exc), exc_info=exc)
+            raise HttpClientException(exc) from exc
+        if instrumentation.enabled:
+            instrumentation.count(POOL_REUSED if reused else POOL_OPENED)
+        return connection, reused
+
+    def exchange(self, message, deadline=None):
+        """POST a message to the host, and return the response body.
+        A kept-alive connection dropped by the server is transparently
+        replaced by a new one.
+        The socket operations end before the deadline (monotonic time).
+        """
+        return b"".join(self.stream(message, deadline))
+
+    def stream(self, message, deadline=None):
+        """POST a message to the host, and yield the response body data
+        as it is received. Same as exchange, without buffering the body.
+        """
+        self.pool.take_slot(deadline)
+        try:
+            connection, reused = self.open_connection(deadline=deadline)
+            try:
+                yield from self.post(connection, message, deadline)
+            except HttpConnectionDropped:
+                if not reused:
+                    raise
+                logger.debug("Kept-alive connection dropped, reconnecting")
+                self.pool.clear()
+                connection, _ = self.open_connection(True, deadline)
+                yield from self.post(connection, message, deadline)
+        finally:
+            self.pool.free_slot()
+
+    @property
+    def received_messages(self):
+        """Responses read by get_messages in the current thread."""
+        if not hasattr(self.thread_messages, "received"):
+            self.thread_messages.received = []
+        return self.thread_messages.received
+
+    def send_message(self, message):
+        """Send a message to the host, POST data message.
+        The exchange is done when reading the response with get_messages,
+        in the same thread.
+        """
+        self.thread_messages.last_message = message
+
+    def get_messages(self):
+        """Read data from server"""
+        self.received_messages.append(
+            self.exchange(self.thread_messages.last_message)
+        )
+
+    def post(self, connection, message, deadline=None):
+        """POST a message on the connection, yield the response body data.
+        The connection is given back to the pool after a full response,
+        and closed when the reading is abandoned.
+        """
+        reader = ResponseReader(connection.conn)
+        try:
+            request_parts = post_request(
+                connection.conn,
+                self.domain,
+                self.endpoint,
+                self.user_agent,
+                message,
+                self.compression,
+            )
+            if logger.isEnabledFor(5):
+                logger.log(5, "Sending HTTP POST data : %s", request_parts)
+            timed = instrumentation.enabled
+            if timed:
+                start = monotonic()
+            connection.ssocket.set_deadline(deadline)
+            connection.ssocket.send_parts(request_parts)
+            if timed:
+                sent = monotonic()
+                instrumentation.phase(PHASE_SEND, sent - start)
+            # Listen to server data
+            while True:
+                complete = reader.process_events()
+                yield from reader.take_data()
+                if complete:
+                    self.pool.release(connection)
+                    return
+                if connection.is_closed():
+                    raise HttpClientException("Socket was closed by remote party")
+                connection.ssocket.set_deadline(deadline)
+                connection.conn.receive_data(connection.ssocket.receive())
+                if timed:
+                    # Only the first reception
+                    timed = False
+                    instrumentation.phase(PHASE_FIRST_BYTE, monotonic() - sent)
+        except GeneratorExit:
+            connection.close()
+            raise
+        except Exception as exc:
+            dropped = not reader.started and (
+                connection.is_closed()
+                or isinstance(exc, (ConnectionError, SSLEOFError))
+            )
+            connection.close()
+            if dropped:
+                raise HttpConnectionDropped(exc) from exc
+            if isinstance(exc, HttpClientException):
+                raise
+            raise HttpClientException(exc) from exc
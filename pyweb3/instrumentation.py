@@ -0,0 +1,299 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : instrumentation
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Instrumentation hooks of the RPC stack, and metrics exporters"""
+
+
+from bisect import bisect_left
+from importlib import import_module
+from threading import Lock
+from time import time
+
+
+# Phases of a request
+PHASE_DNS = "dns"  # host name resolution, when not cached
+PHASE_CONNECT = "connect"  # TCP connection
+PHASE_TLS = "tls"  # TLS handshake
+PHASE_SEND = "send"  # request sending
+PHASE_FIRST_BYTE = "first_byte"  # from the request sent to the response start
+PHASE_DECODE = "decode"  # JSON decoding of the response
+
+# Counters
+BYTES_IN = "bytes_in"
+BYTES_OUT = "bytes_out"
+RETRIES = "retries"
+CACHE_HITS = "cache_hits"
+CACHE_MISSES = "cache_misses"
+DNS_CACHE_HITS = "dns_cache_hits"
+TLS_RESUMED = "tls_resumed"
+POOL_REUSED = "pool_reused"  # requests on a kept-alive connection
+POOL_OPENED = "pool_opened"  # requests on a new connection
+
+# Gauges
+POOL_IN_USE = "pool_in_use"  # HTTPS connections in use, per host
+
+# Upper bounds of the latency histograms buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class InstrumentationListener:
+    """Listener of the measures of the RPC stack, its methods do nothing :
+    override the ones needed. They are called in the threads doing the
+    requests, so they must be quick and thread-safe.
+    """
+
+    def on_request(self, method, duration, success):
+        """A JSON-RPC request (or batch) was exchanged with a node, success
+        is False when it failed or got an error response.
+        Each attempt is measured, the retries are counted.
+        """
+
+    def on_phase(self, phase, duration):
+        """A phase of a request was done, in duration seconds."""
+
+    def on_count(self, name, value):
+        """A counter increased by value."""
+
+    def on_gauge(self, name, value, host):
+        """A gauge of a node host ("domain:port") changed to value."""
+
+
+class Instrumentation:
+    """Give the measures of the RPC stack to the listeners.
+    It is disabled while there is no listener : the instrumented code
+    only reads enabled, and measures nothing.
+    """
+
+    def __init__(self):
+        self.listeners = ()
+        self.enabled = False
+        self.lock = Lock()
+
+    def add_listener(self, listener):
+        """Start giving the measures to a listener."""
+        with self.lock:
+            self.listeners = self.listeners + (listener,)
+            self.enabled = True
+
+    def remove_listener(self, listener):
+        """Stop giving the measures to a listener."""
+        with self.lock:
+            self.listeners = tuple(
+                registered
+                for registered in self.listeners
+                if registered is not listener
+            )
+            self.enabled = bool(self.listeners)
+
+    def request(self, method, duration, success=True):
+        """Give the latency of a request."""
+        for listener in self.listeners:
+            listener.on_request(method, duration, success)
+
+    def phase(self, phase, duration):
+        """Give the duration of a request phase."""
+        for listener in self.listeners:
+            listener.on_phase(phase, duration)
+
+    def count(self, name, value=1):
+        """Increase a counter."""
+        for listener in self.listeners:
+            listener.on_count(name, value)
+
+    def gauge(self, name, value, host):
+        """Set a gauge of a node host."""
+        for listener in self.listeners:
+            listener.on_gauge(name, value, host)
+
+
+# Instrumentation of the clients
+instrumentation = Instrumentation()
+
+
+def add_listener(listener):
+    """Give the measures of all the clients to a listener."""
+    instrumentation.add_listener(listener)
+
+
+def remove_listener(listener):
+    """Stop giving the measures to a listener."""
+    instrumentation.remove_listener(listener)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, as Prometheus."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Last count for the values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add a measured value."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Give the upper bound of the bucket of a quantile, None when there
+        is no value, or infinity when it is above the last bucket.
+        """
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        cumulated = 0
+        for bucket_index, bucket_count in enumerate(self.counts[:-1]):
+            cumulated += bucket_count
+            if cumulated >= rank:
+                return self.buckets[bucket_index]
+        return float("inf")
+
+    def prometheus_lines(self, name, labels):
+        """Give the lines of the histogram in the Prometheus text format."""
+        lines = []
+        cumulated = 0
+        for bucket, bucket_count in zip(self.buckets, self.counts):
+            cumulated += bucket_count
+            lines.append(f'{name}_bucket{{{labels},le="{bucket}"}} {cumulated}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class MetricsRecorder(InstrumentationListener):
+    """Listener aggregating the measures : latency histograms per method and
+    per phase, errors per method, counters and gauges.
+    Export them with prometheus_text.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.requests = {}
+        self.errors = {}
+        self.phases = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def on_request(self, method, duration, success):
+        with self.lock:
+            histogram = self.requests.get(method)
+            if histogram is None:
+                histogram = self.requests[method] = Histogram(self.buckets)
+            histogram.observe(duration)
+            if not success:
+                self.errors[method] = self.errors.get(method, 0) + 1
+
+    def on_phase(self, phase, duration):
+        with self.lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram(self.buckets)
+            histogram.observe(duration)
+
+    def on_count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def on_gauge(self, name, value, host):
+        with self.lock:
+            self.gauges[(name, host)] = value
+
+    def prometheus_text(self, prefix="pyweb3"):
+        """Give the metrics in the Prometheus text exposition format."""
+        with self.lock:
+            lines = [
+                f"# HELP {prefix}_request_duration_seconds JSON-RPC requests latency",
+                f"# TYPE {prefix}_request_duration_seconds histogram",
+            ]
+            for method, histogram in sorted(self.requests.items()):
+                lines += histogram.prometheus_lines(
+                    f"{prefix}_request_duration_seconds", f'method="{method}"'
+                )
+            lines += [
+                f"# HELP {prefix}_request_errors_total Failed JSON-RPC requests",
+                f"# TYPE {prefix}_request_errors_total counter",
+            ]
+            for method, errors in sorted(self.errors.items()):
+                lines.append(
+                    f'{prefix}_request_errors_total{{method="{method}"}} {errors}'
+                )
+            lines += [
+                f"# HELP {prefix}_phase_duration_seconds Requests phases duration",
+                f"# TYPE {prefix}_phase_duration_seconds histogram",
+            ]
+            for phase, histogram in sorted(self.phases.items()):
+                lines += histogram.prometheus_lines(
+                    f"{prefix}_phase_duration_seconds", f'phase="{phase}"'
+                )
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+            gauge_name = None
+            for (name, host), value in sorted(self.gauges.items()):
+                if name != gauge_name:
+                    gauge_name = name
+                    lines.append(f"# TYPE {prefix}_{name} gauge")
+                lines.append(f'{prefix}_{name}{{host="{host}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+class OpenTelemetryListener(InstrumentationListener):
+    """Listener giving the requests and their phases as OpenTelemetry spans,
+    children of the current span. Requires the opentelemetry-api package.
+    """
+
+    def __init__(self, tracer=None):
+        trace = import_module("opentelemetry.trace")
+        if tracer is None:
+            tracer = trace.get_tracer("pyweb3")
+        self.tracer = tracer
+        self.error_status = trace.Status(trace.StatusCode.ERROR)
+
+    def record_span(self, name, duration, attributes, success=True):
+        """Give a span which ended now, after duration seconds."""
+        end_time = int(time() * 1e9)
+        span = self.tracer.start_span(
+            name, start_time=end_time - int(duration * 1e9), attributes=attributes
+        )
+        if not success:
+            span.set_status(self.error_status)
+        span.end(end_time=end_time)
+
+    def on_request(self, method, duration, success):
+        self.record_span(
+            method, duration, {"rpc.system": "jsonrpc", "rpc.method": method}, success
+        )
+
+    def on_phase(self, phase, duration):
+        self.record_span(f"pyweb3.{phase}", duration, {"pyweb3.phase": phase})
@@ -0,0 +1,85 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : JSON codec
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Pluggable JSON encoder and decoder for pyWeb3"""
+
+
+import json
+from importlib import import_module
+from logging import getLogger
+
+
+# Libraries in preference order, json is the standard library
+JSON_LIBRARIES = ("orjson", "ujson", "json")
+
+
+logger = getLogger(__name__)
+
+
+def stdlib_dumps(dataobj):
+    """Compact JSON encoding to bytes, with the standard library."""
+    return json.dumps(dataobj, separators=(",", ":")).encode("utf8")
+
+
+def ujson_dumps_function(ujson):
+    """Build the compact JSON encoding to bytes, with ujson."""
+
+    def ujson_dumps(dataobj):
+        return ujson.dumps(dataobj, escape_forward_slashes=False).encode("utf8")
+
+    return ujson_dumps
+
+
+class JSONCodec:
+    """JSON encoder and decoder, with orjson or ujson when installed, else
+    the standard library. dumps gives bytes, and loads decodes bytes or str.
+    """
+
+    def __init__(self, library=None):
+        self.use(library)
+
+    def use(self, library=None):
+        """Choose the JSON library, the fastest installed when None."""
+        if library is None:
+            for name in JSON_LIBRARIES:
+                try:
+                    self.use(name)
+                    return
+                except ImportError:
+                    continue
+        if library not in JSON_LIBRARIES:
+            raise ValueError(f"JSON library must be one of {JSON_LIBRARIES}")
+        module = import_module(library)
+        if library == "orjson":
+            self.dumps = module.dumps
+            self.loads = module.loads
+        elif library == "ujson":
+            self.dumps = ujson_dumps_function(module)
+            self.loads = module.loads
+        else:
+            self.dumps = stdlib_dumps
+            self.loads = json.loads
+        self.library = library
+        logger.debug("Using %s for JSON", library)
+
+
+# Codec used by the clients
+json_codec = JSONCodec()
+
+
+def set_json_library(library=None):
+    """Choose the JSON library used : "orjson", "ujson" or "json"."""
+    json_codec.use(library)
@@ -1,113 +1,631 @@
-# -*- coding: utf8 -*-
-
-# pyWeb3 : JSON RPC
-# Copyright (C) 2021-2022 BitLogiK
-
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, version 3 of the License.
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-# You should have receive a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>
-
-
-"""JSON RPC for pyWeb3"""
-
-from time import sleep
-from logging import getLogger
-from json import dumps, loads
-from .http_client import HttpClient
-from .websocket import WebSocketClient
-
-
-class JSONRPCexception(Exception):
-    """Exception when the Web3 call has no result, but an error field."""
-
-
-logger = getLogger(__name__)
-
-DEFAULT_USER_AGENT = (
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:96.0) " "Gecko/20100101 Firefox/96.0"
-)
-
-
-# ---- Helpers about messages encoding
-
-
-def json_encode(dataobj):
-    """Compact JSON encoding."""
-    return dumps(dataobj, separators=(",", ":"))
-
-
-def json_rpc_unpack(buffer):
-    """Decode a JSON-RPC response : id, result."""
-    try:
-        resp_obj = loads(buffer)
-    except Exception as exc:
-        raise Exception(f"Error : not JSON response : {buffer}") from exc
-    if resp_obj["jsonrpc"] != "2.0":
-        raise Exception(f"Server is not JSONRPC 2.0 but {resp_obj.jsonrpc}")
-    if "error" in resp_obj:
-        raise JSONRPCexception(resp_obj["error"])
-    return resp_obj["id"], resp_obj["result"]
-
-
-class JSONRPCclient:
-    """WebSocket and HTTPS JSON-RPC client"""
-
-    def __init__(self, url_api, user_agent, retries):
-        if user_agent is None:
-            user_agent = DEFAULT_USER_AGENT
-        if url_api.startswith("wss:"):
-            self.cnx = WebSocketClient(url_api, user_agent)
-        elif url_api.startswith("https:"):
-            self.cnx = HttpClient(url_api, user_agent)
-        else:
-            raise Exception("Only accept HTTPS and WebSocket connection scheme")
-        self.retry = retries
-        self.req_id = 0
-
-    def send_request(self, method_name, params=None):
-        """Send a JSON RPC request"""
-        if params is None:
-            params = []
-        self.req_id += 1
-        request_obj = {
-            "jsonrpc": "2.0",
-            "id": self.req_id,
-            "method": method_name,
-            "params": params,
-        }
-        logger.log(5, "Sending RPC request method:%s with data:%s", method_name, params)
-        self.cnx.send_message(json_encode(request_obj).encode("utf8"))
-
-    def get_response(self):
-        """Listen to response, expect same id as the latest request sent"""
-        self.cnx.get_messages()
-        msg = self.cnx.received_messages.pop()
-        reqid, result = json_rpc_unpack(msg)
-        logger.log(5, "Received RPC result: %s", result)
-        if reqid != self.req_id:
-            raise Exception("JSON RPC response id mismatch")
-        return result
-
-    def request(self, method_name, params=None):
-        """Send a RPC query and listen to response"""
-        if params is None:
-            params = []
-        for nret in range(self.retry + 1):
-            try:
-                self.send_request(method_name, params)
-                resp = self.get_response()
-                return resp
-            except KeyboardInterrupt as exc:
-                raise exc
-            except Exception as exc:
-                if self.retry and nret < self.retry:
-                    logger.log(5, "Retry %i", nret + 1)
-                    sleep(0.5)
-                else:
-                    raise exc
+# -*- coding: utf8 -*-
+
+# pyWeb3 : JSON RPC
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""JSON RPC for pyWeb3"""
+
+from functools import partial
+from itertools import count
+from threading import Lock
+from time import monotonic, sleep
+from logging import getLogger
+from .endpoints import Endpoint, best_endpoint, select_endpoint
+from .cache import canonical_params
+from .coalescing import MicroBatcher, SingleFlight
+from .hedging import RequestHedger
+from .json_codec import json_codec
+from .json_stream import ResultStreamParser
+from .http_client import HttpRateLimited
+from .instrumentation import (
+    instrumentation,
+    CACHE_HITS,
+    CACHE_MISSES,
+    PHASE_DECODE,
+    RETRIES,
+)
+from .rate_limit import RateLimiter, is_rate_limited
+from .retry import RetryPolicy, is_idempotent
+from .tls_socket import Connector
+from .websocket import DEFAULT_MAX_INFLIGHT, GLOBAL_TIMEOUT
+
+
+class JSONRPCexception(Exception):
+    """Exception when the Web3 call has no result, but an error field."""
+
+
+logger = getLogger(__name__)
+
+DEFAULT_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:96.0) " "Gecko/20100101 Firefox/96.0"
+)
+
+# Maximum number of requests sent in a single batch
+DEFAULT_BATCH_SIZE = 100
+
+# Read-only methods, which can be hedged, coalesced or micro-batched
+READ_ONLY_METHODS = (
+    "eth_blockNumber",
+    "eth_call",
+    "eth_chainId",
+    "eth_estimateGas",
+    "eth_feeHistory",
+    "eth_gasPrice",
+    "eth_getBalance",
+    "eth_getBlockByHash",
+    "eth_getBlockByNumber",
+    "eth_getBlockTransactionCountByHash",
+    "eth_getBlockTransactionCountByNumber",
+    "eth_getCode",
+    "eth_getFilterLogs",
+    "eth_getLogs",
+    "eth_getStorageAt",
+    "eth_getTransactionByBlockHashAndIndex",
+    "eth_getTransactionByBlockNumberAndIndex",
+    "eth_getTransactionByHash",
+    "eth_getTransactionCount",
+    "eth_getTransactionReceipt",
+    "eth_maxPriorityFeePerGas",
+    "net_version",
+)
+
+
+# ---- Helpers about messages encoding
+
+
+def json_encode(dataobj):
+    """Compact JSON encoding, as bytes."""
+    return json_codec.dumps(dataobj)
+
+
+def json_rpc_request(req_id, method_name, params=None):
+    """Build a JSON-RPC request object."""
+    if params is None:
+        params = []
+    return {
+        "jsonrpc": "2.0",
+        "id": req_id,
+        "method": method_name,
+        "params": params,
+    }
+
+
+def json_rpc_message(req_id, method_name, params=None):
+    """Encode a JSON-RPC request, the envelope is written directly."""
+    if params is None:
+        params = []
+    return b'{"jsonrpc":"2.0","id":%i,"method":"%s","params":%s}' % (
+        req_id,
+        method_name.encode("ascii"),
+        json_codec.dumps(params),
+    )
+
+
+def json_rpc_decode(buffer):
+    """Decode a JSON-RPC response buffer, bytes or str."""
+    try:
+        return json_codec.loads(buffer)
+    except Exception as exc:
+        raise Exception(f"Error : not JSON response : {buffer}") from exc
+
+
+def json_rpc_result(resp_obj):
+    """Read a decoded JSON-RPC response object : id, result."""
+    if resp_obj["jsonrpc"] != "2.0":
+        raise Exception(f"Server is not JSONRPC 2.0 but {resp_obj['jsonrpc']}")
+    if "error" in resp_obj:
+        raise JSONRPCexception(resp_obj["error"])
+    return resp_obj["id"], resp_obj["result"]
+
+
+def json_rpc_unpack(buffer):
+    """Decode a JSON-RPC response : id, result."""
+    return json_rpc_result(json_rpc_decode(buffer))
+
+
+def request_label(method_names):
+    """Name a request for the instrumentation : its method, or "batch"."""
+    if len(method_names) == 1:
+        return method_names[0]
+    return "batch"
+
+
+def json_rpc_batch_results(resp_objs, request_ids):
+    """Read a decoded JSON-RPC batch response.
+    Return the results in the order of request_ids, whatever the order of
+    the responses. The items in error are given as JSONRPCexception.
+    """
+    if not isinstance(resp_objs, list):
+        # The whole batch was rejected
+        json_rpc_result(resp_objs)
+        raise Exception("JSON RPC batch response is not a list")
+    results = {}
+    for resp_obj in resp_objs:
+        try:
+            reqid, result = json_rpc_result(resp_obj)
+        except JSONRPCexception as exc:
+            reqid, result = resp_obj.get("id"), exc
+        results[reqid] = result
+    return [
+        results.get(
+            reqid, JSONRPCexception({"code": -32603, "message": "No response"})
+        )
+        for reqid in request_ids
+    ]
+
+
+class JSONRPCclient:
+    """WebSocket and HTTPS JSON-RPC client.
+    With many nodes URLs, each request is sent to the best endpoint, with
+    the lowest latency and errors, and failing endpoints are ejected.
+    A request and its retries end before the timeout, when one is given.
+    With coalesce, concurrent identical read requests are sent once.
+    With a batch_window, the concurrent requests are gathered in batches.
+    With a rate_limit, the requests of all the threads are throttled.
+    The connections share the socket_options (SocketOptions), the SSL
+    context and the TLS sessions, resumed when connecting again.
+    Thread-safe : a client can be shared by many threads. Each request has
+    its own id and response, and the HTTPS requests use distinct pooled
+    connections, at most pool_size at once per node when it is given.
+    With compression, the responses can be compressed : gzip for HTTPS,
+    permessage-deflate for WebSocket.
+    """
+
+    def __init__(
+        self,
+        url_api,
+        user_agent,
+        retries,
+        batch_size=DEFAULT_BATCH_SIZE,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        cache=None,
+        timeout=None,
+        hedge=False,
+        coalesce=False,
+        batch_window=None,
+        rate_limit=None,
+        socket_options=None,
+        ssl_context=None,
+        pool_size=None,
+        compression=True,
+    ):
+        if user_agent is None:
+            user_agent = DEFAULT_USER_AGENT
+        if isinstance(url_api, str):
+            url_api = [url_api]
+        self.connector = Connector(socket_options, ssl_context)
+        self.endpoints = [
+            Endpoint(
+                url, user_agent, max_inflight, self.connector, pool_size, compression
+            )
+            for url in url_api
+        ]
+        if len(self.endpoints) == 1:
+            # Single node : connect now, to report errors early
+            self.endpoints[0].connect()
+        if not isinstance(retries, RetryPolicy):
+            retries = RetryPolicy(retries)
+        self.retry_policy = retries
+        self.batch_size = batch_size
+        self.cache = cache
+        self.timeout = timeout
+        self.hedger = RequestHedger() if hedge else None
+        self.singleflight = SingleFlight() if coalesce else None
+        if rate_limit is not None and not isinstance(rate_limit, RateLimiter):
+            # Requests per second
+            rate_limit = RateLimiter(rate_limit)
+        self.limiter = rate_limit
+        self.batcher = None
+        if batch_window is not None:
+            self.batcher = MicroBatcher(self.send_many, batch_window, batch_size)
+        self.req_ids = count(1)
+        self.req_id = 0
+        self.req_id_lock = Lock()
+
+    def new_request_id(self):
+        """Give a new request id, unique among all the threads"""
+        with self.req_id_lock:
+            req_id = next(self.req_ids)
+            self.req_id = req_id
+        return req_id
+
+    def new_request(self, method_name, params=None):
+        """Build a JSON RPC request object, with a new id"""
+        return json_rpc_request(self.new_request_id(), method_name, params)
+
+    @property
+    def cnx(self):
+        """Connection of the first endpoint"""
+        return self.endpoints[0].connect()
+
+    def close(self):
+        """Close the connections"""
+        for endpoint in self.endpoints:
+            endpoint.close()
+        if self.hedger is not None:
+            self.hedger.close()
+
+    def make_deadline(self, timeout=None):
+        """Give the deadline of a request, from its timeout or the client one"""
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return monotonic() + timeout
+
+    def stream_endpoint(self):
+        """Give the best WebSocket endpoint, for subscriptions"""
+        endpoints = [endpoint for endpoint in self.endpoints if endpoint.multiplexed]
+        if not endpoints:
+            raise Exception("Subscriptions require a WebSocket connection")
+        return select_endpoint(endpoints)
+
+    def exchange(
+        self, request_ids, message, method_names, endpoint=None, deadline=None
+    ):
+        """Send an encoded JSON RPC request or batch, of the methods,
+        and return the decoded response.
+        The request is sent to the given endpoint, or else the best one.
+        It waits for the rate limiter, which is told when it is throttled.
+        """
+        if self.limiter is None:
+            return self.exchange_on_endpoint(
+                request_ids, message, method_names, endpoint, deadline
+            )
+        self.limiter.acquire(self.limiter.cost(method_names), deadline)
+        throttled = False
+        retry_after = None
+        try:
+            response = self.exchange_on_endpoint(
+                request_ids, message, method_names, endpoint, deadline
+            )
+            throttled = is_rate_limited(response)
+            return response
+        except HttpRateLimited as exc:
+            throttled = True
+            retry_after = exc.retry_after
+            raise
+        finally:
+            self.limiter.release(throttled, retry_after)
+
+    def exchange_on_endpoint(
+        self, request_ids, message, method_names, endpoint, deadline
+    ):
+        """Send an encoded JSON RPC request or batch to an endpoint.
+        Idempotent requests are sent again after a WebSocket reconnection.
+        """
+        if endpoint is None:
+            endpoint = select_endpoint(self.endpoints)
+        start = monotonic()
+        try:
+            cnx = endpoint.connect()
+            if endpoint.multiplexed:
+                # WebSocket multiplexes the requests
+                timeout = GLOBAL_TIMEOUT
+                if deadline is not None:
+                    timeout = max(deadline - monotonic(), 0)
+                response = cnx.exchange(
+                    request_ids, message, timeout, is_idempotent(method_names)
+                )
+            else:
+                # HTTP uses pooled connections
+                body = cnx.exchange(message, deadline)
+                decode_start = monotonic()
+                response = json_rpc_decode(body)
+                if instrumentation.enabled:
+                    instrumentation.phase(PHASE_DECODE, monotonic() - decode_start)
+        except Exception:
+            endpoint.record_failure()
+            if instrumentation.enabled:
+                instrumentation.request(
+                    request_label(method_names), monotonic() - start, False
+                )
+            raise
+        latency = monotonic() - start
+        endpoint.record_success(latency)
+        if instrumentation.enabled:
+            instrumentation.request(
+                request_label(method_names),
+                latency,
+                not (isinstance(response, dict) and "error" in response),
+            )
+        return response
+
+    def with_retries(self, query_function, *args, deadline=None, idempotent=True):
+        """Run a query function, and retry it after an error, as the retry
+        policy tells. No retry is done when it can't end before the deadline.
+        """
+        start = monotonic()
+        nret = 0
+        while True:
+            try:
+                return query_function(*args, deadline=deadline)
+            except KeyboardInterrupt as exc:
+                raise exc
+            except Exception as exc:
+                delay = self.retry_policy.delay(
+                    nret, exc, monotonic() - start, idempotent
+                )
+                if delay is None or (
+                    deadline is not None and monotonic() + delay >= deadline
+                ):
+                    raise exc
+                nret += 1
+                logger.log(5, "Retry %i in %f s after : %s", nret, delay, exc)
+                if instrumentation.enabled:
+                    instrumentation.count(RETRIES)
+                sleep(delay)
+
+    def query(self, method_name, params, endpoint=None, deadline=None):
+        """Send a RPC query and listen to its response"""
+        req_id = self.new_request_id()
+        logger.log(5, "Sending RPC request method:%s with data:%s", method_name, params)
+        reqid, result = json_rpc_result(
+            self.exchange(
+                [req_id],
+                json_rpc_message(req_id, method_name, params),
+                [method_name],
+                endpoint,
+                deadline,
+            )
+        )
+        logger.log(5, "Received RPC result: %s", result)
+        if reqid != req_id:
+            raise Exception("JSON RPC response id mismatch")
+        return result
+
+    def start_query(self, method_name, params, endpoint, deadline=None):
+        """Send a RPC query to an endpoint, which records it is used."""
+        endpoint.start_request(monotonic())
+        return self.query(method_name, params, endpoint, deadline)
+
+    def stream_query(self, method_name, params, deadline=None):
+        """Send a RPC query, and yield the items of its result array.
+        Over HTTP, the items are decoded as the response is received.
+        """
+        endpoint = select_endpoint(self.endpoints)
+        if endpoint.multiplexed:
+            # A WebSocket message is received whole
+            yield from self.query(method_name, params, endpoint, deadline)
+            return
+        req_id = self.new_request_id()
+        message = json_rpc_message(req_id, method_name, params)
+        if self.limiter is not None:
+            self.limiter.acquire(self.limiter.cost([method_name]), deadline)
+        throttled = False
+        retry_after = None
+        try:
+            parser = ResultStreamParser()
+            start = monotonic()
+            latency = None
+            try:
+                for data in endpoint.connect().stream(message, deadline):
+                    if latency is None:
+                        latency = monotonic() - start
+                    yield from parser.feed(data)
+                response = parser.finish()
+            except HttpRateLimited as exc:
+                throttled = True
+                retry_after = exc.retry_after
+                endpoint.record_failure()
+                raise
+            except GeneratorExit:
+                # The caller stopped reading, after the node answered
+                endpoint.record_success(latency)
+                raise
+            except Exception:
+                endpoint.record_failure()
+                raise
+            throttled = is_rate_limited(response)
+            endpoint.record_success(latency or monotonic() - start)
+            reqid, result = json_rpc_result(response)
+            if reqid != req_id:
+                raise Exception("JSON RPC response id mismatch")
+            if not isinstance(result, list):
+                raise Exception("JSON RPC result is not a list")
+            # Empty when streamed, else the whole result was at the end
+            yield from result
+        finally:
+            if self.limiter is not None:
+                self.limiter.release(throttled, retry_after)
+
+    def hedged_query(self, method_name, params, deadline=None):
+        """Send a RPC query, and a duplicate to another connection when the
+        response is slow. Return the first result.
+        """
+        endpoint = select_endpoint(self.endpoints)
+        now = monotonic()
+        others = [
+            other
+            for other in self.endpoints
+            if other is not endpoint and other.is_available(now)
+        ]
+        if others:
+            # Its state changes only when the hedge is sent
+            hedge_endpoint = best_endpoint(others, now)
+        elif not endpoint.multiplexed:
+            # Another pooled connection to the same node
+            hedge_endpoint = endpoint
+        else:
+            hedge_endpoint = None
+        hedge = None
+        if hedge_endpoint is not None:
+            hedge = partial(self.start_query, method_name, params, hedge_endpoint)
+        return self.hedger.run(
+            partial(self.query, method_name, params, endpoint), hedge, deadline
+        )
+
+    def query_batch(self, requests, deadline=None):
+        """Send a RPC batch and listen to its responses"""
+        request_objs = [self.new_request(method, params) for method, params in requests]
+        request_ids = [request_obj["id"] for request_obj in request_objs]
+        logger.log(5, "Sending RPC batch of %i requests", len(request_objs))
+        results = json_rpc_batch_results(
+            self.exchange(
+                request_ids,
+                json_encode(request_objs),
+                [method for method, _ in requests],
+                deadline=deadline,
+            ),
+            request_ids,
+        )
+        logger.log(5, "Received RPC batch results: %s", results)
+        return results
+
+    def request(self, method_name, params=None, endpoint=None, timeout=None):
+        """Send a RPC query and listen to response.
+        Thread-safe with WebSocket, the requests are multiplexed.
+        The result is read from the cache when it is there.
+        The read queries are hedged, when enabled.
+        """
+        if params is None:
+            params = []
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(method_name, params)
+            if cache_key is not None:
+                found, result = self.cache.get(cache_key)
+                if instrumentation.enabled:
+                    instrumentation.count(CACHE_HITS if found else CACHE_MISSES)
+                if found:
+                    return result
+        deadline = self.make_deadline(timeout)
+        if (
+            self.singleflight is not None
+            and endpoint is None
+            and method_name in READ_ONLY_METHODS
+        ):
+            key = (method_name, json_encode(canonical_params(params)))
+            result = self.singleflight.call(
+                key, deadline, self.send_request, method_name, params, None, deadline
+            )
+        else:
+            result = self.send_request(method_name, params, endpoint, deadline)
+        if cache_key is not None:
+            self.cache.put(cache_key, method_name, params, result)
+        return result
+
+    def stream_request(self, method_name, params=None, timeout=None):
+        """Send a RPC query, and yield the items of its result array as they
+        are received, without buffering the whole response.
+        The query is retried as the retry policy tells, until a first item
+        was given.
+        """
+        deadline = self.make_deadline(timeout)
+        idempotent = is_idempotent([method_name])
+        start = monotonic()
+        nret = 0
+        while True:
+            received = False
+            try:
+                for item in self.stream_query(method_name, params, deadline):
+                    received = True
+                    yield item
+                return
+            except Exception as exc:
+                if received:
+                    raise exc
+                delay = self.retry_policy.delay(
+                    nret, exc, monotonic() - start, idempotent
+                )
+                if delay is None or (
+                    deadline is not None and monotonic() + delay >= deadline
+                ):
+                    raise exc
+                nret += 1
+                logger.log(5, "Retry %i in %f s after : %s", nret, delay, exc)
+                if instrumentation.enabled:
+                    instrumentation.count(RETRIES)
+                sleep(delay)
+
+    def send_request(self, method_name, params, endpoint=None, deadline=None):
+        """Send a RPC query, in a batch, or hedged, or to the endpoint"""
+        if (
+            self.batcher is not None
+            and endpoint is None
+            and method_name in READ_ONLY_METHODS
+        ):
+            return self.batcher.request(method_name, params, deadline)
+        if (
+            self.hedger is not None
+            and endpoint is None
+            and method_name in READ_ONLY_METHODS
+        ):
+            return self.with_retries(
+                self.hedged_query, method_name, params, deadline=deadline
+            )
+        return self.with_retries(
+            self.query,
+            method_name,
+            params,
+            endpoint,
+            deadline=deadline,
+            idempotent=is_idempotent([method_name]),
+        )
+
+    def request_many(self, requests, batch_size=None):
+        """Send a list of (method_name, params) RPC queries in batches.
+        The requests are split in batches of at most batch_size queries.
+        Return the list of the results, in the requests order.
+        A query in error gives a JSONRPCexception in place of its result.
+        The results in the cache are not queried.
+        """
+        requests = [(method, params or []) for method, params in requests]
+        if self.cache is None:
+            return self.send_many(requests, batch_size)
+        results = [None] * len(requests)
+        missing = []
+        for index, (method, params) in enumerate(requests):
+            cache_key = self.cache.make_key(method, params)
+            if cache_key is not None:
+                found, results[index] = self.cache.get(cache_key)
+                if found:
+                    continue
+            missing.append((index, cache_key))
+        missing_results = self.send_many(
+            [requests[index] for index, _ in missing], batch_size
+        )
+        for (index, cache_key), result in zip(missing, missing_results):
+            results[index] = result
+            if cache_key is not None and not isinstance(result, Exception):
+                method, params = requests[index]
+                self.cache.put(cache_key, method, params, result)
+        return results
+
+    def endpoints_status(self):
+        """Give the statistics of the endpoints"""
+        return [endpoint.status() for endpoint in self.endpoints]
+
+    def connection_stats(self):
+        """Give the TLS handshakes counters"""
+        return self.connector.stats()
+
+    def send_many(self, requests, batch_size=None, deadline=None):
+        """Send the queries in batches of at most batch_size queries.
+        Each batch has the client timeout, or ends before the deadline.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        results = []
+        for chunk_start in range(0, len(requests), batch_size):
+            chunk = requests[chunk_start : chunk_start + batch_size]
+            results.extend(
+                self.with_retries(
+                    self.query_batch,
+                    chunk,
+                    deadline=deadline or self.make_deadline(),
+                    idempotent=is_idempotent(method for method, _ in chunk),
+                )
+            )
+        return results
@@ -0,0 +1,275 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : JSON streaming decoder
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Incremental decoding of a JSON-RPC result array for pyWeb3"""
+
+
+import re
+from codecs import getincrementaldecoder
+from json import JSONDecoder
+
+from .json_codec import json_codec
+
+
+# A string, maybe not terminated yet, or a structural character
+TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*(")?|[\[\]{}:,]', re.DOTALL)
+SPACES = re.compile(r"[ \t\n\r]*")
+# Within an item : a string start or a structural character
+ITEM_TOKEN = re.compile(r'["\[\]{}]')
+# Rest of a string, up to its closing quote, or a final escape character
+STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+# A number or a literal, up to its delimiter
+SCALAR = re.compile(r"[^ \t\n\r,\]]*")
+
+RESULT_KEY = '"result"'
+OPENING = "[{"
+CLOSING = "]}"
+
+# Parser states
+IN_RESPONSE = 0  # before the result array, or no result array
+RESULT_VALUE = 1  # after the "result" key, before its value
+IN_RESULT = 2  # reading the result array items
+AFTER_RESULT = 3  # after the result array
+
+
+class JSONStreamException(Exception):
+    """Exception when the JSON-RPC response can't be decoded."""
+
+
+class ResultStreamParser:
+    """Decode the result array of a JSON-RPC response as it is received.
+    Each item is decoded as soon as it is complete, and the received data
+    is then dropped : the memory used is bounded by the largest item.
+    The items within a received part are read with the scanner of the
+    standard json library, which decodes a value within a text. The end of
+    an item split over many parts is searched in each part, from where the
+    scan of the previous part stopped, then the whole item is decoded.
+    """
+
+    def __init__(self):
+        self.text_decoder = getincrementaldecoder("utf8")()
+        self.decode_value = JSONDecoder().raw_decode
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.state = IN_RESPONSE
+        self.key = None
+        self.items_count = 0
+        self.head = ""
+        self.tail = []
+        # Scan of the current item
+        self.item_parts = None
+        self.scalar = False
+        self.item_depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.after_item = False
+
+    def feed(self, data):
+        """Add received data, and give the list of the completed items."""
+        text = self.text_decoder.decode(data)
+        if self.state == AFTER_RESULT:
+            self.tail.append(text)
+            return []
+        if self.state == IN_RESULT:
+            return self.parse_items(text)
+        self.buffer += text
+        self.parse_response()
+        if self.state == IN_RESULT:
+            text = self.buffer[self.pos :]
+            self.buffer = ""
+            return self.parse_items(text)
+        return []
+
+    def parse_response(self):
+        """Scan the response, up to the start of the result array."""
+        buffer = self.buffer
+        while True:
+            if self.state == RESULT_VALUE:
+                value_start = SPACES.match(buffer, self.pos).end()
+                if value_start == len(buffer):
+                    self.pos = value_start
+                    return
+                if buffer[value_start] == "[":
+                    self.head = buffer[:value_start]
+                    self.state = IN_RESULT
+                    self.pos = value_start + 1
+                    return
+                # Not an array, decoded at the end
+                self.state = IN_RESPONSE
+            match = TOKEN.search(buffer, self.pos)
+            if match is None:
+                self.pos = len(buffer)
+                return
+            token = match.group()
+            if token[0] == '"':
+                if match.group(1) is None:
+                    # String not complete yet
+                    self.pos = match.start()
+                    return
+                self.key = token
+            elif token in OPENING:
+                self.depth += 1
+            elif token in CLOSING:
+                self.depth -= 1
+            elif token == ":" and self.depth == 1 and self.key == RESULT_KEY:
+                self.state = RESULT_VALUE
+            self.pos = match.end()
+
+    def parse_items(self, text):
+        """Decode the items of the result array completed by text."""
+        items = []
+        length = len(text)
+        pos = 0
+        decode_value = self.decode_value
+        match_spaces = SPACES.match
+        while True:
+            if self.item_parts is not None:
+                # Item started in a previous text
+                if self.scalar:
+                    item_end = self.scalar_end(text, pos)
+                else:
+                    item_end = self.item_end(text, pos)
+                if item_end is None:
+                    self.item_parts.append(text[pos:])
+                    break
+                self.item_parts.append(text[pos:item_end])
+                item = self.decode_item("".join(self.item_parts))
+                self.item_parts = None
+            else:
+                pos = match_spaces(text, pos).end()
+                if pos == length:
+                    break
+                char = text[pos]
+                if self.after_item:
+                    # Separator in a next text
+                    self.after_item = False
+                    if char == ",":
+                        pos += 1
+                        continue
+                    if char == "]":
+                        self.end_result(text, pos + 1)
+                        break
+                    raise JSONStreamException("Bad separator in the result array")
+                if char == "]" and self.items_count == 0:
+                    self.end_result(text, pos + 1)
+                    break
+                item_end = None
+                if char in '[{"':
+                    try:
+                        item, item_end = decode_value(text, pos)
+                    except ValueError:
+                        # Not complete in this text
+                        pass
+                if item_end is None:
+                    self.scalar = char not in '[{"'
+                    self.item_parts = []
+                    continue
+            items.append(item)
+            self.items_count += 1
+            pos = match_spaces(text, item_end).end()
+            if pos == length:
+                self.after_item = True
+                break
+            char = text[pos]
+            if char == ",":
+                pos += 1
+            elif char == "]":
+                self.end_result(text, pos + 1)
+                break
+            else:
+                raise JSONStreamException("Bad separator in the result array")
+        return items
+
+    @staticmethod
+    def scalar_end(text, pos):
+        """Give the end of a number or a literal, None when the text ends
+        before its delimiter.
+        """
+        item_end = SCALAR.match(text, pos).end()
+        if item_end == len(text):
+            return None
+        return item_end
+
+    def item_end(self, text, pos):
+        """Give the end of a string, array or object item, None when the
+        text ends before. The scan state is kept for the next text.
+        """
+        length = len(text)
+        while True:
+            if self.in_string:
+                if self.escaped:
+                    if pos == length:
+                        return None
+                    pos += 1
+                    self.escaped = False
+                pos = STRING_REST.match(text, pos).end()
+                if pos == length:
+                    return None
+                if text[pos] == "\\":
+                    # Escape character ending the text
+                    self.escaped = True
+                    return None
+                pos += 1
+                self.in_string = False
+                if self.item_depth == 0:
+                    return pos
+                continue
+            match = ITEM_TOKEN.search(text, pos)
+            if match is None:
+                return None
+            token = match.group()
+            pos = match.end()
+            if token == '"':
+                self.in_string = True
+            elif token in OPENING:
+                self.item_depth += 1
+            else:
+                self.item_depth -= 1
+                if self.item_depth == 0:
+                    return pos
+
+    @staticmethod
+    def decode_item(item_text):
+        """Decode a complete item of the result array."""
+        try:
+            return json_codec.loads(item_text)
+        except Exception as exc:
+            raise JSONStreamException(
+                f"Bad item in the result array : {item_text[:100]}"
+            ) from exc
+
+    def end_result(self, text, pos):
+        """Record the end of the result array."""
+        self.state = AFTER_RESULT
+        self.tail.append(text[pos:])
+
+    def finish(self):
+        """Give the decoded response, when it is complete.
+        Its result is an empty list when the result array was streamed.
+        """
+        if self.state == AFTER_RESULT:
+            response = self.head + "[]" + "".join(self.tail)
+        elif self.state == IN_RESULT:
+            raise JSONStreamException("Response ended within the result array")
+        else:
+            response = self.buffer
+        try:
+            return json_codec.loads(response)
+        except Exception as exc:
+            raise JSONStreamException(
+                f"Error : not JSON response : {response}"
+            ) from exc
@@ -0,0 +1,179 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : logs scanner
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Logs scanner over large blocks ranges for pyWeb3"""
+
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from time import monotonic, sleep
+
+from .instrumentation import instrumentation, RETRIES
+from .json_rpc import JSONRPCexception
+from .rate_limit import RATE_LIMIT_HINTS
+
+
+DEFAULT_CHUNK_SIZE = 1000  # blocks
+MAX_CHUNK_SIZE = 100000  # blocks
+DEFAULT_WORKERS = 4
+# Grow the chunks when they give less logs
+SMALL_CHUNK_LOGS = 500
+
+# Errors of the nodes when the range is too large
+RANGE_ERROR_CODES = (-32005,)
+RANGE_ERROR_HINTS = (
+    "too many",
+    "more than",
+    "range",
+    "size exceeded",
+    "too large",
+    "timeout",
+    "timed out",
+)
+
+
+logger = getLogger(__name__)
+
+
+def is_range_error(exc):
+    """Tell if an error comes from a too large query, worth splitting."""
+    if isinstance(exc, JSONRPCexception):
+        error = exc.args[0] if exc.args else {}
+        if isinstance(error, dict):
+            if error.get("code") in RANGE_ERROR_CODES:
+                return True
+            message = str(error.get("message", ""))
+        else:
+            message = str(error)
+    else:
+        message = str(exc)
+    message = message.lower()
+    if any(hint in message for hint in RATE_LIMIT_HINTS):
+        return False
+    return any(hint in message for hint in RANGE_ERROR_HINTS)
+
+
+def block_number(block):
+    """Give a block number as integer, from an integer or a 0x hex string."""
+    if isinstance(block, str):
+        return int(block, 16)
+    return block
+
+
+class ScanCheckpoint:
+    """Progress of a logs scan : all the logs before next_block were given.
+    The logs of next_block may be given again when resuming.
+    """
+
+    def __init__(self, next_block=None):
+        self.next_block = next_block
+
+
+class LogScanner:
+    """Scan the logs over a blocks range, in chunks queried concurrently.
+    A chunk is split in halves when the node reports too many results or
+    a timeout, and the chunks grow when they give few logs. The other
+    errors are retried as the client retry policy tells.
+    The logs are given in blocks order.
+    """
+
+    def __init__(
+        self,
+        jsonrpc,
+        log_filter,
+        from_block,
+        to_block,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        workers=DEFAULT_WORKERS,
+        checkpoint=None,
+    ):
+        self.jsonrpc = jsonrpc
+        self.log_filter = {
+            key: value
+            for key, value in log_filter.items()
+            if key not in ("fromBlock", "toBlock", "blockHash")
+        }
+        self.to_block = block_number(to_block)
+        if checkpoint is None:
+            checkpoint = ScanCheckpoint()
+        if checkpoint.next_block is None:
+            checkpoint.next_block = block_number(from_block)
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def get_logs(self, start, end):
+        """Query the logs of blocks start to end, split when too large."""
+        params = dict(self.log_filter, fromBlock=hex(start), toBlock=hex(end))
+        deadline = self.jsonrpc.make_deadline()
+        first_try = monotonic()
+        nret = 0
+        while True:
+            try:
+                return self.jsonrpc.query("eth_getLogs", [params], deadline=deadline)
+            except Exception as exc:
+                if is_range_error(exc) and end > start:
+                    break
+                delay = self.jsonrpc.retry_policy.delay(
+                    nret, exc, monotonic() - first_try
+                )
+                if delay is None or (
+                    deadline is not None and monotonic() + delay >= deadline
+                ):
+                    raise
+                nret += 1
+                logger.log(
+                    5, "Retry %i of logs of blocks %i-%i : %s", nret, start, end, exc
+                )
+                if instrumentation.enabled:
+                    instrumentation.count(RETRIES)
+                sleep(delay)
+        middle = (start + end) // 2
+        logger.debug("Splitting logs query of blocks %i-%i", start, end)
+        self.chunk_size = max(1, min(self.chunk_size, middle - start + 1))
+        return self.get_logs(start, middle) + self.get_logs(middle + 1, end)
+
+    def adapt_chunk_size(self, start, end, logs_count):
+        """Grow the chunks when the last one, not split, gave few logs."""
+        if logs_count < SMALL_CHUNK_LOGS and end - start + 1 == self.chunk_size:
+            self.chunk_size = min(self.chunk_size * 2, MAX_CHUNK_SIZE)
+
+    def __iter__(self):
+        """Give the logs, in blocks order."""
+        next_start = self.checkpoint.next_block
+        executor = ThreadPoolExecutor(self.workers)
+        chunks = deque()
+        try:
+            while chunks or next_start <= self.to_block:
+                while len(chunks) < self.workers and next_start <= self.to_block:
+                    end = min(next_start + self.chunk_size - 1, self.to_block)
+                    future = executor.submit(self.get_logs, next_start, end)
+                    chunks.append((next_start, end, future))
+                    next_start = end + 1
+                start, end, future = chunks.popleft()
+                logs = future.result()
+                self.adapt_chunk_size(start, end, len(logs))
+                for log in logs:
+                    self.checkpoint.next_block = max(
+                        self.checkpoint.next_block, block_number(log["blockNumber"])
+                    )
+                    yield log
+                self.checkpoint.next_block = end + 1
+        finally:
+            for _, _, future in chunks:
+                future.cancel()
+            executor.shutdown(wait=False)
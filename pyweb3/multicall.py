@@ -0,0 +1,143 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : Multicall3 aggregation
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Multicall3 aggregation of contracts calls for pyWeb3"""
+
+
+from logging import getLogger
+
+
+# Multicall3, same address on all the chains where it is deployed
+MULTICALL3_ADDRESS = "0xca11bde05977b3631167028862be2a173976ca11"
+# aggregate3((address,bool,bytes)[])
+AGGREGATE3_SELECTOR = bytes.fromhex("82ad56cb")
+
+# Limits of an aggregate3 call, to stay within the node eth_call gas cap
+DEFAULT_MULTICALL_SIZE = 300  # calls
+MAX_CALLDATA_BYTES = 64 * 1024
+
+
+logger = getLogger(__name__)
+
+
+class MulticallException(Exception):
+    """Exception when an aggregate3 result can't be decoded."""
+
+
+# ---- Helpers about ABI encoding
+
+
+def encode_uint(value):
+    """ABI encoding of an integer, as uint256."""
+    return value.to_bytes(32, "big")
+
+
+def read_uint(data, offset):
+    """ABI decoding of an uint256 at the given offset."""
+    if offset + 32 > len(data):
+        raise MulticallException("aggregate3 result is too short")
+    return int.from_bytes(data[offset : offset + 32], "big")
+
+
+def encode_call3(target, call_data):
+    """ABI encoding of a Call3 tuple (address, bool, bytes), failure allowed."""
+    padding = b"\0" * (-len(call_data) % 32)
+    return (
+        bytes(12)
+        + bytes.fromhex(target[2:])
+        + encode_uint(1)
+        + encode_uint(96)
+        + encode_uint(len(call_data))
+        + call_data
+        + padding
+    )
+
+
+def call3_size(call_data):
+    """Size of an encoded Call3, with its offset."""
+    return 160 + len(call_data) + -len(call_data) % 32
+
+
+def encode_aggregate3(calls):
+    """Give the calldata of aggregate3 for (target, call_data) calls."""
+    tuples = [encode_call3(target, call_data) for target, call_data in calls]
+    head = encode_uint(32) + encode_uint(len(tuples))
+    offset = 32 * len(tuples)
+    for encoded_tuple in tuples:
+        head += encode_uint(offset)
+        offset += len(encoded_tuple)
+    return AGGREGATE3_SELECTOR + head + b"".join(tuples)
+
+
+def decode_aggregate3(data, calls_count):
+    """Decode the Result[] of aggregate3 : list of (success, 0x return data)."""
+    array_position = read_uint(data, 0)
+    if read_uint(data, array_position) != calls_count:
+        raise MulticallException("aggregate3 results count mismatch")
+    base = array_position + 32
+    results = []
+    for index in range(calls_count):
+        tuple_position = base + read_uint(data, base + 32 * index)
+        success = read_uint(data, tuple_position) != 0
+        bytes_position = tuple_position + read_uint(data, tuple_position + 32)
+        length = read_uint(data, bytes_position)
+        if bytes_position + 32 + length > len(data):
+            raise MulticallException("aggregate3 result is too short")
+        return_data = data[bytes_position + 32 : bytes_position + 32 + length]
+        results.append((success, "0x" + return_data.hex()))
+    return results
+
+
+def split_calls(calls, max_calls=DEFAULT_MULTICALL_SIZE):
+    """Split the calls in chunks, each one fitting an aggregate3 call."""
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    for call in calls:
+        size = call3_size(call[1])
+        full = len(chunk) >= max_calls or chunk_bytes + size > MAX_CALLDATA_BYTES
+        if chunk and full:
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(call)
+        chunk_bytes += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def call_result(raw_result):
+    """Give (success, 0x data) of an eth_call result, or its error.
+    The revert data is given when the node returns it.
+    """
+    if not isinstance(raw_result, Exception):
+        return True, raw_result
+    error = raw_result.args[0] if raw_result.args else {}
+    revert_data = error.get("data") if isinstance(error, dict) else None
+    if not isinstance(revert_data, str) or not revert_data.startswith("0x"):
+        revert_data = "0x"
+    return False, revert_data
+
+
+def eth_call_request(target, call_data, state):
+    """Give the (method, params) of the eth_call of a call."""
+    return ("eth_call", [{"to": target, "data": "0x" + call_data.hex()}, state])
+
+
+def aggregate3_request(calls, state):
+    """Give the (method, params) of the aggregate3 eth_call of calls."""
+    return eth_call_request(MULTICALL3_ADDRESS, encode_aggregate3(calls), state)
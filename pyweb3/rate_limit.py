@@ -0,0 +1,169 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : rate limiter
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Client-side rate limiter and adaptive concurrency for pyWeb3"""
+
+
+from logging import getLogger
+from threading import Condition
+from time import monotonic
+
+
+DEFAULT_MAX_CONCURRENCY = 64  # requests in flight
+DECREASE_FACTOR = 0.5  # of the concurrency limit, when throttled
+DECREASE_INTERVAL = 0.5  # seconds, a single decrease for simultaneous 429
+MAX_RETRY_AFTER = 60  # seconds
+
+# Errors of the nodes when the requests are throttled
+RATE_LIMIT_CODES = (429, -32007, -32029, -32090)
+RATE_LIMIT_HINTS = (
+    "rate limit",
+    "too many requests",
+    "request limit",
+    "exceeded its compute units",
+)
+
+
+logger = getLogger(__name__)
+
+
+class RateLimitException(Exception):
+    """Exception when a request can't be sent before its deadline."""
+
+
+def is_rate_limit_error(error):
+    """Tell if a JSON-RPC error object tells the requests are throttled."""
+    if not isinstance(error, dict):
+        return any(hint in str(error).lower() for hint in RATE_LIMIT_HINTS)
+    if error.get("code") in RATE_LIMIT_CODES:
+        return True
+    message = str(error.get("message", "")).lower()
+    return any(hint in message for hint in RATE_LIMIT_HINTS)
+
+
+def is_rate_limited(resp_obj):
+    """Tell if a decoded JSON-RPC response, or batch, is throttled."""
+    if isinstance(resp_obj, list):
+        return any(is_rate_limited(item) for item in resp_obj)
+    return (
+        isinstance(resp_obj, dict)
+        and "error" in resp_obj
+        and is_rate_limit_error(resp_obj["error"])
+    )
+
+
+class RateLimiter:
+    """Token bucket of rate units per second, and adaptive concurrency.
+    Each method costs its weight in units (compute units), 1 by default.
+    The number of requests in flight is limited with AIMD : +1 per
+    limit successful requests, and halved when the node throttles. After
+    a Retry-After, no request is sent until this delay expires.
+    Shared by all the threads using a client.
+    """
+
+    def __init__(
+        self,
+        rate=None,
+        burst=None,
+        weights=None,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        min_concurrency=1,
+    ):
+        self.rate = rate
+        if burst is None:
+            burst = max(rate or 1, 1)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.weights = weights or {}
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.inflight = 0
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.throttled = 0
+        self.condition = Condition()
+
+    def cost(self, method_names):
+        """Give the units cost of requests."""
+        return sum(self.weights.get(method_name, 1) for method_name in method_names)
+
+    def refill(self, now):
+        """Add the tokens earned since the last update."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now, cost):
+        """Give how long to wait before sending, None to wait for a slot."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.inflight >= int(self.limit):
+            return None
+        if self.rate:
+            self.refill(now)
+            needed = min(cost, self.burst)
+            if self.tokens < needed:
+                return (needed - self.tokens) / self.rate
+        return 0
+
+    def acquire(self, cost=1, deadline=None):
+        """Wait until a request of this cost can be sent."""
+        with self.condition:
+            while True:
+                now = monotonic()
+                wait = self.wait_time(now, cost)
+                if wait == 0:
+                    break
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        raise RateLimitException("Rate limit wait exceeds deadline")
+                    if wait is None:
+                        wait = remaining
+                self.condition.wait(wait)
+            if self.rate:
+                self.tokens -= cost
+            self.inflight += 1
+
+    def release(self, throttled=False, retry_after=None):
+        """Record the end of a request, and if the node throttled it."""
+        with self.condition:
+            self.inflight -= 1
+            now = monotonic()
+            if throttled:
+                self.throttled += 1
+                if now - self.last_decrease > DECREASE_INTERVAL:
+                    self.limit = max(
+                        self.min_concurrency, self.limit * DECREASE_FACTOR
+                    )
+                    self.last_decrease = now
+                    logger.debug("Throttled, concurrency limit %i", self.limit)
+                if retry_after:
+                    self.paused_until = max(
+                        self.paused_until, now + min(retry_after, MAX_RETRY_AFTER)
+                    )
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def stats(self):
+        """Give the limiter state."""
+        return {
+            "concurrency_limit": int(self.limit),
+            "inflight": self.inflight,
+            "throttled": self.throttled,
+        }
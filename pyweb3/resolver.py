@@ -0,0 +1,112 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : DNS cache
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""DNS cache for pyWeb3"""
+
+
+from logging import getLogger
+from socket import getaddrinfo, AF_INET6, SOCK_STREAM, IPPROTO_TCP
+from threading import Lock
+from time import monotonic
+
+from .instrumentation import instrumentation, DNS_CACHE_HITS, PHASE_DNS
+
+
+# getaddrinfo doesn't give the records TTL, they are kept this time
+DNS_CACHE_TTL = 60  # seconds
+
+
+logger = getLogger(__name__)
+
+
+def interleave_families(addresses):
+    """Order the addresses alternating IPv6 and IPv4 (RFC 8305), starting
+    with the family of the first address, the system preference.
+    """
+    if not addresses:
+        return addresses
+    first_family = addresses[0][0]
+    preferred = [address for address in addresses if address[0] == first_family]
+    others = [address for address in addresses if address[0] != first_family]
+    ordered = []
+    for index in range(max(len(preferred), len(others))):
+        ordered.extend(preferred[index : index + 1])
+        ordered.extend(others[index : index + 1])
+    return ordered
+
+
+class DNSCache:
+    """Resolved addresses of the hosts, kept ttl seconds.
+    Shared by all the clients, thread-safe.
+    """
+
+    def __init__(self, ttl=DNS_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.lookups = 0
+
+    def resolve(self, domain, port):
+        """Give the addresses of a host, as getaddrinfo, in the order to try
+        them : IPv6 and IPv4 alternated.
+        """
+        key = (domain, port)
+        now = monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                if instrumentation.enabled:
+                    instrumentation.count(DNS_CACHE_HITS)
+                return entry[1]
+            self.lookups += 1
+        logger.log(5, "Resolving %s", domain)
+        addresses = interleave_families(
+            getaddrinfo(domain, port, type=SOCK_STREAM, proto=IPPROTO_TCP)
+        )
+        if instrumentation.enabled:
+            instrumentation.phase(PHASE_DNS, monotonic() - now)
+        if not addresses:
+            raise OSError(f"No address for {domain}")
+        with self.lock:
+            self.entries[key] = (now + self.ttl, addresses)
+        logger.log(
+            5,
+            "%s resolved : %i addresses, %i IPv6",
+            domain,
+            len(addresses),
+            sum(1 for address in addresses if address[0] == AF_INET6),
+        )
+        return addresses
+
+    def forget(self, domain, port):
+        """Remove a host, when none of its addresses can be connected."""
+        with self.lock:
+            self.entries.pop((domain, port), None)
+
+    def clear(self):
+        """Remove all the hosts."""
+        with self.lock:
+            self.entries = {}
+
+    def stats(self):
+        """Give the cache counters."""
+        return {"hits": self.hits, "lookups": self.lookups}
+
+
+# Cache of all the clients
+dns_cache = DNSCache()
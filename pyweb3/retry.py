@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : retry policy
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Retry policy of the failed requests for pyWeb3"""
+
+
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from random import uniform
+
+from .http_client import HttpClientException, HttpRateLimited, HttpResponseError
+from .rate_limit import RateLimitException, is_rate_limit_error
+from .websocket import WebSocketClientException
+
+
+DEFAULT_RETRIES = 2
+BASE_DELAY = 0.5  # seconds, doubled at each retry
+MAX_DELAY = 8  # seconds
+MAX_RETRY_TIME = 30  # seconds, for all the tries
+
+# Errors classes
+TRANSPORT_ERROR = "transport"
+RATE_LIMIT_ERROR = "rate-limit"
+NODE_ERROR = "node-internal"
+EXECUTION_ERROR = "execution"
+
+# Methods which change the chain state, they may be done even after an error
+NON_IDEMPOTENT_METHODS = ("eth_sendRawTransaction", "eth_sendTransaction")
+
+# JSON-RPC errors which give the same result when the request is sent again
+EXECUTION_ERROR_CODES = (3, -32700, -32600, -32601, -32602)
+EXECUTION_ERROR_HINTS = (
+    "revert",
+    "invalid",
+    "insufficient funds",
+    "nonce too low",
+    "already known",
+    "gas required exceeds",
+    "intrinsic gas too low",
+    "underpriced",
+    "out of gas",
+    "not supported",
+)
+
+
+def is_idempotent(method_names):
+    """Tell if requests can be sent twice, without changing the result."""
+    return not any(
+        method_name in NON_IDEMPOTENT_METHODS for method_name in method_names
+    )
+
+
+def error_class(exc):
+    """Give the class of an error : transport, rate-limit, node-internal,
+    or execution, a deterministic error of the request.
+    """
+    if isinstance(exc, HttpRateLimited):
+        return RATE_LIMIT_ERROR
+    if isinstance(exc, HttpResponseError):
+        return NODE_ERROR if exc.status_code >= 500 else EXECUTION_ERROR
+    if isinstance(exc, RateLimitException):
+        # No more time to wait for the rate limiter
+        return EXECUTION_ERROR
+    if isinstance(
+        exc,
+        (HttpClientException, WebSocketClientException, OSError, FutureTimeoutError),
+    ):
+        return TRANSPORT_ERROR
+    error = exc.args[0] if exc.args else None
+    if isinstance(error, dict) and "code" in error:
+        # JSON-RPC error object, of a JSONRPCexception
+        if is_rate_limit_error(error):
+            return RATE_LIMIT_ERROR
+        message = str(error.get("message", "")).lower()
+        if error["code"] in EXECUTION_ERROR_CODES or any(
+            hint in message for hint in EXECUTION_ERROR_HINTS
+        ):
+            return EXECUTION_ERROR
+    return NODE_ERROR
+
+
+class RetryPolicy:
+    """Which failed requests are retried, and when.
+    The transport, rate limit and node internal errors are retried after an
+    exponential backoff with full jitter, up to retries times and within
+    max_time seconds. The execution errors, such as a revert, are not
+    retried. A non-idempotent request, such as a transaction push, is only
+    retried when throttled : after a transport error, it may have been done.
+    """
+
+    def __init__(
+        self,
+        retries=DEFAULT_RETRIES,
+        base_delay=BASE_DELAY,
+        max_delay=MAX_DELAY,
+        max_time=MAX_RETRY_TIME,
+        retried_errors=(TRANSPORT_ERROR, RATE_LIMIT_ERROR, NODE_ERROR),
+    ):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_time = max_time
+        self.retried_errors = retried_errors
+
+    def delay(self, attempt, exc, elapsed, idempotent=True):
+        """Give the delay before retrying a request after the error exc,
+        or None when it must not be retried.
+        attempt : number of retries already done.
+        elapsed : time since the first try.
+        """
+        if attempt >= self.retries:
+            return None
+        kind = error_class(exc)
+        if kind not in self.retried_errors:
+            return None
+        if not idempotent and kind != RATE_LIMIT_ERROR:
+            return None
+        delay = uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if kind == RATE_LIMIT_ERROR:
+            delay = max(delay, getattr(exc, "retry_after", None) or 0)
+        if elapsed + delay > self.max_time:
+            return None
+        return delay
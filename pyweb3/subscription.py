@@ -0,0 +1,167 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : subscriptions
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""eth_subscribe notifications for pyWeb3"""
+
+
+from logging import getLogger
+from queue import Queue, Empty, Full
+
+
+DEFAULT_QUEUE_SIZE = 1000
+
+# Overflow policies, when the queue of notifications is full
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_ERROR = "error"
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_ERROR)
+
+# Marks the end of the notifications in the queue
+END_OF_NOTIFICATIONS = object()
+
+
+logger = getLogger(__name__)
+
+
+class SubscriptionException(Exception):
+    """Exception when a subscription is stopped by an error."""
+
+
+class Subscription:
+    """Notifications of an eth_subscribe, pushed by the node.
+    The notifications are given to the callback in the WebSocket reader
+    thread, or else queued in a bounded queue, read by iterating over the
+    subscription or with get. When the queue is full, the overflow policy
+    drops the oldest or the newest notification, or stops the subscription
+    with an error.
+    """
+
+    def __init__(
+        self,
+        jsonrpc,
+        kind,
+        params=None,
+        callback=None,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        overflow=OVERFLOW_DROP_OLDEST,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Overflow policy must be one of {OVERFLOW_POLICIES}")
+        self.jsonrpc = jsonrpc
+        self.kind = kind
+        self.params = params
+        self.callback = callback
+        self.overflow = overflow
+        self.queue = Queue(queue_size)
+        self.endpoint = None
+        self.subscription_id = None
+        self.dropped = 0
+        self.closed = False
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unsubscribe()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        notification = self.queue.get()
+        if notification is END_OF_NOTIFICATIONS:
+            # Let next readers also see the end
+            self.end_queue()
+            if self.error is not None:
+                raise self.error
+            raise StopIteration
+        return notification
+
+    def subscribe_params(self):
+        """Give the eth_subscribe parameters."""
+        if self.params is None:
+            return [self.kind]
+        return [self.kind, self.params]
+
+    def get(self, timeout=None):
+        """Wait for the next notification, at most timeout seconds.
+        Raise queue.Empty after timeout, StopIteration at the end.
+        """
+        notification = self.queue.get(timeout=timeout)
+        if notification is END_OF_NOTIFICATIONS:
+            self.end_queue()
+            if self.error is not None:
+                raise self.error
+            raise StopIteration
+        return notification
+
+    def push(self, notification):
+        """Give a notification received from the node."""
+        if self.closed:
+            return
+        if self.callback is not None:
+            try:
+                self.callback(notification)
+            except Exception as exc:
+                logger.error("Error in subscription callback : %s", exc, exc_info=exc)
+            return
+        try:
+            self.queue.put_nowait(notification)
+        except Full:
+            self.dropped += 1
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                self.drop_oldest()
+                self.queue.put_nowait(notification)
+            elif self.overflow == OVERFLOW_ERROR:
+                self.stop(SubscriptionException("Subscription queue overflow"))
+
+    def drop_oldest(self):
+        """Remove the oldest notification from the queue."""
+        try:
+            self.queue.get_nowait()
+        except Empty:
+            pass
+
+    def end_queue(self):
+        """Queue the end mark, making room for it when the queue is full."""
+        while True:
+            try:
+                self.queue.put_nowait(END_OF_NOTIFICATIONS)
+                return
+            except Full:
+                self.drop_oldest()
+
+    def stop(self, error=None):
+        """End the notifications, locally. Error is raised to the reader."""
+        if self.closed:
+            return
+        self.closed = True
+        self.error = error
+        self.end_queue()
+
+    def unsubscribe(self):
+        """Cancel the subscription on the node, and end the notifications."""
+        if self.closed:
+            return
+        self.stop()
+        self.endpoint.cnx.remove_subscription(self.subscription_id)
+        try:
+            self.jsonrpc.request(
+                "eth_unsubscribe", [self.subscription_id], self.endpoint
+            )
+        except Exception as exc:
+            logger.debug("Error when unsubscribing : %s", exc)
@@ -1,66 +1,373 @@
-# -*- coding: utf8 -*-
-
-# pyWeb3 : TLS socket
-# Copyright (C) 2021-2022 BitLogiK
-
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, version 3 of the License.
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-# You should have receive a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>
-
-
-"""TLS socket for pyWeb3"""
-
-from logging import getLogger
-from ssl import create_default_context
-from socket import socket
-
-
-RECEIVING_BUFFER_SIZE = 8192
-
-
-logger = getLogger(__name__)
-
-
-class TLSsocket:
-    """TLS socket client with a host, push and read data."""
-
-    def __init__(self, domain, port):
-        """Open a TLS connection with a host domain:port."""
-        context = create_default_context()
-        self.conn = context.wrap_socket(socket(), server_hostname=domain)
-        self.conn.connect((domain, port))
-        logger.log(5, "Socket connected")
-        self.conn.settimeout(8)
-
-    def __del__(self):
-        """Close the socket when deleting the object."""
-        self.close()
-
-    def close(self):
-        """Close the socket."""
-        if hasattr(self, "conn"):
-            if self.conn is not None:
-                logger.log(5, "Closing socket")
-                self.conn.close()
-                self.conn = None
-
-    def send(self, data_buffer):
-        """Send data to the host."""
-        self.conn.sendall(data_buffer)
-
-    def receive(self):
-        """Read data from the host.
-        Blocking reception.
-        If no data received after timeout : throw exception
-        """
-        datar = self.conn.recv(RECEIVING_BUFFER_SIZE)
-        if datar == b"":
-            logger.debug("Socket disconnected")
-            self.close()
-        return datar
+# -*- coding: utf8 -*-
+
+# pyWeb3 : TLS socket
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""TLS socket for pyWeb3"""
+
+from errno import EINPROGRESS, EWOULDBLOCK, EAGAIN
+from logging import getLogger
+from os import strerror
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+from ssl import create_default_context
+from socket import (
+    socket,
+    timeout as socket_timeout,
+    IPPROTO_TCP,
+    SOL_SOCKET,
+    SO_ERROR,
+    SO_KEEPALIVE,
+    SO_RCVBUF,
+    TCP_NODELAY,
+)
+import socket as socket_module
+from threading import Lock
+from time import monotonic
+
+from .instrumentation import (
+    instrumentation,
+    BYTES_IN,
+    BYTES_OUT,
+    PHASE_CONNECT,
+    PHASE_TLS,
+    TLS_RESUMED,
+)
+from .resolver import dns_cache
+
+
+# A TLS read gives at most a record of 16 kB
+RECEIVING_BUFFER_SIZE = 16384
+SOCKET_TIMEOUT = 8  # seconds, for each socket operation
+CONNECT_TIMEOUT = 4  # seconds, for the TCP connection
+CONNECTION_ATTEMPT_DELAY = 0.25  # seconds, before trying the next address
+KEEPALIVE_PROBES_INTERVAL = 10  # seconds
+
+# connect_ex results of a connection in progress, 10035 on Windows
+CONNECT_IN_PROGRESS = (EINPROGRESS, EWOULDBLOCK, EAGAIN, 10035)
+
+
+logger = getLogger(__name__)
+
+
+def time_left(deadline):
+    """Give the timeout of a socket operation, to end before the deadline.
+    At most SOCKET_TIMEOUT, raise socket.timeout when the deadline passed.
+    """
+    if deadline is None:
+        return SOCKET_TIMEOUT
+    remaining = deadline - monotonic()
+    if remaining <= 0:
+        raise socket_timeout("Deadline exceeded")
+    return min(remaining, SOCKET_TIMEOUT)
+
+
+class SocketOptions:
+    """Options of the TCP sockets of a client.
+    buffer_size : size of the reception buffer, reused for each read.
+    nodelay : send the requests at once, without the Nagle algorithm delay.
+    rcvbuf : size of the system receive buffer, system default when None.
+    keepalive : idle seconds before the TCP keep-alive probes, or None.
+    connect_timeout : seconds to connect, for all the host addresses.
+    """
+
+    def __init__(
+        self,
+        buffer_size=RECEIVING_BUFFER_SIZE,
+        nodelay=True,
+        rcvbuf=None,
+        keepalive=None,
+        connect_timeout=CONNECT_TIMEOUT,
+    ):
+        self.buffer_size = buffer_size
+        self.nodelay = nodelay
+        self.rcvbuf = rcvbuf
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+
+    def apply(self, sock):
+        """Set the options of a socket, before it is connected."""
+        if self.nodelay:
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        if self.rcvbuf:
+            sock.setsockopt(SOL_SOCKET, SO_RCVBUF, self.rcvbuf)
+        if self.keepalive is not None:
+            sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+            if hasattr(socket_module, "TCP_KEEPIDLE"):
+                sock.setsockopt(IPPROTO_TCP, socket_module.TCP_KEEPIDLE, self.keepalive)
+                sock.setsockopt(
+                    IPPROTO_TCP, socket_module.TCP_KEEPINTVL, KEEPALIVE_PROBES_INTERVAL
+                )
+            elif hasattr(socket_module, "TCP_KEEPALIVE"):
+                # macOS
+                sock.setsockopt(
+                    IPPROTO_TCP, socket_module.TCP_KEEPALIVE, self.keepalive
+                )
+
+
+DEFAULT_SOCKET_OPTIONS = SocketOptions()
+
+
+def start_connection(address, options):
+    """Start a non-blocking TCP connection to an address of getaddrinfo.
+    Return the socket, and if it is already connected.
+    """
+    family, sock_type, proto, _, sockaddr = address
+    sock = socket(family, sock_type, proto)
+    try:
+        options.apply(sock)
+        sock.setblocking(False)
+        error = sock.connect_ex(sockaddr)
+    except OSError:
+        sock.close()
+        raise
+    if error == 0:
+        return sock, True
+    if error in CONNECT_IN_PROGRESS:
+        return sock, False
+    sock.close()
+    raise OSError(error, strerror(error))
+
+
+def happy_eyeballs_connect(addresses, timeout, options):
+    """Connect to the first address which accepts (RFC 8305).
+    A connection attempt starts every CONNECTION_ATTEMPT_DELAY, or as soon
+    as the previous ones failed. The other attempts are then cancelled.
+    Return the connected socket, in blocking mode.
+    """
+    end = monotonic() + timeout
+    next_addresses = list(addresses)
+    attempts = {}
+    last_error = None
+    connected = None
+    next_attempt = 0
+    with DefaultSelector() as selector:
+        try:
+            while connected is None:
+                now = monotonic()
+                if next_addresses and (not attempts or now >= next_attempt):
+                    address = next_addresses.pop(0)
+                    logger.log(5, "Connecting to %s", address[4])
+                    try:
+                        sock, done = start_connection(address, options)
+                    except OSError as exc:
+                        last_error = exc
+                        continue
+                    if done:
+                        connected = sock
+                        break
+                    attempts[sock] = address
+                    selector.register(sock, EVENT_WRITE)
+                    next_attempt = now + CONNECTION_ATTEMPT_DELAY
+                if not attempts:
+                    if next_addresses:
+                        continue
+                    raise last_error or OSError("No address to connect")
+                if now >= end:
+                    raise socket_timeout("Connection timeout")
+                wait = end - now
+                if next_addresses:
+                    wait = min(wait, max(next_attempt - now, 0))
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    address = attempts.pop(sock)
+                    error = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+                    if error == 0:
+                        connected = sock
+                        break
+                    logger.log(5, "Connection to %s failed", address[4])
+                    last_error = OSError(error, strerror(error))
+                    sock.close()
+                    # Try the next address at once
+                    next_attempt = 0
+        finally:
+            for sock in attempts:
+                sock.close()
+    connected.setblocking(True)
+    return connected
+
+
+class Connector:
+    """Settings and state shared by the TLS connections of a client : the
+    socket options, and a single SSL context. The last TLS session of each
+    host is kept, to resume it with an abbreviated handshake when connecting
+    again.
+    """
+
+    def __init__(self, socket_options=None, ssl_context=None, resolver=dns_cache):
+        if socket_options is None:
+            socket_options = DEFAULT_SOCKET_OPTIONS
+        self.socket_options = socket_options
+        self.resolver = resolver
+        if ssl_context is None:
+            ssl_context = create_default_context()
+        self.ssl_context = ssl_context
+        self.sessions = {}
+        self.lock = Lock()
+        self.handshakes = 0
+        self.resumed = 0
+
+    def open_socket(self, domain, port, deadline=None):
+        """Connect a TCP socket to a host, with its cached addresses.
+        The connection takes at most the connect timeout, within the deadline.
+        """
+        addresses = self.resolver.resolve(domain, port)
+        timeout = self.socket_options.connect_timeout
+        if deadline is not None:
+            timeout = min(timeout, time_left(deadline))
+        start = monotonic()
+        try:
+            connected_socket = happy_eyeballs_connect(
+                addresses, timeout, self.socket_options
+            )
+        except OSError:
+            # Maybe the host addresses changed
+            self.resolver.forget(domain, port)
+            raise
+        if instrumentation.enabled:
+            instrumentation.phase(PHASE_CONNECT, monotonic() - start)
+        return connected_socket
+
+    def session(self, domain, port):
+        """Give the TLS session to resume with a host, or None."""
+        with self.lock:
+            return self.sessions.get((domain, port))
+
+    def save_session(self, domain, port, session):
+        """Keep the TLS session of a host, for its next connections."""
+        with self.lock:
+            self.sessions[(domain, port)] = session
+
+    def record_handshake(self, resumed):
+        """Count a TLS handshake, and if it resumed a session."""
+        with self.lock:
+            self.handshakes += 1
+            if resumed:
+                self.resumed += 1
+
+    def stats(self):
+        """Give the TLS handshakes counters."""
+        return {"handshakes": self.handshakes, "resumed": self.resumed}
+
+
+class TLSsocket:
+    """TLS socket client with a host, push and read data.
+    The data is read in a buffer reused for all the readings.
+    """
+
+    def __init__(self, domain, port, deadline=None, connector=None):
+        """Open a TLS connection with a host domain:port."""
+        if connector is None:
+            connector = Connector()
+        self.connector = connector
+        self.host = (domain, port)
+        self.buffer = bytearray(connector.socket_options.buffer_size)
+        self.buffer_view = memoryview(self.buffer)
+        raw_socket = connector.open_socket(domain, port, deadline)
+        start = monotonic()
+        try:
+            raw_socket.settimeout(time_left(deadline))
+            # TLS handshake
+            self.conn = connector.ssl_context.wrap_socket(
+                raw_socket,
+                server_hostname=domain,
+                session=connector.session(domain, port),
+            )
+        except Exception:
+            raw_socket.close()
+            raise
+        logger.log(5, "Socket connected, session reused : %s", self.conn.session_reused)
+        connector.record_handshake(self.conn.session_reused)
+        if instrumentation.enabled:
+            instrumentation.phase(PHASE_TLS, monotonic() - start)
+            if self.conn.session_reused:
+                instrumentation.count(TLS_RESUMED)
+        self.session_saved = False
+        self.save_session()
+        self.conn.settimeout(SOCKET_TIMEOUT)
+
+    def save_session(self):
+        """Give the TLS session to the connector, once it can be resumed.
+        With TLS 1.3, its ticket is received after the handshake.
+        """
+        session = self.conn.session
+        if session is None:
+            return
+        if self.conn.version() == "TLSv1.3" and not session.has_ticket:
+            return
+        self.connector.save_session(*self.host, session)
+        self.session_saved = True
+
+    def __del__(self):
+        """Close the socket when deleting the object."""
+        self.close()
+
+    def close(self):
+        """Close the socket."""
+        if hasattr(self, "conn"):
+            if self.conn is not None:
+                logger.log(5, "Closing socket")
+                self.conn.close()
+                self.conn = None
+
+    def set_deadline(self, deadline):
+        """Bound the next socket operations to end before the deadline,
+        or to SOCKET_TIMEOUT without deadline.
+        """
+        timeout = time_left(deadline)
+        if timeout != self.conn.gettimeout():
+            self.conn.settimeout(timeout)
+
+    def send(self, data_buffer):
+        """Send data to the host."""
+        self.conn.sendall(data_buffer)
+        if instrumentation.enabled:
+            instrumentation.count(BYTES_OUT, len(data_buffer))
+
+    def send_parts(self, parts):
+        """Send the parts of a message to the host, joined once.
+        A TLS socket can't gather them with sendmsg.
+        """
+        data_buffer = b"".join(parts)
+        self.conn.sendall(data_buffer)
+        if instrumentation.enabled:
+            instrumentation.count(BYTES_OUT, len(data_buffer))
+
+    def wait_readable(self, timeout):
+        """Wait until data is available to read, at most timeout seconds.
+        Return True when data can be read.
+        """
+        if self.conn.pending():
+            # Already decrypted data in the TLS buffer
+            return True
+        with DefaultSelector() as selector:
+            selector.register(self.conn, EVENT_READ)
+            return bool(selector.select(timeout))
+
+    def receive(self):
+        """Read data from the host.
+        Blocking reception.
+        If no data received after timeout : throw exception
+        The data is given as a view of the reception buffer, valid until
+        the next reception.
+        """
+        size = self.conn.recv_into(self.buffer)
+        if not self.session_saved and size:
+            self.save_session()
+        if size == 0:
+            logger.debug("Socket disconnected")
+            self.close()
+        elif instrumentation.enabled:
+            instrumentation.count(BYTES_IN, size)
+        return self.buffer_view[:size]
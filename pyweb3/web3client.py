@@ -1,76 +1,386 @@
-# -*- coding: utf8 -*-
-
-# pyWeb3 : Web3 client
-# Copyright (C) 2021-2022 BitLogiK
-
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, version 3 of the License.
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-# You should have receive a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>
-
-
-"""Web3 RPC client"""
-
-
-from .json_rpc import JSONRPCclient
-
-
-class Web3Client:
-    """Web3 RPC client"""
-
-    def __init__(self, node_url, user_agent=None, retries=2):
-        self.jsonrpc = JSONRPCclient(node_url, user_agent, retries)
-
-    def get_balance(self, address, state="latest"):
-        """Get native token balance"""
-        balraw = self.jsonrpc.request("eth_getBalance", [address, state])
-        if balraw and len(balraw) >= 2 and balraw[:2] == "0x":
-            return int(balraw[2:], 16)
-        return 0
-
-    def call(self, contract, command_code, data="", state="latest"):
-        """eth call query"""
-        # https://eth.wiki/json-rpc/API#eth_call
-        # The following state options are possible :
-        #   HEX String - an integer block number
-        #   String "earliest" for the earliest/genesis block
-        #   String "latest" for the latest mined block
-        #   String "pending" for the pending state/transactions
-        datab = f"0x{command_code}{data}"
-        return self.jsonrpc.request(
-            "eth_call", [{"to": contract, "data": datab}, state]
-        )
-
-    def pushtx(self, txhex):
-        """Upload a transaction"""
-        return self.jsonrpc.request("eth_sendRawTransaction", ["0x" + txhex])
-
-    def get_tx_num(self, addr, state="latest"):
-        """Read number of transaction done by this address"""
-        tx_count_raw = self.jsonrpc.request(
-            "eth_getTransactionCount", ["0x" + addr, state]
-        )
-        if tx_count_raw and len(tx_count_raw) >= 2 and tx_count_raw[:2] == "0x":
-            return int(tx_count_raw[2:], 16)
-        raise Exception("Bad data when reading getTransactionCount")
-
-    def get_gasprice(self):
-        """Get the gas price in wei units"""
-        gas_price_raw = self.jsonrpc.request("eth_gasPrice")
-        if gas_price_raw and len(gas_price_raw) >= 2 and gas_price_raw[:2] == "0x":
-            return int(gas_price_raw[2:], 16)
-        raise Exception("Bad data when reading gasPrice")
-
-    def get_logs(self, param):
-        return self.jsonrpc.request("eth_getLogs", [param])
-
-    def set_filter(self, param):
-        return self.jsonrpc.request("eth_newFilter", [param])
-
-    def get_filter(self, filter_id):
-        return self.jsonrpc.request("eth_getFilterLogs", [filter_id])
+# -*- coding: utf8 -*-
+
+# pyWeb3 : Web3 client
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""Web3 RPC client"""
+
+
+from logging import getLogger
+
+from .accounts import AccountFetcher, DEFAULT_ACCOUNTS_CHUNK
+from .cache import ResponseCache
+from .json_rpc import JSONRPCclient, DEFAULT_BATCH_SIZE, DEFAULT_MAX_INFLIGHT
+from .log_scanner import LogScanner, DEFAULT_CHUNK_SIZE, DEFAULT_WORKERS
+from .multicall import (
+    MULTICALL3_ADDRESS,
+    DEFAULT_MULTICALL_SIZE,
+    aggregate3_request,
+    call_result,
+    decode_aggregate3,
+    eth_call_request,
+    split_calls,
+)
+from .subscription import Subscription, DEFAULT_QUEUE_SIZE, OVERFLOW_DROP_OLDEST
+
+
+logger = getLogger(__name__)
+
+
+# ---- Helpers about results decoding
+
+
+def decode_balance(balraw):
+    """Decode a balance hex value, 0 in case of bad data."""
+    if balraw and len(balraw) >= 2 and balraw[:2] == "0x":
+        return int(balraw[2:], 16)
+    return 0
+
+
+def hex_decoder(value_name):
+    """Build a decoder of a 0x hex integer, which checks data."""
+
+    def decode_hex(raw_value):
+        if raw_value and len(raw_value) >= 2 and raw_value[:2] == "0x":
+            return int(raw_value[2:], 16)
+        raise Exception(f"Bad data when reading {value_name}")
+
+    return decode_hex
+
+
+class Web3Methods:
+    """Web3 RPC methods, built on the query method of the subclass :
+    query(method_name, params=None, decoder=None) sends a RPC query, and
+    decodes its result with the decoder.
+    """
+
+    def get_balance(self, address, state="latest"):
+        """Get native token balance"""
+        return self.query("eth_getBalance", [address, state], decode_balance)
+
+    def call(self, contract, command_code, data="", state="latest"):
+        """eth call query"""
+        # https://eth.wiki/json-rpc/API#eth_call
+        # The following state options are possible :
+        #   HEX String - an integer block number
+        #   String "earliest" for the earliest/genesis block
+        #   String "latest" for the latest mined block
+        #   String "pending" for the pending state/transactions
+        datab = f"0x{command_code}{data}"
+        return self.query("eth_call", [{"to": contract, "data": datab}, state])
+
+    def pushtx(self, txhex):
+        """Upload a transaction"""
+        return self.query("eth_sendRawTransaction", ["0x" + txhex])
+
+    def get_tx_num(self, addr, state="latest"):
+        """Read number of transaction done by this address"""
+        return self.query(
+            "eth_getTransactionCount",
+            ["0x" + addr, state],
+            hex_decoder("getTransactionCount"),
+        )
+
+    def get_gasprice(self):
+        """Get the gas price in wei units"""
+        return self.query("eth_gasPrice", None, hex_decoder("gasPrice"))
+
+    def get_block_number(self):
+        """Get the number of the latest block"""
+        return self.query("eth_blockNumber", None, hex_decoder("blockNumber"))
+
+    def get_logs(self, param):
+        return self.query("eth_getLogs", [param])
+
+    def set_filter(self, param):
+        return self.query("eth_newFilter", [param])
+
+    def get_filter(self, filter_id):
+        return self.query("eth_getFilterLogs", [filter_id])
+
+
+class Web3Client(Web3Methods):
+    """Web3 RPC client, which can be shared by many threads."""
+
+    def __init__(
+        self,
+        node_url,
+        user_agent=None,
+        retries=2,
+        batch_size=DEFAULT_BATCH_SIZE,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        cache=None,
+        timeout=None,
+        hedge=False,
+        coalesce=False,
+        batch_window=None,
+        rate_limit=None,
+        socket_options=None,
+        ssl_context=None,
+        pool_size=None,
+        compression=True,
+    ):
+        if cache is True:
+            cache = ResponseCache()
+        self.cache = cache
+        self.multicall_available = None
+        self.jsonrpc = JSONRPCclient(
+            node_url,
+            user_agent,
+            retries,
+            batch_size,
+            max_inflight,
+            cache,
+            timeout,
+            hedge,
+            coalesce,
+            batch_window,
+            rate_limit,
+            socket_options,
+            ssl_context,
+            pool_size,
+            compression,
+        )
+        if cache is not None and any(
+            endpoint.multiplexed for endpoint in self.jsonrpc.endpoints
+        ):
+            self.follow_new_heads(cache)
+
+    def follow_new_heads(self, cache):
+        """Invalidate the latest state results of the cache at each new block."""
+        try:
+            self.subscribe("newHeads", callback=cache.invalidate_latest)
+        except Exception as exc:
+            logger.debug("Cache can't follow new blocks : %s", exc)
+
+    def query(self, method_name, params=None, decoder=None, timeout=None):
+        """Send a RPC query, and decode its result with the decoder.
+        timeout in seconds bounds the query and its retries.
+        """
+        result = self.jsonrpc.request(method_name, params, timeout=timeout)
+        if decoder is None:
+            return result
+        return decoder(result)
+
+    def request_many(self, requests):
+        """Send a list of (method_name, params) RPC queries in batches.
+        Return the list of the raw results, in the requests order.
+        A query in error gives a JSONRPCexception in place of its result.
+        """
+        return self.jsonrpc.request_many(requests)
+
+    def batch(self):
+        """Open a batch of queries, to be used as a context manager."""
+        return Web3Batch(self)
+
+    def stream(self, method_name, params=None, timeout=None):
+        """Generator of the items of a large result array, such as logs or
+        traces, decoded as the response is received over HTTPS.
+        """
+        return self.jsonrpc.stream_request(method_name, params, timeout)
+
+    def stream_logs(self, log_filter, timeout=None):
+        """Generator of the logs of an eth_getLogs query, as received."""
+        return self.stream("eth_getLogs", [log_filter], timeout)
+
+    def has_multicall(self):
+        """Tell if the Multicall3 contract is deployed on the chain."""
+        if self.multicall_available is None:
+            code = self.query("eth_getCode", [MULTICALL3_ADDRESS, "latest"])
+            self.multicall_available = code not in (None, "0x", "0x0")
+        return self.multicall_available
+
+    def multicall(self, calls, state="latest", max_calls=DEFAULT_MULTICALL_SIZE):
+        """Read many contracts with a few Multicall3 aggregate3 eth_call.
+        calls : list of (contract, command_code, [data]), hex as for call.
+        Return the list of (success, 0x return data), in the calls order.
+        Without Multicall3 on the chain, the calls are sent in JSON-RPC
+        batches instead.
+        """
+        calls = [
+            (call[0], bytes.fromhex(call[1] + (call[2] if len(call) > 2 else "")))
+            for call in calls
+        ]
+        if not calls:
+            return []
+        if not self.has_multicall():
+            return self.call_many(calls, state)
+        chunks = split_calls(calls, max_calls)
+        raw_results = self.request_many(
+            [aggregate3_request(chunk, state) for chunk in chunks]
+        )
+        results = []
+        for chunk, raw_result in zip(chunks, raw_results):
+            try:
+                if isinstance(raw_result, Exception):
+                    raise raw_result
+                results.extend(
+                    decode_aggregate3(bytes.fromhex(raw_result[2:]), len(chunk))
+                )
+            except Exception as exc:
+                # Such as a block before the Multicall3 deployment
+                logger.debug("Multicall failed, sending a batch : %s", exc)
+                results.extend(self.call_many(chunk, state))
+        return results
+
+    def call_many(self, calls, state):
+        """Send (contract, call_data) eth_call in JSON-RPC batches.
+        Return the list of (success, 0x return data).
+        """
+        raw_results = self.request_many(
+            [eth_call_request(target, call_data, state) for target, call_data in calls]
+        )
+        return [call_result(raw_result) for raw_result in raw_results]
+
+    def scan_logs(
+        self,
+        log_filter,
+        from_block,
+        to_block="latest",
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        workers=DEFAULT_WORKERS,
+        checkpoint=None,
+    ):
+        """Generator of the logs over a large blocks range, in blocks order.
+        The range is queried in chunks, concurrently.
+        The checkpoint (ScanCheckpoint) records the progress, to resume.
+        """
+        if to_block == "latest":
+            to_block = self.get_block_number()
+        yield from LogScanner(
+            self.jsonrpc,
+            log_filter,
+            from_block,
+            to_block,
+            chunk_size,
+            workers,
+            checkpoint,
+        )
+
+    def fetch_accounts(
+        self,
+        addresses,
+        fields=("balance", "nonce"),
+        block=None,
+        chunk_size=DEFAULT_ACCOUNTS_CHUNK,
+        workers=DEFAULT_WORKERS,
+    ):
+        """Fetch the balance, nonce and/or code of many accounts, all at the
+        same block : the latest one is pinned when block is not given.
+        Return an AccountFetcher, iterate over it to get the
+        (address, {field: value}) of the accounts, as they are fetched.
+        """
+        if block is None or block == "latest":
+            block = self.get_block_number()
+        return AccountFetcher(
+            self.jsonrpc, addresses, fields, block, chunk_size, workers
+        )
+
+    def subscribe(
+        self,
+        kind,
+        params=None,
+        callback=None,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        overflow=OVERFLOW_DROP_OLDEST,
+    ):
+        """Subscribe to notifications pushed by the node, WebSocket only.
+        kind : "newHeads", "logs", "newPendingTransactions"...
+        Return a Subscription, iterate over it to read the notifications,
+        or they are given to the callback in the WebSocket reader thread.
+        With many nodes, the subscription is on the best WebSocket one.
+        """
+        endpoint = self.jsonrpc.stream_endpoint()
+        subscription = Subscription(
+            self.jsonrpc, kind, params, callback, queue_size, overflow
+        )
+        subscription.endpoint = endpoint
+        subscription_id = self.jsonrpc.request(
+            "eth_subscribe", subscription.subscribe_params(), endpoint
+        )
+        endpoint.connect().add_subscription(subscription_id, subscription)
+        return subscription
+
+    def endpoints_status(self):
+        """Give the state, latency and error rate of the nodes endpoints."""
+        return self.jsonrpc.endpoints_status()
+
+    def connection_stats(self):
+        """Give the number of TLS handshakes, and of resumed sessions."""
+        return self.jsonrpc.connection_stats()
+
+
+class BatchResult:
+    """Result of a query in a batch, available after the batch was sent."""
+
+    def __init__(self, decoder=None):
+        self.decoder = decoder
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def set(self, raw_result):
+        """Record the raw result of the query, or its error."""
+        self.done = True
+        if isinstance(raw_result, Exception):
+            self.error = raw_result
+            return
+        try:
+            if self.decoder is None:
+                self.value = raw_result
+            else:
+                self.value = self.decoder(raw_result)
+        except Exception as exc:
+            self.error = exc
+
+    def result(self):
+        """Give the decoded result, or raise the error of this query."""
+        if not self.done:
+            raise Exception("The batch was not sent yet")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Web3Batch(Web3Methods):
+    """Queue Web3 queries, and send them in batches when leaving the context.
+    Each method gives a BatchResult, read with its result() method once the
+    batch was sent.
+    """
+
+    def __init__(self, web3client):
+        self.jsonrpc = web3client.jsonrpc
+        self.requests = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def query(self, method_name, params=None, decoder=None):
+        """Queue a RPC query in the batch, return its BatchResult"""
+        result = BatchResult(decoder)
+        self.requests.append((method_name, params))
+        self.results.append(result)
+        return result
+
+    def send(self):
+        """Send the queued queries and record their results."""
+        requests, self.requests = self.requests, []
+        results, self.results = self.results, []
+        for result, raw_result in zip(results, self.jsonrpc.request_many(requests)):
+            result.set(raw_result)
@@ -1,176 +1,605 @@
-# -*- coding: utf8 -*-
-
-# pyWeb3 : WebSocket client
-# Copyright (C) 2021-2022 BitLogiK
-
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, version 3 of the License.
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-# You should have receive a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>
-
-
-"""WebSocket client"""
-
-
-from logging import getLogger
-from urllib.parse import urlparse
-from time import sleep
-
-from wsproto import WSConnection, ConnectionType
-from wsproto.events import (
-    Request,
-    AcceptConnection,
-    RejectConnection,
-    CloseConnection,
-    Ping,
-    Message,
-    TextMessage,
-    BytesMessage,
-)
-from .tls_socket import TLSsocket
-
-
-DEFAULT_HTTPS_PORT = 443
-
-GLOBAL_TIMEOUT = 8  # seconds
-UNIT_WAITING_TIME = 0.4
-CYCLES_TIMEOUT = int(GLOBAL_TIMEOUT / UNIT_WAITING_TIME)
-
-
-logger = getLogger(__name__)
-
-
-class WebSocketClientException(Exception):
-    """Exception from the WebSocket client."""
-
-
-class WebSocketClient:
-    """WebSocket client with a host within HTTPS, send and decode messages."""
-
-    def __init__(self, wsURL, user_agent):
-        """Open the WebSocket connection to a given a URL."""
-        ws_url = urlparse(wsURL)
-        assert ws_url.scheme == "wss"
-        self.partial_txtmessages = []
-        self.partial_binmessages = []
-        self.received_messages = []
-        port_num = ws_url.port or DEFAULT_HTTPS_PORT
-        try:
-            self.ssocket = TLSsocket(ws_url.hostname, port_num)
-            self.websock_conn = WSConnection(ConnectionType.CLIENT)
-            page = ws_url.path
-            if ws_url.query:
-                page += f"?{ws_url.query}"
-            logger.debug(
-                "Connecting to WebSocket Host=%s PathTarget=%s",
-                ws_url.hostname,
-                page,
-            )
-            self.send(
-                Request(
-                    host=ws_url.hostname,
-                    target=page or "/",
-                    extra_headers=[("User-Agent", user_agent)],
-                )
-            )
-            cyclew = 0
-            while cyclew < CYCLES_TIMEOUT:
-                logger.debug("Waiting WebSocket handshake : %ith loop.", cyclew + 1)
-                sleep(UNIT_WAITING_TIME)
-                self.get_messages()
-                while len(self.received_messages) > 0:
-                    res = self.received_messages.pop()
-                    if res == "established":
-                        return
-                    if res == "rejected":
-                        raise WebSocketClientException("WebSocket handshake rejected")
-                cyclew += 1
-            if cyclew == CYCLES_TIMEOUT:
-                raise WebSocketClientException("WebSocket handshake timeout")
-        except Exception as exc:
-            logger.error(
-                "Error during WebSocket connection : %s", str(exc), exc_info=exc
-            )
-            raise WebSocketClientException(exc) from exc
-
-    def close(self):
-        """Stop read timer and close the TLS connection when deleting the object."""
-        logger.debug("Cancelling the WebSocket reading timer")
-        if hasattr(self, "ssocket"):
-            if self.ssocket is not None:
-                logger.debug("Closing WebSocket")
-                self.ssocket.close()
-                self.ssocket = None
-
-    def send(self, data_frame):
-        """Send a WebSocket data frame to the host."""
-        frame_bin = self.websock_conn.send(data_frame)
-        self.ssocket.send(frame_bin)
-
-    def send_message(self, data_message):
-        """Send a message to the host."""
-        raw_message = Message(data_message)
-        logger.log(5, "Sending message : %s", raw_message.data)
-        self.send(raw_message)
-
-    def get_messages(self):
-        """Read data from server and decode messages.
-        Return a list of messages.
-        "established", "rejected", <text>, <bytes>.
-        Text and Bytes messages are given as their content.
-        Close underlying TLS socket if WS connection closed.
-        Auto-reply to ping messages.
-        """
-        # Test if socket is still opened
-        if self.ssocket.conn is None:
-            logger.debug("Socket was closed by remote party")
-            self.close()
-            return
-        # Listen to server data and build a queue list
-        datarcv = self.ssocket.receive()
-        if datarcv:
-            self.websock_conn.receive_data(datarcv)
-            for event in self.websock_conn.events():
-                if isinstance(event, AcceptConnection):
-                    logger.debug("WebSocket connection established.")
-                    self.received_messages.append("established")
-                elif isinstance(event, RejectConnection):
-                    logger.debug("WebSocket connection rejected.")
-                    self.received_messages.append("rejected")
-                elif isinstance(event, CloseConnection):
-                    logger.error(
-                        "WebSocket Connection closed: code=%i reason=%s",
-                        event.code,
-                        event.reason,
-                    )
-                    self.close()
-                elif isinstance(event, Ping):
-                    logger.debug("Ping received in WebSocket")
-                    self.send(event.response())
-                    logger.debug("Pong reply sent")
-                elif isinstance(event, TextMessage):
-                    self.partial_txtmessages.append(event.data)
-                    if event.message_finished:
-                        full_message = "".join(self.partial_txtmessages)
-                        logger.log(
-                            5, "WebSocket Text message received : %s", full_message
-                        )
-                        self.received_messages.append(full_message)
-                        self.partial_txtmessages = []
-                elif isinstance(event, BytesMessage):
-                    self.partial_binmessages.append(event.data)
-                    if event.message_finished:
-                        full_message = b"".join(self.partial_binmessages)
-                        logger.log(
-                            5, "WebSocket Binary message received : %s", full_message
-                        )
-                        self.received_messages.append(full_message)
-                        self.partial_binmessages = []
-
-                else:
-                    Exception(f"Unknown WebSocket event : {event}")
+# -*- coding: utf8 -*-
+
+# pyWeb3 : WebSocket client
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+"""WebSocket client"""
+
+
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from itertools import count
+from logging import getLogger
+from random import uniform
+from socket import timeout as socket_timeout
+from threading import BoundedSemaphore, Lock, RLock, Thread
+from urllib.parse import urlparse
+from time import monotonic, sleep
+from weakref import ref
+
+from wsproto import WSConnection, ConnectionType
+from wsproto.connection import ConnectionState
+from wsproto.extensions import PerMessageDeflate
+from wsproto.events import (
+    Request,
+    AcceptConnection,
+    RejectConnection,
+    CloseConnection,
+    Ping,
+    Pong,
+    Message,
+    TextMessage,
+    BytesMessage,
+)
+from .instrumentation import instrumentation, PHASE_DECODE, PHASE_SEND
+from .json_codec import json_codec
+from .subscription import SubscriptionException
+from .tls_socket import TLSsocket
+
+
+DEFAULT_HTTPS_PORT = 443
+
+GLOBAL_TIMEOUT = 8  # seconds
+
+# Maximum number of requests waiting for their response
+DEFAULT_MAX_INFLIGHT = 1000
+
+# Notifications kept for subscriptions not registered yet
+EARLY_NOTIFICATIONS_IDS = 16
+EARLY_NOTIFICATIONS_SIZE = 100
+
+# Heartbeat : a ping is sent after HEARTBEAT_INTERVAL seconds without data
+# from the server, which is dead when no pong came after HEARTBEAT_TIMEOUT.
+HEARTBEAT_INTERVAL = 15  # seconds
+HEARTBEAT_TIMEOUT = 10  # seconds
+READ_POLL_INTERVAL = 1  # seconds, the reader checks the heartbeat
+
+# Reconnection after the connection is lost, with exponential backoff
+RECONNECT_BASE_DELAY = 0.5  # seconds
+RECONNECT_MAX_DELAY = 15  # seconds
+RECONNECT_MAX_TIME = 60  # seconds of attempts, before giving up
+
+# Ids of the eth_subscribe requests sent again after a reconnection
+RESUBSCRIBE_IDS = count(1)
+
+
+logger = getLogger(__name__)
+
+
+class WebSocketClientException(Exception):
+    """Exception from the WebSocket client."""
+
+
+def handshake_request(ws_url, user_agent, compression=False):
+    """Build the WebSocket handshake request of a parsed wss URL.
+    With compression, the permessage-deflate extension is offered.
+    """
+    page = ws_url.path
+    if ws_url.query:
+        page += f"?{ws_url.query}"
+    logger.debug(
+        "Connecting to WebSocket Host=%s PathTarget=%s",
+        ws_url.hostname,
+        page,
+    )
+    return Request(
+        host=ws_url.hostname,
+        target=page or "/",
+        extra_headers=[("User-Agent", user_agent)],
+        extensions=[PerMessageDeflate()] if compression else [],
+    )
+
+
+def response_ids(resp_obj):
+    """Give the ids of a decoded JSON-RPC response, or batch response."""
+    if isinstance(resp_obj, list):
+        return [item.get("id") for item in resp_obj if isinstance(item, dict)]
+    return [resp_obj.get("id")]
+
+
+def read_loop(client_ref):
+    """Reader thread : read the WebSocket and dispatch the received messages.
+    Only keep a weak reference to the client between reads, so the client
+    can be deleted, which closes its socket.
+    """
+    while True:
+        client = client_ref()
+        if client is None or not client.read_step():
+            return
+        del client
+
+
+class WebSocketClient:
+    """WebSocket client with a host within HTTPS, send and decode messages.
+    Once connected, a reader thread dispatches the JSON-RPC responses to
+    their waiting requests, so many requests can be in flight at once.
+    The reader sends pings when the server is silent, and reconnects when
+    the connection is lost : the pending requests are sent again, except
+    the ones which are not idempotent, and the subscriptions are renewed.
+    """
+
+    def __init__(
+        self,
+        wsURL,
+        user_agent,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        connector=None,
+        compression=True,
+    ):
+        """Open the WebSocket connection to a given a URL.
+        With compression, the messages are compressed when the server
+        accepts the permessage-deflate extension.
+        """
+        self.ws_url = urlparse(wsURL)
+        assert self.ws_url.scheme == "wss"
+        self.user_agent = user_agent
+        self.connector = connector
+        self.compression = compression
+        self.port_num = self.ws_url.port or DEFAULT_HTTPS_PORT
+        self.ssocket = None
+        self.websock_conn = None
+        self.partial_txtmessages = []
+        self.partial_binmessages = []
+        self.received_messages = []
+        self.lock = RLock()
+        self.pending = {}
+        self.pending_lock = Lock()
+        self.inflight = BoundedSemaphore(max_inflight)
+        self.subscriptions = {}
+        self.early_notifications = {}
+        self.reader = None
+        self.closed = False
+        self.last_received = monotonic()
+        self.ping_sent = None
+        self.reconnections = 0
+        self.connect()
+        self.start_reader()
+
+    def connect(self):
+        """Open the TLS connection, and do the WebSocket handshake."""
+        try:
+            ssocket = TLSsocket(
+                self.ws_url.hostname, self.port_num, connector=self.connector
+            )
+            with self.lock:
+                self.ssocket = ssocket
+                self.websock_conn = WSConnection(ConnectionType.CLIENT)
+                self.partial_txtmessages = []
+                self.partial_binmessages = []
+            self.send(
+                handshake_request(self.ws_url, self.user_agent, self.compression)
+            )
+            deadline = monotonic() + GLOBAL_TIMEOUT
+            while True:
+                logger.debug("Waiting WebSocket handshake")
+                remaining = deadline - monotonic()
+                if remaining <= 0 or not ssocket.wait_readable(remaining):
+                    raise WebSocketClientException("WebSocket handshake timeout")
+                self.get_messages()
+                while len(self.received_messages) > 0:
+                    res = self.received_messages.pop(0)
+                    if res == "established":
+                        return
+                    if res == "rejected":
+                        raise WebSocketClientException("WebSocket handshake rejected")
+                if not self.is_connected():
+                    raise WebSocketClientException("Socket was closed by remote party")
+        except Exception as exc:
+            self.drop_connection()
+            logger.error(
+                "Error during WebSocket connection : %s", str(exc), exc_info=exc
+            )
+            raise WebSocketClientException(exc) from exc
+
+    def close(self):
+        """Close the TLS connection for good, this stops the reader thread."""
+        self.closed = True
+        self.drop_connection()
+
+    def drop_connection(self):
+        """Close the TLS connection, the reader thread reconnects."""
+        with self.lock:
+            if self.ssocket is not None:
+                logger.debug("Closing WebSocket")
+                self.ssocket.close()
+                self.ssocket = None
+
+    def is_closed(self):
+        """Tell if the client was closed, or gave up reconnecting."""
+        return self.closed
+
+    def is_connected(self):
+        """Tell if the connection is open, it is not during a reconnection."""
+        return self.ssocket is not None and self.ssocket.conn is not None
+
+    def is_open(self):
+        """Tell if the connection is connected and its handshake is done."""
+        return self.is_connected() and self.websock_conn.state == ConnectionState.OPEN
+
+    def send(self, data_frame):
+        """Send a WebSocket data frame to the host."""
+        with self.lock:
+            if not self.is_connected():
+                raise WebSocketClientException("WebSocket connection is closed")
+            frame_bin = self.websock_conn.send(data_frame)
+            try:
+                self.ssocket.send(frame_bin)
+            except OSError as exc:
+                self.drop_connection()
+                raise WebSocketClientException(exc) from exc
+
+    def send_message(self, data_message):
+        """Send a message to the host."""
+        raw_message = Message(data_message)
+        if logger.isEnabledFor(5):
+            logger.log(5, "Sending message : %s", raw_message.data)
+        start = monotonic()
+        with self.lock:
+            # During a reconnection handshake, the request waits to be replayed
+            if not self.is_open():
+                raise WebSocketClientException("WebSocket connection is not open")
+            self.send(raw_message)
+        if instrumentation.enabled:
+            instrumentation.phase(PHASE_SEND, monotonic() - start)
+
+    def get_messages(self):
+        """Read data from server and decode messages.
+        Return a list of messages.
+        "established", "rejected", <text>, <bytes>.
+        Text and Bytes messages are given as their content.
+        Close underlying TLS socket if WS connection closed.
+        Auto-reply to ping messages.
+        """
+        # Test if socket is still opened
+        if not self.is_connected():
+            logger.debug("Socket was closed by remote party")
+            self.drop_connection()
+            return
+        # Listen to server data and build a queue list
+        with self.lock:
+            # The socket is readable, and the TLS connection can't be read
+            # while another thread writes to it
+            if not self.is_connected():
+                return
+            datarcv = self.ssocket.receive()
+            if not datarcv:
+                return
+            self.last_received = monotonic()
+            self.ping_sent = None
+            self.websock_conn.receive_data(datarcv)
+            for event in self.websock_conn.events():
+                if isinstance(event, AcceptConnection):
+                    logger.debug("WebSocket connection established.")
+                    self.received_messages.append("established")
+                elif isinstance(event, RejectConnection):
+                    logger.debug("WebSocket connection rejected.")
+                    self.received_messages.append("rejected")
+                elif isinstance(event, CloseConnection):
+                    logger.error(
+                        "WebSocket Connection closed: code=%i reason=%s",
+                        event.code,
+                        event.reason,
+                    )
+                    self.drop_connection()
+                elif isinstance(event, Ping):
+                    logger.debug("Ping received in WebSocket")
+                    self.send(event.response())
+                    logger.debug("Pong reply sent")
+                elif isinstance(event, Pong):
+                    logger.debug("Pong received in WebSocket")
+                elif isinstance(event, TextMessage):
+                    self.partial_txtmessages.append(event.data)
+                    if event.message_finished:
+                        full_message = "".join(self.partial_txtmessages)
+                        if logger.isEnabledFor(5):
+                            logger.log(
+                                5, "WebSocket Text message received : %s", full_message
+                            )
+                        self.received_messages.append(full_message)
+                        self.partial_txtmessages = []
+                elif isinstance(event, BytesMessage):
+                    self.partial_binmessages.append(event.data)
+                    if event.message_finished:
+                        full_message = b"".join(self.partial_binmessages)
+                        if logger.isEnabledFor(5):
+                            logger.log(
+                                5,
+                                "WebSocket Binary message received : %s",
+                                full_message,
+                            )
+                        self.received_messages.append(full_message)
+                        self.partial_binmessages = []
+
+                else:
+                    Exception(f"Unknown WebSocket event : {event}")
+
+    def start_reader(self):
+        """Start the reader thread, which dispatches the received messages."""
+        self.reader = Thread(
+            target=read_loop, args=(ref(self),), name="WebSocketReader", daemon=True
+        )
+        self.reader.start()
+
+    def read_step(self):
+        """Read and dispatch the messages from the server, reconnect when
+        the connection was lost.
+        Return False when the client is closed.
+        """
+        ssocket = self.ssocket
+        if ssocket is not None:
+            try:
+                if ssocket.wait_readable(READ_POLL_INTERVAL):
+                    self.get_messages()
+                else:
+                    self.heartbeat()
+            except socket_timeout:
+                # No complete data from the server, keep listening
+                pass
+            except Exception as exc:
+                if self.is_connected():
+                    logger.error(
+                        "Error in WebSocket reader : %s", str(exc), exc_info=exc
+                    )
+                    self.drop_connection()
+        while self.received_messages:
+            self.dispatch(self.received_messages.pop(0))
+        if self.closed:
+            self.fail_pending(WebSocketClientException("WebSocket connection closed"))
+            return False
+        if not self.is_connected():
+            return self.reconnect()
+        return True
+
+    def heartbeat(self):
+        """Send a ping when the server is silent, drop the connection when
+        the pong doesn't come in time.
+        """
+        now = monotonic()
+        if self.ping_sent is not None:
+            if now - self.ping_sent > HEARTBEAT_TIMEOUT:
+                logger.warning("WebSocket heartbeat timeout, the server is dead")
+                self.drop_connection()
+        elif now - self.last_received > HEARTBEAT_INTERVAL:
+            logger.debug("Sending ping in WebSocket")
+            self.ping_sent = now
+            self.send(Ping())
+
+    def reconnect(self):
+        """Open a new connection after the previous one was lost, waiting
+        with an exponential backoff between the attempts. Then the pending
+        requests are sent again, and the subscriptions are renewed.
+        Return False when it gives up after RECONNECT_MAX_TIME.
+        """
+        self.fail_not_replayable()
+        start = monotonic()
+        attempt = 0
+        while not self.closed:
+            delay = uniform(
+                0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt)
+            )
+            if monotonic() + delay - start > RECONNECT_MAX_TIME:
+                break
+            sleep(delay)
+            if self.closed:
+                break
+            logger.info("Reconnecting WebSocket, attempt %i", attempt + 1)
+            try:
+                self.connect()
+            except WebSocketClientException:
+                attempt += 1
+                continue
+            self.reconnections += 1
+            self.replay_pending()
+            self.resubscribe()
+            return True
+        logger.error("WebSocket connection lost")
+        self.closed = True
+        self.fail_pending(WebSocketClientException("WebSocket connection lost"))
+        return False
+
+    def fail_not_replayable(self):
+        """Give an error to the pending requests which can't be sent again."""
+        with self.pending_lock:
+            futures = set(
+                future for future in self.pending.values() if not future.replay
+            )
+            for future in futures:
+                for req_id in future.request_ids:
+                    del self.pending[req_id]
+        for future in futures:
+            future.set_exception(
+                WebSocketClientException("WebSocket connection lost during request")
+            )
+
+    def replay_pending(self):
+        """Send again the requests waiting for their response."""
+        with self.pending_lock:
+            futures = set(self.pending.values())
+        if futures:
+            logger.debug("Sending again %i pending requests", len(futures))
+        for future in futures:
+            try:
+                self.send_message(future.message)
+            except WebSocketClientException:
+                # Lost again, the next reconnection replays them
+                return
+            # Once sent, a request not idempotent must not be sent again
+            future.replay = future.idempotent
+
+    def resubscribe(self):
+        """Subscribe again, the node gives new subscription ids.
+        The notifications during the reconnection are missed.
+        """
+        with self.pending_lock:
+            subscriptions = list(self.subscriptions.values())
+            self.subscriptions.clear()
+            self.early_notifications.clear()
+        for subscription in subscriptions:
+            if subscription.closed:
+                continue
+            req_id = f"resubscribe-{next(RESUBSCRIBE_IDS)}"
+            future = Future()
+            future.request_ids = [req_id]
+            future.replay = True
+            future.idempotent = True
+            future.message = json_codec.dumps(
+                {
+                    "jsonrpc": "2.0",
+                    "method": "eth_subscribe",
+                    "params": subscription.subscribe_params(),
+                    "id": req_id,
+                }
+            )
+            future.add_done_callback(
+                lambda done, subscription=subscription: self.resubscribed(
+                    done, subscription
+                )
+            )
+            with self.pending_lock:
+                self.pending[req_id] = future
+            try:
+                self.send_message(future.message)
+            except WebSocketClientException:
+                # Lost again, the next reconnection replays it
+                pass
+
+    def resubscribed(self, future, subscription):
+        """Register a subscription renewed, with its new id."""
+        if future.exception() is not None:
+            subscription.stop(SubscriptionException(future.exception()))
+            return
+        response = future.result()
+        if "result" not in response:
+            subscription.stop(SubscriptionException(response.get("error")))
+            return
+        logger.debug("Subscription %s renewed", subscription.subscription_id)
+        self.add_subscription(response["result"], subscription)
+
+    def dispatch(self, message):
+        """Give a received JSON-RPC response to its waiting request.
+        A batch response is matched by the id of any of its items.
+        """
+        start = monotonic()
+        try:
+            resp_obj = json_codec.loads(message)
+        except Exception:
+            logger.error("Not JSON message received : %s", message)
+            return
+        if instrumentation.enabled:
+            instrumentation.phase(PHASE_DECODE, monotonic() - start)
+        if isinstance(resp_obj, dict) and resp_obj.get("method") == "eth_subscription":
+            self.notify(resp_obj.get("params", {}))
+            return
+        with self.pending_lock:
+            for resp_id in response_ids(resp_obj):
+                future = self.pending.get(resp_id)
+                if future is not None:
+                    for req_id in future.request_ids:
+                        del self.pending[req_id]
+                    break
+            else:
+                future = None
+        if future is None:
+            logger.debug("Message received without pending request : %s", message)
+            return
+        future.set_result(resp_obj)
+
+    def notify(self, notification_params):
+        """Give a subscription notification to its subscription.
+        The notifications received before the subscription is registered
+        are kept a while, it is registered after its id is received.
+        """
+        subscription_id = notification_params.get("subscription")
+        with self.pending_lock:
+            subscription = self.subscriptions.get(subscription_id)
+            if subscription is None:
+                early = self.early_notifications.setdefault(subscription_id, [])
+                if len(early) < EARLY_NOTIFICATIONS_SIZE:
+                    early.append(notification_params.get("result"))
+                if len(self.early_notifications) > EARLY_NOTIFICATIONS_IDS:
+                    del self.early_notifications[next(iter(self.early_notifications))]
+                return
+        subscription.push(notification_params.get("result"))
+
+    def add_subscription(self, subscription_id, subscription):
+        """Register a subscription, to receive the notifications of its id."""
+        subscription.subscription_id = subscription_id
+        with self.pending_lock:
+            self.subscriptions[subscription_id] = subscription
+            early = self.early_notifications.pop(subscription_id, [])
+        for notification in early:
+            subscription.push(notification)
+
+    def remove_subscription(self, subscription_id):
+        """Unregister a subscription."""
+        with self.pending_lock:
+            self.subscriptions.pop(subscription_id, None)
+
+    def fail_pending(self, exc):
+        """Give an error to all the requests waiting a response,
+        and stop the subscriptions.
+        """
+        with self.pending_lock:
+            futures = set(self.pending.values())
+            self.pending.clear()
+            subscriptions = list(self.subscriptions.values())
+            self.subscriptions.clear()
+        for future in futures:
+            future.set_exception(exc)
+        for subscription in subscriptions:
+            subscription.stop(SubscriptionException(exc))
+
+    def exchange(self, request_ids, data_message, timeout=GLOBAL_TIMEOUT, replay=True):
+        """Send a JSON-RPC request (or batch) and wait for its response.
+        Return the decoded response object.
+        Thread-safe, many requests can be in flight at once.
+        When the connection is lost, the request is sent again after the
+        reconnection if replay is True, else it fails. A request made during
+        a reconnection is sent once it is done.
+        """
+        if self.closed:
+            raise WebSocketClientException("WebSocket connection is closed")
+        deadline = monotonic() + timeout
+        if not self.inflight.acquire(timeout=timeout):
+            raise WebSocketClientException("Too many requests in flight")
+        try:
+            future = Future()
+            future.request_ids = request_ids
+            future.message = data_message
+            future.idempotent = replay
+            try:
+                try:
+                    with self.lock:
+                        # Not sent yet during a reconnection, it can be sent after
+                        connection_open = self.is_open()
+                        future.replay = replay or not connection_open
+                        with self.pending_lock:
+                            for req_id in request_ids:
+                                self.pending[req_id] = future
+                        if connection_open:
+                            self.send_message(data_message)
+                except WebSocketClientException:
+                    if not future.replay or self.closed:
+                        raise
+                if not connection_open:
+                    logger.debug("Request waiting for the WebSocket reconnection")
+                return future.result(max(deadline - monotonic(), 0))
+            except FutureTimeoutError as exc:
+                raise WebSocketClientException("WebSocket response timeout") from exc
+            finally:
+                with self.pending_lock:
+                    for req_id in request_ids:
+                        if self.pending.get(req_id) is future:
+                            del self.pending[req_id]
+        finally:
+            self.inflight.release()
@@ -0,0 +1,162 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : nodes endpoints tests
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import unittest
+from time import monotonic
+
+from pyweb3.endpoints import (
+    CLOSED,
+    EJECTION_TIME,
+    FAILURES_TO_EJECT,
+    HALF_OPEN,
+    MAX_EJECTION_TIME,
+    OPEN,
+    PROBE_TIMEOUT,
+    Endpoint,
+    select_endpoint,
+)
+
+
+def make_endpoint(url="https://node.example"):
+    """Give an endpoint, its connection is never opened."""
+    return Endpoint(url, "test", 100, None)
+
+
+def ejected_endpoint():
+    """Give an endpoint which succeeded, then failed until ejected."""
+    endpoint = make_endpoint()
+    endpoint.record_success(0.1)
+    for _ in range(FAILURES_TO_EJECT):
+        endpoint.record_failure()
+    return endpoint
+
+
+class TestEndpoint(unittest.TestCase):
+    def test_new(self):
+        endpoint = make_endpoint()
+        self.assertEqual(endpoint.state, CLOSED)
+        self.assertTrue(endpoint.is_available(monotonic()))
+        self.assertEqual(endpoint.score(), 0)
+
+    def test_never_succeeded_ejected_at_once(self):
+        endpoint = make_endpoint()
+        endpoint.record_failure()
+        self.assertEqual(endpoint.state, OPEN)
+        self.assertFalse(endpoint.is_available(monotonic()))
+
+    def test_ejected_after_consecutive_failures(self):
+        endpoint = make_endpoint()
+        endpoint.record_success(0.1)
+        for _ in range(FAILURES_TO_EJECT - 1):
+            endpoint.record_failure()
+        self.assertEqual(endpoint.state, CLOSED)
+        endpoint.record_success(0.1)
+        for _ in range(FAILURES_TO_EJECT - 1):
+            endpoint.record_failure()
+        self.assertEqual(endpoint.state, CLOSED)
+        endpoint.record_failure()
+        self.assertEqual(endpoint.state, OPEN)
+        now = monotonic()
+        self.assertFalse(endpoint.is_available(now))
+        self.assertTrue(endpoint.is_available(now + EJECTION_TIME))
+
+    def test_start_request_closed(self):
+        endpoint = make_endpoint()
+        endpoint.start_request(monotonic())
+        self.assertEqual(endpoint.state, CLOSED)
+
+    def test_start_request_not_due(self):
+        endpoint = ejected_endpoint()
+        endpoint.start_request(monotonic())
+        self.assertEqual(endpoint.state, OPEN)
+
+    def test_probe_success(self):
+        endpoint = ejected_endpoint()
+        now = monotonic() + EJECTION_TIME
+        endpoint.start_request(now)
+        self.assertEqual(endpoint.state, HALF_OPEN)
+        # A single probe at once
+        self.assertFalse(endpoint.is_available(now))
+        endpoint.record_success(0.1)
+        self.assertEqual(endpoint.state, CLOSED)
+        self.assertEqual(endpoint.ejection_time, EJECTION_TIME)
+        self.assertTrue(endpoint.is_available(now))
+
+    def test_probe_failure(self):
+        endpoint = ejected_endpoint()
+        endpoint.start_request(monotonic() + EJECTION_TIME)
+        endpoint.record_failure()
+        self.assertEqual(endpoint.state, OPEN)
+        self.assertEqual(endpoint.ejection_time, 2 * EJECTION_TIME)
+        now = monotonic()
+        self.assertFalse(endpoint.is_available(now + EJECTION_TIME))
+        self.assertTrue(endpoint.is_available(now + 2 * EJECTION_TIME))
+
+    def test_ejection_time_limit(self):
+        endpoint = ejected_endpoint()
+        for _ in range(20):
+            endpoint.start_request(monotonic() + MAX_EJECTION_TIME)
+            endpoint.record_failure()
+        self.assertEqual(endpoint.ejection_time, MAX_EJECTION_TIME)
+
+    def test_probe_without_outcome(self):
+        endpoint = ejected_endpoint()
+        now = monotonic() + EJECTION_TIME
+        endpoint.start_request(now)
+        self.assertFalse(endpoint.is_available(now + PROBE_TIMEOUT / 2))
+        # Probed again after the probe deadline
+        now += PROBE_TIMEOUT
+        self.assertTrue(endpoint.is_available(now))
+        endpoint.start_request(now)
+        self.assertEqual(endpoint.state, HALF_OPEN)
+        self.assertFalse(endpoint.is_available(now))
+        endpoint.record_success(0.1)
+        self.assertEqual(endpoint.state, CLOSED)
+
+    def test_score(self):
+        endpoint = make_endpoint()
+        endpoint.record_success(0.1)
+        score = endpoint.score()
+        self.assertAlmostEqual(score, 0.1)
+        endpoint.record_failure()
+        self.assertGreater(endpoint.score(), score)
+
+
+class TestSelectEndpoint(unittest.TestCase):
+    def test_lowest_score(self):
+        fast = make_endpoint("https://fast.example")
+        slow = make_endpoint("https://slow.example")
+        fast.record_success(0.1)
+        slow.record_success(0.5)
+        self.assertIs(select_endpoint([slow, fast]), fast)
+
+    def test_skip_ejected(self):
+        ejected = ejected_endpoint()
+        ejected.latency = 0.01
+        other = make_endpoint("https://other.example")
+        other.record_success(0.5)
+        self.assertIs(select_endpoint([ejected, other]), other)
+        self.assertEqual(ejected.state, OPEN)
+
+    def test_all_ejected(self):
+        first = ejected_endpoint()
+        second = ejected_endpoint()
+        second.ejected_until = first.ejected_until + 1
+        self.assertIs(select_endpoint([second, first]), first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : hedged requests tests
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import unittest
+from threading import current_thread, Event
+from time import monotonic, sleep
+
+from pyweb3.hedging import MIN_SAMPLES, RequestHedger
+
+
+def fast_hedger(delay):
+    """Give a hedger, its hedging delay is about the given one."""
+    hedger = RequestHedger()
+    for _ in range(MIN_SAMPLES):
+        hedger.latencies.record(delay)
+    return hedger
+
+
+class TestRequestHedger(unittest.TestCase):
+    def tearDown(self):
+        self.hedger.close()
+
+    def test_primary_in_calling_thread(self):
+        self.hedger = fast_hedger(0.05)
+        caller = current_thread()
+        hedged = Event()
+
+        def primary(deadline):
+            self.assertIs(current_thread(), caller)
+            return 1
+
+        def hedge(deadline):
+            hedged.set()
+            return 2
+
+        self.assertEqual(self.hedger.run(primary, hedge), 1)
+        sleep(0.1)
+        self.assertFalse(hedged.is_set())
+        self.assertEqual(self.hedger.stats(), {"hedged": 0, "hedge_wins": 0})
+
+    def test_hedge_used_when_primary_fails(self):
+        self.hedger = fast_hedger(0.01)
+        hedge_thread = []
+
+        def primary(deadline):
+            sleep(0.1)
+            raise ValueError("primary failed")
+
+        def hedge(deadline):
+            hedge_thread.append(current_thread())
+            return 2
+
+        self.assertEqual(self.hedger.run(primary, hedge), 2)
+        self.assertIsNot(hedge_thread[0], current_thread())
+        self.assertEqual(self.hedger.stats(), {"hedged": 1, "hedge_wins": 1})
+
+    def test_both_fail(self):
+        self.hedger = fast_hedger(0.01)
+
+        def primary(deadline):
+            sleep(0.1)
+            raise ValueError("primary failed")
+
+        def hedge(deadline):
+            raise KeyError("hedge failed")
+
+        with self.assertRaises(ValueError):
+            self.hedger.run(primary, hedge)
+
+    def test_fast_failure_not_hedged(self):
+        self.hedger = fast_hedger(0.05)
+        hedged = Event()
+
+        def primary(deadline):
+            raise ValueError("primary failed")
+
+        def hedge(deadline):
+            hedged.set()
+            return 2
+
+        with self.assertRaises(ValueError):
+            self.hedger.run(primary, hedge)
+        sleep(0.1)
+        self.assertFalse(hedged.is_set())
+
+    def test_no_hedge_after_deadline(self):
+        self.hedger = fast_hedger(0.05)
+        hedged = Event()
+
+        def primary(deadline):
+            sleep(0.1)
+            return 1
+
+        def hedge(deadline):
+            hedged.set()
+            return 2
+
+        self.assertEqual(self.hedger.run(primary, hedge, monotonic() + 0.02), 1)
+        self.assertFalse(hedged.is_set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : JSON streaming decoder tests
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import json
+import unittest
+
+from pyweb3.json_stream import ResultStreamParser, JSONStreamException
+
+
+RESPONSES = [
+    '{"jsonrpc":"2.0","id":1,"result":[]}',
+    '{"jsonrpc":"2.0","id":1,"result":[1500.25,2,-3e-2,true,false,null]}',
+    '{"jsonrpc": "2.0", "id": 1, "result": [ {"a": [1, {"b": "]}"}]} ,\n'
+    ' "x\\"y\\\\", [[]], {} ] }',
+    '{"id":1,"result":["\\u00e9t\\u00e9","été ✓","\\\\","[{,:"],"jsonrpc":"2.0"}',
+    '{"jsonrpc":"2.0","id":1,"result":"0x1234"}',
+    '{"jsonrpc":"2.0","id":1,"error":{"code":-32000,"message":"bad [ ]"}}',
+    '{"jsonrpc":"2.0","id":1,"result":{"result":[1,2]}}',
+]
+
+
+def parse(parts):
+    """Feed the parts to a parser, give the items and the final response."""
+    parser = ResultStreamParser()
+    items = []
+    for part in parts:
+        items.extend(parser.feed(part))
+    return items, parser.finish()
+
+
+def expected(response):
+    """Give the items streamed from a response, and the final response."""
+    response_obj = json.loads(response)
+    if isinstance(response_obj.get("result"), list):
+        items = response_obj["result"]
+        response_obj["result"] = []
+        return items, response_obj
+    return [], response_obj
+
+
+class TestResultStreamParser(unittest.TestCase):
+    def test_whole(self):
+        for response in RESPONSES:
+            self.assertEqual(parse([response.encode("utf8")]), expected(response))
+
+    def test_split_at_every_offset(self):
+        for response in RESPONSES:
+            data = response.encode("utf8")
+            for offset in range(len(data) + 1):
+                self.assertEqual(
+                    parse([data[:offset], data[offset:]]),
+                    expected(response),
+                    f"split at {offset} : {data[:offset]}",
+                )
+
+    def test_byte_by_byte(self):
+        for response in RESPONSES:
+            data = response.encode("utf8")
+            parts = [data[index : index + 1] for index in range(len(data))]
+            self.assertEqual(parse(parts), expected(response))
+
+    def test_split_number(self):
+        parser = ResultStreamParser()
+        self.assertEqual(parser.feed(b'{"id":1,"result":[1500.'), [])
+        self.assertEqual(parser.feed(b"25,2]}"), [1500.25, 2])
+
+    def test_items_given_when_complete(self):
+        parser = ResultStreamParser()
+        self.assertEqual(parser.feed(b'{"id":1,"result":[{"a":1},{"b"'), [{"a": 1}])
+        self.assertEqual(parser.feed(b":2}"), [{"b": 2}])
+        self.assertEqual(parser.feed(b",3"), [])
+        self.assertEqual(parser.feed(b"]}"), [3])
+
+    def test_large_item_in_small_parts(self):
+        item = {"input": "0x" + "ab" * 200000, "calls": [{"to": "0x1"}] * 1000}
+        data = json.dumps({"id": 1, "result": [item, item]}).encode("utf8")
+        parts = [data[index : index + 100] for index in range(0, len(data), 100)]
+        self.assertEqual(parse(parts)[0], [item, item])
+
+    def test_bad_separator(self):
+        parser = ResultStreamParser()
+        with self.assertRaises(JSONStreamException):
+            parser.feed(b'{"id":1,"result":[1 2]}')
+
+    def test_bad_item(self):
+        parser = ResultStreamParser()
+        with self.assertRaises(JSONStreamException):
+            parser.feed(b'{"id":1,"result":[1,tru,2]}')
+
+    def test_truncated(self):
+        parser = ResultStreamParser()
+        parser.feed(b'{"id":1,"result":[1,2')
+        with self.assertRaises(JSONStreamException):
+            parser.finish()
+
+
+if __name__ == "__main__":
+    unittest.main()
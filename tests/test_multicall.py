@@ -0,0 +1,156 @@
+# -*- coding: utf8 -*-
+
+# pyWeb3 : Multicall3 aggregation tests
+# Copyright (C) 2021-2022 BitLogiK
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have receive a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import unittest
+
+from pyweb3.json_rpc import JSONRPCexception
+from pyweb3.multicall import (
+    AGGREGATE3_SELECTOR,
+    MAX_CALLDATA_BYTES,
+    MULTICALL3_ADDRESS,
+    MulticallException,
+    aggregate3_request,
+    call_result,
+    decode_aggregate3,
+    encode_aggregate3,
+    split_calls,
+)
+
+
+TARGET = "0x" + "11" * 20
+
+# ABI encoding of the aggregate3 argument, a (address,bool,bytes)[] of
+# (TARGET, true, 0x12345678) and (MULTICALL3_ADDRESS, true, 0x)
+AGGREGATE3_ARGS = bytes.fromhex(
+    "".join(
+        [
+            "0000000000000000000000000000000000000000000000000000000000000020",
+            "0000000000000000000000000000000000000000000000000000000000000002",
+            "0000000000000000000000000000000000000000000000000000000000000040",
+            "00000000000000000000000000000000000000000000000000000000000000e0",
+            "0000000000000000000000001111111111111111111111111111111111111111",
+            "0000000000000000000000000000000000000000000000000000000000000001",
+            "0000000000000000000000000000000000000000000000000000000000000060",
+            "0000000000000000000000000000000000000000000000000000000000000004",
+            "1234567800000000000000000000000000000000000000000000000000000000",
+            "000000000000000000000000ca11bde05977b3631167028862be2a173976ca11",
+            "0000000000000000000000000000000000000000000000000000000000000001",
+            "0000000000000000000000000000000000000000000000000000000000000060",
+            "0000000000000000000000000000000000000000000000000000000000000000",
+        ]
+    )
+)
+
+# ABI encoding of an aggregate3 result, a (bool,bytes)[] of (true, uint 42)
+# and (false, Error("nope"))
+AGGREGATE3_RESULT = bytes.fromhex(
+    "".join(
+        [
+            "0000000000000000000000000000000000000000000000000000000000000020",
+            "0000000000000000000000000000000000000000000000000000000000000002",
+            "0000000000000000000000000000000000000000000000000000000000000040",
+            "00000000000000000000000000000000000000000000000000000000000000c0",
+            "0000000000000000000000000000000000000000000000000000000000000001",
+            "0000000000000000000000000000000000000000000000000000000000000040",
+            "0000000000000000000000000000000000000000000000000000000000000020",
+            "000000000000000000000000000000000000000000000000000000000000002a",
+            "0000000000000000000000000000000000000000000000000000000000000000",
+            "0000000000000000000000000000000000000000000000000000000000000040",
+            "0000000000000000000000000000000000000000000000000000000000000064",
+            "08c379a000000000000000000000000000000000000000000000000000000000",
+            "0000002000000000000000000000000000000000000000000000000000000000",
+            "000000046e6f7065000000000000000000000000000000000000000000000000",
+            "0000000000000000000000000000000000000000000000000000000000000000",
+        ]
+    )
+)
+
+REVERT_NOPE = (
+    "0x08c379a0"
+    "0000000000000000000000000000000000000000000000000000000000000020"
+    "0000000000000000000000000000000000000000000000000000000000000004"
+    "6e6f706500000000000000000000000000000000000000000000000000000000"
+)
+
+
+class TestAggregate3(unittest.TestCase):
+    def test_encode(self):
+        calls = [(TARGET, bytes.fromhex("12345678")), (MULTICALL3_ADDRESS, b"")]
+        self.assertEqual(
+            encode_aggregate3(calls), AGGREGATE3_SELECTOR + AGGREGATE3_ARGS
+        )
+
+    def test_request(self):
+        method, params = aggregate3_request(
+            [(TARGET, bytes.fromhex("12345678"))], "0x10"
+        )
+        self.assertEqual(method, "eth_call")
+        self.assertEqual(params[0]["to"], MULTICALL3_ADDRESS)
+        self.assertEqual(params[0]["data"][:10], "0x82ad56cb")
+        self.assertEqual(params[1], "0x10")
+
+    def test_decode(self):
+        self.assertEqual(
+            decode_aggregate3(AGGREGATE3_RESULT, 2),
+            [(True, "0x" + f"{42:064x}"), (False, REVERT_NOPE)],
+        )
+
+    def test_decode_count_mismatch(self):
+        with self.assertRaises(MulticallException):
+            decode_aggregate3(AGGREGATE3_RESULT, 3)
+
+    def test_decode_truncated(self):
+        for length in (0, 64, 200, len(AGGREGATE3_RESULT) - 64):
+            with self.assertRaises(MulticallException):
+                decode_aggregate3(AGGREGATE3_RESULT[:length], 2)
+
+
+class TestSplitCalls(unittest.TestCase):
+    def test_max_calls(self):
+        calls = [(TARGET, b"\x01" * 4)] * 7
+        self.assertEqual([len(chunk) for chunk in split_calls(calls, 3)], [3, 3, 1])
+
+    def test_max_bytes(self):
+        calls = [(TARGET, b"\x01" * 20000)] * 7
+        chunks = split_calls(calls, 300)
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 7)
+        for chunk in chunks:
+            self.assertLessEqual(
+                len(encode_aggregate3(chunk)), MAX_CALLDATA_BYTES + 4 + 64
+            )
+
+    def test_large_call_alone(self):
+        calls = [(TARGET, b"\x01" * (MAX_CALLDATA_BYTES + 1)), (TARGET, b"")]
+        self.assertEqual([len(chunk) for chunk in split_calls(calls)], [1, 1])
+
+
+class TestCallResult(unittest.TestCase):
+    def test_success(self):
+        self.assertEqual(call_result("0x2a"), (True, "0x2a"))
+
+    def test_revert_data(self):
+        error = JSONRPCexception(
+            {"code": 3, "message": "execution reverted", "data": REVERT_NOPE}
+        )
+        self.assertEqual(call_result(error), (False, REVERT_NOPE))
+
+    def test_error_without_data(self):
+        error = JSONRPCexception({"code": -32000, "message": "out of gas"})
+        self.assertEqual(call_result(error), (False, "0x"))
+
+
+if __name__ == "__main__":
+    unittest.main()